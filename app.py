@@ -1,340 +1,586 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session, Response
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from datetime import datetime, date
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, text
+from sqlalchemy.exc import OperationalError
 import os
 import json
+import click
 
 from config import Config
-from models import db, User, InvoiceApplication, InvoiceDetail
-from readpdftxt import extract_pdf_info
+from models import db, User, InvoiceApplication, InvoiceDetail, ExtractionTrace
+from db_engine import init_engine, run_write, upgrade_schema, is_database_locked
+from importer import import_invoices
+from text_layer import reparse_invoices, backfill_text_layers
+from rollups import track_rollups, rebuild_rollups, ensure_rollups
+from user_cache import user_cache, init_user_cache, load_cached_user, record_user_change
+from issuers import init_issuer_index, refresh_issuer_index, note_issuer
+from events import init_events, record_application_event, feed
+from previews import init_previews
+from storage import init_storage, get_storage
+from buyers import init_buyers, get_buyers
+from lifecycle import cleanup_storage, application_files, remove_files
+from archive import archive_settled
+from metrics import init_metrics
+from extraction_traces import summarize_traces
 
-app = Flask(__name__, template_folder='templates')
-app.config.from_object(Config)
-Config.init_app(app)
-
-# 初始化数据库
-db.init_app(app)
-
-# 初始化登录管理
+# 登录管理（扩展对象全局共享，在 create_app 中绑定到应用）
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = '请先登录'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
-# ==================== 认证路由 ====================
+    return load_cached_user(int(user_id), lambda uid: db.session.get(User, uid))
 
-@app.route('/')
-def index():
-    if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+def create_app(config=None):
+    """
+    创建应用
     
-    if request.method == 'POST':
-        login = request.form.get('login')
-        password = request.form.get('password')
-        
-        user = User.query.filter_by(login=login).first()
-        if user and user.check_password(password):
-            login_user(user)
-            next_page = request.args.get('next')
-            return redirect(next_page or url_for('dashboard'))
-        else:
-            flash('登录名或密码错误', 'error')
+    Args:
+        config: 覆盖 Config 的配置项（dict），如测试和基准使用的数据库地址
     
-    return render_template('login.html')
-
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
-
-@app.route('/register', methods=['GET', 'POST'])
-def register():
-    if request.method == 'POST':
-        login = request.form.get('login')
-        name = request.form.get('name')
-        password = request.form.get('password')
-        role = request.form.get('role', '普通用户')
-        
-        if User.query.filter_by(login=login).first():
-            flash('登录名已存在', 'error')
-        else:
-            user = User(login=login, name=name, role=role)
-            user.set_password(password)
-            db.session.add(user)
-            db.session.commit()
-            flash('注册成功，请登录', 'success')
-            return redirect(url_for('login'))
+    Returns:
+        Flask: 应用对象
+    """
+    app = Flask(__name__, template_folder='templates')
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    Config.init_app(app)
     
-    return render_template('register.html')
-
-# ==================== 主页 ====================
-
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    # 普通用户：只看自己的申请
-    if current_user.role == '普通用户':
-        my_applications = InvoiceApplication.query.filter_by(user_id=current_user.id).order_by(InvoiceApplication.created_at.desc()).all()
-        return render_template('dashboard.html', my_applications=my_applications, pending_applications=[])
+    # 初始化数据库
+    db.init_app(app)
+    init_engine(app)
     
-    # 管理员和财务：看自己的+待处理的
-    my_applications = InvoiceApplication.query.filter_by(user_id=current_user.id).order_by(InvoiceApplication.created_at.desc()).all()
-    pending_applications = InvoiceApplication.query.filter(
-        InvoiceApplication.user_id != current_user.id,
-        InvoiceApplication.status == '已提交'
-    ).order_by(InvoiceApplication.created_at.desc()).all()
+    # 初始化运行指标（请求耗时、SQL 统计、慢请求日志）
+    init_metrics(app)
     
-    return render_template('dashboard.html', my_applications=my_applications, pending_applications=pending_applications)
-
-# ==================== 申请管理 ====================
-
-@app.route('/application/create', methods=['GET', 'POST'])
-@login_required
-def create_application():
-    if request.method == 'POST':
-        name = request.form.get('name')
-        reimbursement_person = request.form.get('reimbursement_person')
-        is_paid = request.form.get('is_paid') == 'on'
-        remarks = request.form.get('remarks', '')
-        
-        # 生成申请编号：YYYYMMDDHHmm + user_id
-        sn = datetime.now().strftime('%Y%m%d%H%M') + str(current_user.id)
-        
-        application = InvoiceApplication(
-            sn=sn,
-            name=name,
-            reimbursement_person=reimbursement_person,
-            is_paid=is_paid,
-            remarks=remarks,
-            user_id=current_user.id,
-            status='未提交'
-        )
-        db.session.add(application)
-        db.session.commit()
-        
-        flash('申请创建成功', 'success')
-        return redirect(url_for('edit_application', app_id=application.id))
+    # 初始化登录用户缓存
+    init_user_cache(app)
     
-    return render_template('create_application.html')
-
-@app.route('/application/<int:app_id>/edit')
-@login_required
-def edit_application(app_id):
-    application = InvoiceApplication.query.get_or_404(app_id)
+    # 初始化开票方自动补全索引
+    init_issuer_index(app)
     
-    # 权限检查
-    if current_user.role == '普通用户' and application.user_id != current_user.id:
-        flash('没有权限', 'error')
-        return redirect(url_for('dashboard'))
+    # 初始化待处理队列的实时推送
+    init_events(app)
     
-    return render_template('edit_application.html', application=application, reimbursement_types=InvoiceDetail.REIMBURSEMENT_TYPES)
-
-@app.route('/application/<int:app_id>/delete', methods=['POST'])
-@login_required
-def delete_application(app_id):
-    application = InvoiceApplication.query.get_or_404(app_id)
+    # 初始化上传文件存储后端
+    init_storage(app)
     
-    if current_user.role == '普通用户' and application.user_id != current_user.id:
-        return jsonify({'success': False, 'message': '没有权限'}), 403
+    # 初始化购买方主体自动机
+    init_buyers(app)
     
-    db.session.delete(application)
-    db.session.commit()
+    # 初始化发票预览图缓存
+    init_previews(app)
     
-    return jsonify({'success': True, 'message': '删除成功'})
-
-@app.route('/application/<int:app_id>/submit', methods=['POST'])
-@login_required
-def submit_application(app_id):
-    application = InvoiceApplication.query.get_or_404(app_id)
+    # 初始化登录管理
+    login_manager.init_app(app)
     
-    if current_user.role == '普通用户' and application.user_id != current_user.id:
-        return jsonify({'success': False, 'message': '没有权限'}), 403
+    register_core_routes(app)
     
-    application.status = '已提交'
-    db.session.commit()
+    # 注册额外的路由
+    from routes import register_routes
+    register_routes(app)
     
-    return jsonify({'success': True, 'message': '提交成功'})
-
-@app.route('/application/<int:app_id>/mark_paid', methods=['POST'])
-@login_required
-def mark_paid(app_id):
-    application = InvoiceApplication.query.get_or_404(app_id)
-    
-    if current_user.role == '普通用户' and application.user_id != current_user.id:
-        return jsonify({'success': False, 'message': '没有权限'}), 403
-    
-    # 获取报销日期时间
-    reimbursement_date_str = request.form.get('reimbursement_date')
-    if not reimbursement_date_str:
-        return jsonify({'success': False, 'message': '请选择报销日期时间'}), 400
-    
-    try:
-        # 解析日期时间（格式：2024-11-15T14:30）
-        reimbursement_date = datetime.strptime(reimbursement_date_str, '%Y-%m-%dT%H:%M')
-    except ValueError:
-        return jsonify({'success': False, 'message': '日期时间格式错误'}), 400
-    
-    # 处理银行回单上传
-    if 'receipt_file' not in request.files:
-        return jsonify({'success': False, 'message': '请上传转账回单文件'}), 400
-    
-    file = request.files['receipt_file']
-    if not file or file.filename == '':
-        return jsonify({'success': False, 'message': '请上传转账回单文件'}), 400
-    
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'receipts', filename)
-        file.save(filepath)
-        application.bank_receipt_url = f"/uploads/receipts/{filename}"
-    else:
-        return jsonify({'success': False, 'message': '不支持的文件类型'}), 400
-    
-    application.is_paid = True
-    application.status = '已报销'
-    application.reimbursement_date = reimbursement_date
-    db.session.commit()
-    
-    return jsonify({'success': True, 'message': f'标记成功，报销日期：{reimbursement_date.strftime("%Y-%m-%d %H:%M")}'})
+    register_commands(app)
+    return app
 
-# ==================== 用户管理（仅管理员） ====================
-
-@app.route('/admin/users')
-@login_required
-def manage_users():
-    """用户管理页面"""
-    if current_user.role != '管理员':
-        flash('没有权限访问此页面', 'error')
-        return redirect(url_for('dashboard'))
-    
-    users = User.query.order_by(User.created_at.desc()).all()
-    return render_template('manage_users.html', users=users)
+def warm_up(app):
+    """
+    多进程部署时在 fork 之前执行的预热，子进程共享这些只读状态：
+    PDF相关模块和字体注册、提取用的正则、数据库引擎和表结构、开票方索引
+    """
+    import readpdftxt
+    import pdf_generator
+    readpdftxt.warm_up()
+    pdf_generator.get_font_name()
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        ensure_rollups()
+        refresh_issuer_index()
+        db.session.remove()
 
-@app.route('/admin/user/<int:user_id>/edit', methods=['GET', 'POST'])
-@login_required
-def edit_user(user_id):
-    """编辑用户"""
-    if current_user.role != '管理员':
-        return jsonify({'success': False, 'message': '没有权限'}), 403
+def register_core_routes(app):
+    """注册认证、主页、申请和用户管理路由"""
     
-    user = User.query.get_or_404(user_id)
+    def allowed_file(filename):
+        return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
     
-    if request.method == 'POST':
-        data = request.get_json()
+    # ==================== 认证路由 ====================
+    
+    @app.route('/')
+    def index():
+        if current_user.is_authenticated:
+            return redirect(url_for('dashboard'))
+        return redirect(url_for('login'))
+    
+    @app.route('/login', methods=['GET', 'POST'])
+    def login():
+        if current_user.is_authenticated:
+            return redirect(url_for('dashboard'))
         
-        # 更新登录名（检查重复）
-        if 'login' in data and data['login'] != user.login:
-            if User.query.filter_by(login=data['login']).first():
-                return jsonify({'success': False, 'message': '登录名已存在'})
-            user.login = data['login']
+        if request.method == 'POST':
+            login = request.form.get('login')
+            password = request.form.get('password')
+            
+            user = User.query.filter_by(login=login).first()
+            if user and user.check_password(password):
+                login_user(user)
+                next_page = request.args.get('next')
+                return redirect(next_page or url_for('dashboard'))
+            else:
+                flash('登录名或密码错误', 'error')
         
-        # 更新用户姓名
-        if 'name' in data:
-            user.name = data['name']
+        return render_template('login.html')
+    
+    @app.route('/logout')
+    @login_required
+    def logout():
+        logout_user()
+        return redirect(url_for('login'))
+    
+    @app.route('/register', methods=['GET', 'POST'])
+    def register():
+        if request.method == 'POST':
+            login = request.form.get('login')
+            name = request.form.get('name')
+            password = request.form.get('password')
+            role = request.form.get('role', '普通用户')
+            
+            if User.query.filter_by(login=login).first():
+                flash('登录名已存在', 'error')
+            else:
+                user = User(login=login, name=name, role=role)
+                user.set_password(password)
+                db.session.add(user)
+                db.session.commit()
+                flash('注册成功，请登录', 'success')
+                return redirect(url_for('login'))
         
-        # 更新角色
-        if 'role' in data:
-            user.role = data['role']
+        return render_template('register.html')
+    
+    # ==================== 主页 ====================
+    
+    @app.route('/dashboard')
+    @login_required
+    def dashboard():
+        # 普通用户：只看自己的申请
+        if current_user.role == '普通用户':
+            my_applications = InvoiceApplication.query.filter_by(user_id=current_user.id).order_by(InvoiceApplication.created_at.desc()).all()
+            return render_template('dashboard.html', my_applications=my_applications, pending_applications=[])
         
-        # 更新密码（如果提供）
-        if 'password' in data and data['password']:
-            user.set_password(data['password'])
+        # 管理员和财务：看自己的+待处理的
+        my_applications = InvoiceApplication.query.filter_by(user_id=current_user.id).order_by(InvoiceApplication.created_at.desc()).all()
+        pending_applications = InvoiceApplication.query.filter(
+            InvoiceApplication.user_id != current_user.id,
+            InvoiceApplication.status == '已提交'
+        ).order_by(InvoiceApplication.created_at.desc()).all()
         
-        db.session.commit()
-        return jsonify({'success': True, 'message': '用户信息已更新'})
+        # 页面之后的变化由 /dashboard/events 推送
+        return render_template('dashboard.html', my_applications=my_applications, pending_applications=pending_applications,
+                               last_event_id=feed.latest_id())
+    
+    @app.route('/dashboard/events')
+    @login_required
+    def dashboard_events():
+        """待处理队列的变化（Server-Sent Events，仅管理员和财务）"""
+        if current_user.role not in ['管理员', '财务']:
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        # 重连时浏览器带上收到的最后一个事件ID，第一次连接时为页面生成时的ID
+        after = request.headers.get('Last-Event-ID', type=int)
+        if after is None:
+            after = request.args.get('after', 0, type=int)
+        backlog = feed.backlog(app, after)
+        db.session.remove()
+        
+        return Response(feed.stream(after, backlog), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    # ==================== 申请管理 ====================
+    
+    @app.route('/application/create', methods=['GET', 'POST'])
+    @login_required
+    def create_application():
+        if request.method == 'POST':
+            name = request.form.get('name')
+            reimbursement_person = request.form.get('reimbursement_person')
+            is_paid = request.form.get('is_paid') == 'on'
+            remarks = request.form.get('remarks', '')
+            
+            # 生成申请编号：YYYYMMDDHHmm + user_id
+            sn = datetime.now().strftime('%Y%m%d%H%M') + str(current_user.id)
+            
+            application = InvoiceApplication(
+                sn=sn,
+                name=name,
+                reimbursement_person=reimbursement_person,
+                is_paid=is_paid,
+                remarks=remarks,
+                user_id=current_user.id,
+                status='未提交'
+            )
+            db.session.add(application)
+            db.session.commit()
+            
+            flash('申请创建成功', 'success')
+            return redirect(url_for('edit_application', app_id=application.id))
+        
+        return render_template('create_application.html')
     
-    return render_template('edit_user.html', user=user)
-
-@app.route('/admin/user/<int:user_id>/delete', methods=['POST'])
-@login_required
-def delete_user(user_id):
-    """删除用户"""
-    if current_user.role != '管理员':
-        return jsonify({'success': False, 'message': '没有权限'}), 403
+    @app.route('/application/<int:app_id>/edit')
+    @login_required
+    def edit_application(app_id):
+        application = InvoiceApplication.query.get_or_404(app_id)
+        
+        # 权限检查
+        if current_user.role == '普通用户' and application.user_id != current_user.id:
+            flash('没有权限', 'error')
+            return redirect(url_for('dashboard'))
+        
+        # 可作为批量移动目标的申请：同一创建人的其他未付款申请
+        move_targets = InvoiceApplication.query.filter(
+            InvoiceApplication.user_id == application.user_id,
+            InvoiceApplication.id != application.id,
+            InvoiceApplication.is_paid == False
+        ).order_by(InvoiceApplication.created_at.desc()).all()
+        
+        return render_template('edit_application.html', application=application, reimbursement_types=InvoiceDetail.REIMBURSEMENT_TYPES, move_targets=move_targets)
     
-    user = User.query.get_or_404(user_id)
+    @app.route('/application/<int:app_id>/delete', methods=['POST'])
+    @login_required
+    def delete_application(app_id):
+        application = InvoiceApplication.query.get_or_404(app_id)
+        
+        if current_user.role == '普通用户' and application.user_id != current_user.id:
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        # 提交成功后再删除申请的发票文件和银行回单
+        files = application_files(application)
+        for detail in application.details:
+            note_issuer(db.session, detail.issuer, -1)
+        with track_rollups(app_ids=[application.id]):
+            db.session.delete(application)
+        record_application_event(app_id, 'deleted')
+        db.session.commit()
+        remove_files(files)
+        
+        return jsonify({'success': True, 'message': '删除成功'})
     
-    # 不能删除自己
-    if user.id == current_user.id:
-        return jsonify({'success': False, 'message': '不能删除自己的账户'})
+    @app.route('/application/<int:app_id>/submit', methods=['POST'])
+    @login_required
+    def submit_application(app_id):
+        application = InvoiceApplication.query.get_or_404(app_id)
+        
+        if current_user.role == '普通用户' and application.user_id != current_user.id:
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        with track_rollups(app_ids=[application.id]):
+            application.status = '已提交'
+        record_application_event(application.id, 'submitted')
+        db.session.commit()
+        
+        return jsonify({'success': True, 'message': '提交成功'})
     
-    # 检查用户是否有关联的申请
-    if user.applications:
-        return jsonify({'success': False, 'message': f'该用户有 {len(user.applications)} 个申请，无法删除'})
+    @app.route('/application/<int:app_id>/mark_paid', methods=['POST'])
+    @login_required
+    def mark_paid(app_id):
+        application = InvoiceApplication.query.get_or_404(app_id)
+        
+        if current_user.role == '普通用户' and application.user_id != current_user.id:
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        # 获取报销日期时间
+        reimbursement_date_str = request.form.get('reimbursement_date')
+        if not reimbursement_date_str:
+            return jsonify({'success': False, 'message': '请选择报销日期时间'}), 400
+        
+        try:
+            # 解析日期时间（格式：2024-11-15T14:30）
+            reimbursement_date = datetime.strptime(reimbursement_date_str, '%Y-%m-%dT%H:%M')
+        except ValueError:
+            return jsonify({'success': False, 'message': '日期时间格式错误'}), 400
+        
+        # 处理银行回单上传
+        if 'receipt_file' not in request.files:
+            return jsonify({'success': False, 'message': '请上传转账回单文件'}), 400
+        
+        file = request.files['receipt_file']
+        if not file or file.filename == '':
+            return jsonify({'success': False, 'message': '请上传转账回单文件'}), 400
+        
+        if file and allowed_file(file.filename):
+            filename = secure_filename(file.filename)
+            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+            filename = f"{timestamp}_{filename}"
+            get_storage().save(f"receipts/{filename}", file.stream)
+            bank_receipt_url = f"/uploads/receipts/{filename}"
+        else:
+            return jsonify({'success': False, 'message': '不支持的文件类型'}), 400
+        
+        def save_paid():
+            application = db.session.get(InvoiceApplication, app_id)
+            with track_rollups(app_ids=[app_id]):
+                application.bank_receipt_url = bank_receipt_url
+                application.is_paid = True
+                application.status = '已报销'
+                application.reimbursement_date = reimbursement_date
+            record_application_event(app_id, 'paid')
+            db.session.commit()
+        
+        try:
+            run_write(save_paid)
+        except OperationalError as e:
+            db.session.rollback()
+            # 没有记录到申请上的回单文件直接删除
+            get_storage().delete(f"receipts/{filename}")
+            if is_database_locked(e):
+                return jsonify({'success': False, 'message': '系统繁忙，请稍后重试'}), 503
+            return jsonify({'success': False, 'message': f'标记失败: {str(e)}'}), 500
+        
+        return jsonify({'success': True, 'message': f'标记成功，报销日期：{reimbursement_date.strftime("%Y-%m-%d %H:%M")}'})
     
-    db.session.delete(user)
-    db.session.commit()
+    # ==================== 用户管理（仅管理员） ====================
     
-    return jsonify({'success': True, 'message': '用户已删除'})
-
-@app.route('/admin/user/create', methods=['POST'])
-@login_required
-def create_user():
-    """创建新用户"""
-    if current_user.role != '管理员':
-        return jsonify({'success': False, 'message': '没有权限'}), 403
-    
-    data = request.get_json()
-    login = data.get('login')
-    name = data.get('name')
-    password = data.get('password')
-    role = data.get('role', '普通用户')
-    
-    if not login or not password or not name:
-        return jsonify({'success': False, 'message': '登录名、姓名和密码不能为空'})
-    
-    if User.query.filter_by(login=login).first():
-        return jsonify({'success': False, 'message': '登录名已存在'})
-    
-    user = User(login=login, name=name, role=role)
-    user.set_password(password)
-    db.session.add(user)
-    db.session.commit()
-    
-    return jsonify({'success': True, 'message': '用户创建成功', 'user_id': user.id})
-
-# 注册额外的路由
-from routes import register_routes
-register_routes(app)
-
-# ==================== 数据库初始化 ====================
-
-@app.cli.command()
-def init_db():
-    """初始化数据库"""
-    db.create_all()
-    print('数据库初始化成功')
-    
-    # 创建默认管理员账户
-    if not User.query.filter_by(login='admin').first():
-        admin = User(login='admin', name='管理员', role='管理员')
-        admin.set_password('admin123')
-        db.session.add(admin)
+    @app.route('/admin/users')
+    @login_required
+    def manage_users():
+        """用户管理页面"""
+        if current_user.role != '管理员':
+            flash('没有权限访问此页面', 'error')
+            return redirect(url_for('dashboard'))
+        
+        users = User.query.order_by(User.created_at.desc()).all()
+        return render_template('manage_users.html', users=users)
+    
+    @app.route('/admin/extraction_traces')
+    @login_required
+    def extraction_traces():
+        """PDF提取记录：按发票类型汇总的耗时和最近的慢文档"""
+        if current_user.role != '管理员':
+            flash('没有权限访问此页面', 'error')
+            return redirect(url_for('dashboard'))
+        
+        summary = summarize_traces()
+        slowest = ExtractionTrace.query.order_by(ExtractionTrace.total_ms.desc()).limit(50).all()
+        failed = (ExtractionTrace.query
+                  .filter(ExtractionTrace.fields.notlike('%发票号码%'))
+                  .order_by(ExtractionTrace.created_at.desc())
+                  .limit(50).all())
+        return render_template('extraction_traces.html', summary=summary, slowest=slowest, failed=failed)
+    
+    @app.route('/admin/user/<int:user_id>/edit', methods=['GET', 'POST'])
+    @login_required
+    def edit_user(user_id):
+        """编辑用户"""
+        if current_user.role != '管理员':
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        user = User.query.get_or_404(user_id)
+        
+        if request.method == 'POST':
+            data = request.get_json()
+            
+            # 更新登录名（检查重复）
+            if 'login' in data and data['login'] != user.login:
+                if User.query.filter_by(login=data['login']).first():
+                    return jsonify({'success': False, 'message': '登录名已存在'})
+                user.login = data['login']
+            
+            # 更新用户姓名
+            if 'name' in data:
+                user.name = data['name']
+            
+            # 更新角色
+            if 'role' in data:
+                user.role = data['role']
+            
+            # 更新密码（如果提供）
+            if 'password' in data and data['password']:
+                user.set_password(data['password'])
+            
+            record_user_change(user.id)
+            db.session.commit()
+            user_cache.invalidate(user.id)
+            return jsonify({'success': True, 'message': '用户信息已更新'})
+        
+        return render_template('edit_user.html', user=user)
+    
+    @app.route('/admin/user/<int:user_id>/delete', methods=['POST'])
+    @login_required
+    def delete_user(user_id):
+        """删除用户"""
+        if current_user.role != '管理员':
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        user = User.query.get_or_404(user_id)
+        
+        # 不能删除自己
+        if user.id == current_user.id:
+            return jsonify({'success': False, 'message': '不能删除自己的账户'})
+        
+        # 检查用户是否有关联的申请
+        if user.applications:
+            return jsonify({'success': False, 'message': f'该用户有 {len(user.applications)} 个申请，无法删除'})
+        
+        db.session.delete(user)
+        record_user_change(user_id)
         db.session.commit()
-        print('默认管理员账户已创建: admin / admin123')
+        user_cache.invalidate(user_id)
+        
+        return jsonify({'success': True, 'message': '用户已删除'})
+    
+    @app.route('/admin/user/create', methods=['POST'])
+    @login_required
+    def create_user():
+        """创建新用户"""
+        if current_user.role != '管理员':
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        data = request.get_json()
+        login = data.get('login')
+        name = data.get('name')
+        password = data.get('password')
+        role = data.get('role', '普通用户')
+        
+        if not login or not password or not name:
+            return jsonify({'success': False, 'message': '登录名、姓名和密码不能为空'})
+        
+        if User.query.filter_by(login=login).first():
+            return jsonify({'success': False, 'message': '登录名已存在'})
+        
+        user = User(login=login, name=name, role=role)
+        user.set_password(password)
+        db.session.add(user)
+        db.session.flush()
+        record_user_change(user.id)
+        db.session.commit()
+        user_cache.invalidate(user.id)
+        
+        return jsonify({'success': True, 'message': '用户创建成功', 'user_id': user.id})
+    
+    # ==================== 健康检查 ====================
+    
+    @app.route('/healthz')
+    def healthz():
+        """健康检查（无需登录），数据库不可用时返回 503"""
+        try:
+            db.session.execute(text('SELECT 1'))
+        except Exception as e:
+            return jsonify({'status': 'error', 'pid': os.getpid(), 'message': str(e)}), 503
+        return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+def register_commands(app):
+    """注册命令行命令"""
+    
+    @app.cli.command()
+    def init_db():
+        """初始化数据库"""
+        db.create_all()
+        upgrade_schema()
+        ensure_rollups()
+        print('数据库初始化成功')
+        
+        # 创建默认管理员账户
+        if not User.query.filter_by(login='admin').first():
+            admin = User(login='admin', name='管理员', role='管理员')
+            admin.set_password('admin123')
+            db.session.add(admin)
+            db.session.commit()
+            print('默认管理员账户已创建: admin / admin123')
+    
+    @app.cli.command('import-invoices')
+    @click.argument('directory', type=click.Path(exists=True, file_okay=False))
+    @click.option('--user', 'login', default='admin', help='申请的创建用户登录名')
+    @click.option('--person', default=None, help='报销人，默认为创建用户姓名')
+    @click.option('--status', default='已报销', type=click.Choice(['未提交', '已提交', '已报销']), help='导入后的申请状态')
+    @click.option('--workers', default=None, type=int, help='提取进程数，默认为CPU核数')
+    @click.option('--batch-size', default=200, help='每批插入的发票数')
+    @click.option('--journal', default=None, help='导入日志路径，默认为 <目录>/.import_journal.jsonl')
+    def import_invoices_command(directory, login, person, status, workers, batch_size, journal):
+        """批量导入历史发票目录（每个目录一个申请，可中断后继续）"""
+        user = User.query.filter_by(login=login).first()
+        if not user:
+            print(f'用户不存在: {login}')
+            return
+        
+        counts = import_invoices(
+            directory, user, get_buyers(),
+            person=person, status=status, workers=workers, batch_size=batch_size, journal_path=journal,
+            slow_ms=app.config['EXTRACTION_SLOW_MS']
+        )
+        print(f"导入完成：新增 {counts['imported']}，重复 {counts['duplicate']}，"
+              f"无法识别 {counts['failed']}，此前已处理 {counts['skipped']}")
+    
+    @app.cli.command('reparse-invoices')
+    @click.option('--apply', is_flag=True, help='写回有变化的字段（默认只生成差异文件）')
+    @click.option('--output', default='reparse_diff.jsonl', help='差异文件路径')
+    @click.option('--backfill', is_flag=True, help='先为没有文本层的历史发票读取一次PDF')
+    @click.option('--workers', default=None, type=int, help='解析进程数，默认为CPU核数')
+    @click.option('--include-paid', is_flag=True, help='同时修改已付款申请的发票（默认只列入差异文件）')
+    def reparse_invoices_command(apply, output, backfill, workers, include_paid):
+        """用保存的文本层重新解析发票，生成（或写回）有变化的字段"""
+        if backfill:
+            counts = backfill_text_layers(workers=workers)
+            print(f"补充文本层 {counts['filled']} 张，无法读取 {counts['failed']} 张")
+        counts = reparse_invoices(get_buyers(), apply=apply, output=output, workers=workers, include_paid=include_paid)
+        print(f"重新解析 {counts['scanned']} 张发票：有变化 {counts['changed']}，"
+              f"保留（手工修改或已付款）{counts['kept']}，无法解析 {counts['failed']}；差异见 {output}")
+        if not apply and counts['changed']:
+            print('未修改数据库，核对差异后加 --apply 写回')
+    
+    @app.cli.command('rebuild-rollups')
+    def rebuild_rollups_command():
+        """从发票明细重新生成报销汇总表"""
+        rebuild_rollups()
+        print('汇总表已重新生成')
+    
+    @app.cli.command('cleanup-storage')
+    @click.option('--dry-run', is_flag=True, help='只统计，不删除文件')
+    @click.option('--report-hours', default=None, type=float, help='报销单保留小时数，默认为 REPORT_RETENTION_HOURS')
+    @click.option('--grace-hours', default=None, type=float, help='无引用文件保留小时数，默认为 ORPHAN_GRACE_HOURS')
+    @click.option('--verbose', is_flag=True, help='列出删除的无引用文件')
+    def cleanup_storage_command(dry_run, report_hours, grace_hours, verbose):
+        """删除过期的报销单和没有被数据库引用的发票/回单文件"""
+        if report_hours is not None:
+            app.config['REPORT_RETENTION_HOURS'] = report_hours
+        if grace_hours is not None:
+            app.config['ORPHAN_GRACE_HOURS'] = grace_hours
+        
+        result = cleanup_storage(app, dry_run=dry_run)
+        if verbose:
+            for url in result['orphans']['paths']:
+                print(f'  {url}')
+        prefix = '试运行，将' if dry_run else '已'
+        print(f"{prefix}删除报销单 {result['reports']['files']} 个（{result['reports']['bytes'] / 1024 / 1024:.1f} MB），"
+              f"无引用文件 {result['orphans']['files']} 个（{result['orphans']['bytes'] / 1024 / 1024:.1f} MB），"
+              f"共释放 {result['bytes'] / 1024 / 1024:.1f} MB")
+    
+    @app.cli.command('archive-settled')
+    @click.option('--days', default=None, type=int, help='已报销超过多少天的申请，默认为 ARCHIVE_AFTER_DAYS')
+    @click.option('--dry-run', is_flag=True, help='只统计，不归档')
+    def archive_settled_command(days, dry_run):
+        """把已报销申请的发票和回单归档到按月的归档文件"""
+        if app.config['STORAGE_BACKEND'] != 'local':
+            print('归档只支持本地存储（STORAGE_BACKEND=local）')
+            return
+        days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+        result = archive_settled(app.config['UPLOAD_FOLDER'], days=days, dry_run=dry_run)
+        prefix = '试运行，将' if dry_run else '已'
+        print(f"{prefix}归档 {result['applications']} 个申请的 {result['files']} 个文件"
+              f"（{result['bytes'] / 1024 / 1024:.1f} MB），月份：{', '.join(result['months']) or '无'}")
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         db.create_all()
+        upgrade_schema()
+        ensure_rollups()
+        refresh_issuer_index()
         # 创建默认管理员（如果不存在）
         if not User.query.filter_by(login='admin').first():
             admin = User(login='admin', name='管理员', role='管理员')
@@ -342,4 +588,4 @@ if __name__ == '__main__':
             db.session.add(admin)
             db.session.commit()
             print('默认管理员账户已创建: admin / admin123')
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+已报销申请的文件归档
+申请报销完成（已报销）一段时间后，发票和银行回单很少再被访问，却以大量小文件的形式占用 inode、拖慢备份。
+归档任务把这些文件按报销月份追加到 uploads/archive/<YYYY-MM>.pack，
+偏移索引保存在同名的 .idx.json（{原相对路径: [偏移, 长度, SHA-256]}），
+数据库中的URL改写为 /uploads/archive/<YYYY-MM>/<原相对路径>，然后删除原文件。
+
+读取时用 mmap 映射整个归档文件，直接读取对应的字节范围，不需要解包；
+SHA-256 与预览图缓存的键相同，归档前生成的缩略图继续有效
+
+命令行：flask archive-settled [--days N] [--dry-run]
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from sqlalchemy import select
+
+from models import db, InvoiceApplication, InvoiceDetail
+
+ARCHIVE_FOLDER = 'archive'
+ARCHIVE_URL_PREFIX = f'/uploads/{ARCHIVE_FOLDER}/'
+# 归档的子目录
+ARCHIVED_FOLDERS = ('invoices', 'receipts')
+
+
+class ArchiveMember(io.RawIOBase):
+    """归档文件中的一个文件：只读、可 seek 的文件对象，数据直接从 mmap 读取"""
+
+    def __init__(self, name, data, offset, length, digest, mtime):
+        super().__init__()
+        self.name = name
+        self.digest = digest
+        self.mtime = mtime
+        self.length = length
+        self._data = data
+        self._offset = offset
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self._position = min(max(offset, 0), self.length)
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self._position)
+        if size <= 0:
+            return 0
+        start = self._offset + self._position
+        buffer[:size] = self._data[start:start + size]
+        self._position += size
+        return size
+
+    def getvalue(self):
+        """全部内容（bytes）"""
+        return self._data[self._offset:self._offset + self.length]
+
+
+class _PackReader:
+    """按归档文件缓存 mmap 和索引；归档文件被追加后重新映射"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._maps = {}  # 归档文件路径 -> mmap
+        self._indexes = {}  # 索引路径 -> ((mtime_ns, size), 索引)
+
+    def index(self, index_path):
+        stat = os.stat(index_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._indexes.get(index_path)
+            if cached and cached[0] == key:
+                return cached[1]
+        with open(index_path, encoding='utf-8') as f:
+            entries = json.load(f)
+        with self._lock:
+            self._indexes[index_path] = (key, entries)
+        return entries
+
+    def mapping(self, pack_path, end):
+        """至少覆盖到 end 的只读映射（旧的映射仍被正在发送的响应引用时由垃圾回收关闭）"""
+        with self._lock:
+            data = self._maps.get(pack_path)
+            if data is None or len(data) < end:
+                with open(pack_path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[pack_path] = data
+            return data
+
+
+_reader = _PackReader()
+
+
+def _pack_paths(upload_folder, month):
+    folder = os.path.join(upload_folder, ARCHIVE_FOLDER)
+    return os.path.join(folder, f'{month}.pack'), os.path.join(folder, f'{month}.idx.json')
+
+
+def is_archive_url(file_url):
+    return bool(file_url) and file_url.startswith(ARCHIVE_URL_PREFIX)
+
+
+def open_member(upload_folder, relative):
+    """
+    打开归档中的文件
+
+    Args:
+        upload_folder: 上传文件夹
+        relative: 上传目录下的相对路径，如 archive/2025-06/invoices/xxx.pdf
+
+    Returns:
+        ArchiveMember；不存在时为 None
+    """
+    parts = relative.split('/', 2)
+    if len(parts) != 3 or parts[0] != ARCHIVE_FOLDER:
+        return None
+    month, name = parts[1], parts[2]
+    if len(month) != 7 or not month.replace('-', '').isdigit():
+        return None
+    pack_path, index_path = _pack_paths(upload_folder, month)
+    try:
+        entry = _reader.index(index_path).get(name)
+        if entry is None:
+            return None
+        offset, length, digest = entry
+        data = _reader.mapping(pack_path, offset + length)
+        mtime = os.path.getmtime(index_path)
+    except (FileNotFoundError, ValueError):
+        return None
+    return ArchiveMember(name, data, offset, length, digest, mtime)
+
+
+def _settled_month(application):
+    settled_at = application.reimbursement_date or application.created_at
+    return settled_at.strftime('%Y-%m')
+
+
+def _append_to_pack(pack_path, index_path, files):
+    """
+    把文件追加到归档文件并更新索引（已在归档中的文件不重复追加）
+
+    先写数据并 fsync，再原子替换索引，中途失败时归档中只会多出没有索引指向的数据
+    """
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        entries = {}
+
+    with open(pack_path, 'ab') as pack:
+        offset = pack.seek(0, io.SEEK_END)
+        for name, path in files:
+            if name in entries:
+                continue
+            with open(path, 'rb') as f:
+                content = f.read()
+            pack.write(content)
+            entries[name] = [offset, len(content), hashlib.sha256(content).hexdigest()]
+            offset += len(content)
+        pack.flush()
+        os.fsync(pack.fileno())
+
+    temp_path = f'{index_path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, index_path)
+
+
+def _referenced_urls(urls):
+    """urls 中仍被发票明细或银行回单引用的URL"""
+    if not urls:
+        return set()
+    referenced = set(db.session.scalars(select(InvoiceDetail.file_url).where(InvoiceDetail.file_url.in_(urls))))
+    referenced.update(db.session.scalars(
+        select(InvoiceApplication.bank_receipt_url).where(InvoiceApplication.bank_receipt_url.in_(urls))
+    ))
+    return referenced
+
+
+def archive_settled(upload_folder, days=90, dry_run=False, now=None):
+    """
+    归档报销完成超过 days 天的申请的发票和银行回单（需在应用上下文中调用）
+
+    Returns:
+        dict: applications、files、bytes（归档的申请数、文件数、字节数）以及 months（涉及的月份）
+    """
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=days)
+    applications = db.session.scalars(
+        select(InvoiceApplication).where(
+            InvoiceApplication.status == '已报销',
+            db.func.coalesce(InvoiceApplication.reimbursement_date, InvoiceApplication.created_at) < cutoff
+        )
+    ).all()
+
+    # 月份 -> [(相对路径, 磁盘路径, 要改写URL的对象, 属性名, 申请ID), ...]
+    months = defaultdict(list)
+    for application in applications:
+        month = _settled_month(application)
+        urls = [(detail, 'file_url', detail.file_url) for detail in application.details]
+        urls.append((application, 'bank_receipt_url', application.bank_receipt_url))
+        for row, attr, url in urls:
+            if not url or not url.startswith('/uploads/') or is_archive_url(url):
+                continue
+            name = url[len('/uploads/'):]
+            if name.split('/', 1)[0] not in ARCHIVED_FOLDERS:
+                continue
+            path = os.path.join(upload_folder, name)
+            if os.path.isfile(path):
+                months[month].append((name, path, row, attr, application.id))
+
+    result = {
+        'applications': len({item[4] for items in months.values() for item in items}),
+        'files': 0,
+        'bytes': 0,
+        'months': sorted(months),
+    }
+    for month, items in sorted(months.items()):
+        # 一个文件包含多张发票时多条明细引用同一个文件
+        unique = {item[0]: item[1] for item in items}
+        result['files'] += len(unique)
+        result['bytes'] += sum(os.path.getsize(path) for path in unique.values())
+        if dry_run:
+            continue
+
+        pack_path, index_path = _pack_paths(upload_folder, month)
+        os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+        # 同一月份同时只允许一个归档任务写入
+        with open(f'{pack_path}.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _append_to_pack(pack_path, index_path, [(item[0], item[1]) for item in items])
+
+        for name, _, row, attr, _ in items:
+            setattr(row, attr, f'{ARCHIVE_URL_PREFIX}{month}/{name}')
+        db.session.commit()
+
+        # 提交成功后再删除原文件（删除失败的文件由 cleanup-storage 清理）；
+        # 同一文件可能还被未归档申请的明细或回单引用（批量移动、重复上传），这些文件保留
+        in_use = _referenced_urls({f'/uploads/{name}' for name in unique})
+        for name, path in unique.items():
+            if f'/uploads/{name}' in in_use:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return result
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""性能基准测试"""
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+并发写入基准：多个客户端同时向同一个 SQLite 数据库添加发票，统计每秒写入数和错误数
+
+用法：
+    python -m benchmarks.concurrent_uploads --clients 32 --duration 10
+    python -m benchmarks.concurrent_uploads --clients 32 --processes 4 --profile default
+
+写入走 /invoice/manual_add，与 /invoice/upload 的数据库写入路径相同（不含PDF解析）
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _import_app(db_path, profile):
+    from app import create_app
+    return create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}', 'DB_ENGINE_PROFILE': profile})
+
+
+def setup_database(db_path, profile):
+    """创建数据库、测试用户和申请，返回申请ID"""
+    app = _import_app(db_path, profile)
+    from models import db, User, InvoiceApplication
+    with app.app_context():
+        db.create_all()
+        user = User(login='bench', name='bench', role='普通用户')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        application = InvoiceApplication(sn='bench', name='bench', reimbursement_person='bench', user_id=user.id)
+        db.session.add(application)
+        db.session.commit()
+        return application.id
+
+
+def run_clients(args):
+    """在一个进程内运行若干客户端线程，返回 (成功数, 错误统计, 延迟列表)"""
+    db_path, profile, worker_id, clients, duration, app_id = args
+    app = _import_app(db_path, profile)
+
+    ok = [0]
+    errors = {}
+    latencies = []
+    lock = threading.Lock()
+    # 登录（密码哈希）比较耗时，全部登录完成后再开始计时
+    ready = threading.Barrier(clients, action=lambda: deadline.append(time.monotonic() + duration))
+    deadline = []
+
+    def client(client_id):
+        c = app.test_client()
+        c.post('/login', data={'login': 'bench', 'password': 'bench'})
+        ready.wait()
+        n = 0
+        while time.monotonic() < deadline[0]:
+            n += 1
+            start = time.perf_counter()
+            r = c.post('/invoice/manual_add', data={
+                'application_id': app_id,
+                'invoice_number': f'{worker_id}-{client_id}-{n}',
+                'invoice_date': '2025-01-01',
+                'issuer': '基准测试有限公司',
+                'amount': '12.34',
+            })
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if r.status_code == 200 and r.get_json().get('success'):
+                    ok[0] += 1
+                else:
+                    errors[r.status_code] = errors.get(r.status_code, 0) + 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return ok[0], errors, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite 并发写入基准')
+    parser.add_argument('--clients', type=int, default=32, help='并发客户端总数')
+    parser.add_argument('--processes', type=int, default=1, help='进程数（模拟多个 worker）')
+    parser.add_argument('--duration', type=float, default=10, help='持续时间（秒）')
+    parser.add_argument('--profile', default='sqlite-wal', help='Config.DB_ENGINE_PROFILES 中的配置名')
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_uploads_')
+    db_path = os.path.join(tmpdir, 'bench.db')
+
+    with Pool(1) as pool:
+        app_id = pool.apply(setup_database, (db_path, args.profile))
+
+    per_process = [args.clients // args.processes + (1 if i < args.clients % args.processes else 0)
+                   for i in range(args.processes)]
+    jobs = [(db_path, args.profile, i, n, args.duration, app_id) for i, n in enumerate(per_process)]
+    start = time.perf_counter()
+    with Pool(args.processes) as pool:
+        results = pool.map(run_clients, jobs)
+    elapsed = time.perf_counter() - start
+
+    ok = sum(r[0] for r in results)
+    errors = {}
+    latencies = []
+    for _, errs, lats in results:
+        for code, count in errs.items():
+            errors[code] = errors.get(code, 0) + count
+        latencies.extend(lats)
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+    report = {
+        'profile': args.profile,
+        'clients': args.clients,
+        'processes': args.processes,
+        'duration_s': round(elapsed, 2),
+        'uploads': ok,
+        'uploads_per_s': round(ok / args.duration, 1),
+        'errors': errors,
+        'p50_ms': round(percentile(0.50), 1),
+        'p99_ms': round(percentile(0.99), 1),
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for key, value in report.items():
+            print(f'{key:>14}: {value}')
+
+
+if __name__ == '__main__':
+    main()
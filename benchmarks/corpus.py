@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+合成发票语料生成器
+用 reportlab 生成包含 readpdftxt.py 识别标记的增值税电子发票和铁路电子客票，
+返回每个文件的期望提取结果，基准测试和数据库种子数据共用
+
+用法：
+    python -m benchmarks.corpus /tmp/corpus --count 100 --railway-ratio 0.2
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfgen import canvas
+
+# reportlab 内置的 CID 字体，不依赖系统字体，pdfplumber 可以正确提取中文
+FONT_NAME = 'STSong-Light'
+
+BUYER = '天津标度科技有限公司'
+BUYER_TAX_ID = '91120116MA05XXXX1K'
+# 基准测试只配置 COMPANY_NAME_KEYWORD 一个主体，购买方主体即该关键字
+BUYER_ENTITY = '标度'
+
+SELLERS = [
+    '北京京东世纪信息技术有限公司',
+    '上海携程国际旅行社有限公司',
+    '天津滨海新区华住酒店管理有限公司',
+    '中国石化销售股份有限公司天津石油分公司',
+    '北京三快在线科技有限公司',
+    '深圳市腾讯计算机系统有限公司',
+    '中国联合网络通信有限公司天津市分公司',
+    '天津市和平区小馆餐饮有限公司',
+]
+
+ITEMS = [
+    ('*餐饮服务*餐费', '6%'),
+    ('*住宿服务*住宿费', '6%'),
+    ('*经纪代理服务*代订车费', '6%'),
+    ('*计算机外部设备*鼠标', '13%'),
+    ('*纸制品*打印纸', '13%'),
+    ('*电信服务*通信费', '9%'),
+    ('*汽油*92号车用汽油', '13%'),
+]
+
+STATIONS = ['北京南', '天津', '天津西', '上海虹桥', '南京南', '济南西', '石家庄', '沈阳北']
+
+_font_registered = False
+
+
+def _register_font():
+    global _font_registered
+    if not _font_registered:
+        pdfmetrics.registerFont(UnicodeCIDFont(FONT_NAME))
+        _font_registered = True
+
+
+def _cn_date(value):
+    return value.strftime('%Y年%m月%d日')
+
+
+def generate_vat_invoice(path, invoice_number, invoice_date, seller, amount, items):
+    """
+    生成增值税电子普通发票
+
+    Args:
+        path: 输出路径
+        invoice_number: 20位发票号码
+        invoice_date: 开票日期（date）
+        seller: 销售方名称
+        amount: 价税合计（分）
+        items: [(项目名称, 税率), ...]
+    """
+    _register_font()
+    c = canvas.Canvas(path, pagesize=A4)
+    width, height = A4
+    c.setFont(FONT_NAME, 16)
+    c.drawCentredString(width / 2, height - 60, '电子发票（普通发票）')
+    c.setFont(FONT_NAME, 10)
+    y = height - 100
+    lines = [
+        f'发票号码:{invoice_number}',
+        f'开票日期:{_cn_date(invoice_date)}',
+        f'购买方信息 名称:{BUYER} 统一社会信用代码/纳税人识别号:{BUYER_TAX_ID}',
+        f'销售方信息 名称:{seller}',
+        '项目名称 规格型号 单位 数量 单价 金额 税率/征收率 税额',
+    ]
+    # 按税率倒推不含税金额，各明细平均分摊
+    share = amount // len(items)
+    for index, (name, rate) in enumerate(items):
+        line_amount = share if index < len(items) - 1 else amount - share * (len(items) - 1)
+        tax_rate = int(rate.rstrip('%'))
+        net = round(line_amount / (1 + tax_rate / 100))
+        lines.append(f'{name} 次 1 {net / 100:.2f} {net / 100:.2f} {rate} {(line_amount - net) / 100:.2f}')
+    lines.append(f'价税合计（大写）圆整 （小写）¥{amount / 100:.2f}')
+    lines.append('开票人:系统')
+    for line in lines:
+        c.drawString(50, y, line)
+        y -= 20
+    c.save()
+
+
+def generate_railway_invoice(path, invoice_number, invoice_date, amount, departure, arrival, passenger):
+    """
+    生成铁路电子客票（电子发票）
+
+    Args:
+        path: 输出路径
+        invoice_number: 20位发票号码
+        invoice_date: 开票日期（date）
+        amount: 票价（分）
+        departure: 出发站
+        arrival: 到达站
+        passenger: 乘车人
+    """
+    _register_font()
+    c = canvas.Canvas(path, pagesize=A4)
+    width, height = A4
+    c.setFont(FONT_NAME, 16)
+    c.drawCentredString(width / 2, height - 60, '电子发票（铁路电子客票）')
+    c.setFont(FONT_NAME, 10)
+    y = height - 100
+    lines = [
+        f'发票号码:{invoice_number} 天津市税务局 开票日期:{_cn_date(invoice_date)}',
+        f'{departure}站 G{invoice_number[-4:]} {arrival}站',
+        f'{_cn_date(invoice_date)} 08:00开 05车12A号 二等座',
+        f'￥{amount / 100:.2f}',
+        f'{passenger} 1201011990****0011',
+        f'电子客票号:{invoice_number[-14:]}',
+        f'购买方名称:{BUYER} 统一社会信用代码:{BUYER_TAX_ID}',
+    ]
+    for line in lines:
+        c.drawString(50, y, line)
+        y -= 20
+    c.save()
+
+
+def generate_corpus(directory, count=50, railway_ratio=0.2, seed=0):
+    """
+    生成一批合成发票
+
+    Args:
+        directory: 输出目录
+        count: 文件数
+        railway_ratio: 铁路电子客票所占比例
+        seed: 随机种子（相同参数生成相同语料）
+
+    Returns:
+        list: [(PDF路径, 期望提取结果), ...]，期望结果与 extract_pdf_invoices 返回的发票信息一致（不含页码和页面文本）
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    corpus = []
+    start = date(2025, 1, 1)
+    for index in range(count):
+        invoice_date = start + timedelta(days=rng.randrange(365))
+        number = f'{25000000000000000000 + seed * 1000000 + index}'
+        path = os.path.join(directory, f'invoice_{index:05d}.pdf')
+        if rng.random() < railway_ratio:
+            amount = rng.randrange(2000, 60000, 50)
+            departure, arrival = rng.sample(STATIONS, 2)
+            generate_railway_invoice(path, number, invoice_date, amount, departure, arrival, '张三')
+            issuer = '中国铁路总公司'
+            extra = {'公司名称': BUYER}  # get_huochepiao 会保留购买方名称
+        else:
+            amount = rng.randrange(500, 500000)
+            issuer = rng.choice(SELLERS)
+            generate_vat_invoice(path, number, invoice_date, issuer, amount, rng.sample(ITEMS, rng.randint(1, 4)))
+            extra = {}
+        corpus.append((path, {
+            '发票号码': number,
+            '开票日期': invoice_date.strftime('%Y-%m-%d'),
+            '开票方': issuer,
+            '价税合计': amount,
+            '购买方主体': BUYER_ENTITY,
+            **extra,
+        }))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成发票PDF')
+    parser.add_argument('directory', help='输出目录')
+    parser.add_argument('--count', type=int, default=50, help='文件数')
+    parser.add_argument('--railway-ratio', type=float, default=0.2, help='铁路电子客票比例')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    args = parser.parse_args()
+    corpus = generate_corpus(args.directory, args.count, args.railway_ratio, args.seed)
+    print(f'已生成 {len(corpus)} 个PDF：{args.directory}')
+
+
+if __name__ == '__main__':
+    main()
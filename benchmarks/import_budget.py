@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+冷启动导入耗时预算
+在新的解释器中用 -X importtime 执行 create_app()，统计导入耗时，
+超过预算或导入了不应在启动时加载的重量级模块（PDF解析、报销单生成）时返回非零退出码
+
+用法：
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --budget-ms 800 --runs 5 --json
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 启动时执行的语句
+STARTUP_STATEMENT = 'from app import create_app; create_app()'
+
+# 默认预算（毫秒，取多次运行的最小值比较）
+DEFAULT_BUDGET_MS = 800
+
+# 只应在解析PDF或生成报销单时才导入的模块
+LAZY_MODULES = ['pdfplumber', 'pdfminer', 'reportlab', 'PyPDF2', 'fitz', 'pymupdf', 'PIL', 'pdf_generator']
+
+_LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure(statement=STARTUP_STATEMENT):
+    """
+    执行一次并解析 -X importtime 输出
+
+    Returns:
+        dict: total_ms（顶层模块累计耗时之和）、modules（顶层模块 -> 累计毫秒）、imported（全部模块名）
+    """
+    env = dict(os.environ)
+    # 使用临时数据库，避免在工作目录创建文件
+    env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.gettempdir(), 'import_budget.db')}")
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+
+    modules = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if not match:
+            continue
+        cumulative_us, indent, name = int(match.group(2)), match.group(3), match.group(4)
+        imported.add(name)
+        if len(indent) == 1:
+            modules[name] = cumulative_us / 1000
+    return {
+        'total_ms': round(sum(modules.values()), 1),
+        'modules': modules,
+        'imported': imported,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='冷启动导入耗时预算检查')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS, help='导入耗时预算（毫秒）')
+    parser.add_argument('--runs', type=int, default=3, help='运行次数（取最小值）')
+    parser.add_argument('--top', type=int, default=10, help='显示耗时最多的顶层模块数')
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    best = min(runs, key=lambda run: run['total_ms'])
+    lazy_loaded = sorted(
+        name for name in best['imported']
+        if any(name == module or name.startswith(module + '.') for module in LAZY_MODULES)
+    )
+    top = sorted(best['modules'].items(), key=lambda item: -item[1])[:args.top]
+    report = {
+        'statement': STARTUP_STATEMENT,
+        'total_ms': best['total_ms'],
+        'runs_ms': [run['total_ms'] for run in runs],
+        'budget_ms': args.budget_ms,
+        'top_modules': [{'module': name, 'cumulative_ms': round(ms, 1)} for name, ms in top],
+        'lazy_modules_loaded': lazy_loaded,
+        'passed': best['total_ms'] <= args.budget_ms and not lazy_loaded,
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"启动导入耗时 {report['total_ms']}ms（预算 {args.budget_ms}ms，各次 {report['runs_ms']}）")
+        for item in report['top_modules']:
+            print(f"  {item['cumulative_ms']:>8.1f}ms  {item['module']}")
+        if lazy_loaded:
+            print(f"启动时不应导入的模块：{', '.join(lazy_loaded[:20])}")
+        print('通过' if report['passed'] else '未通过')
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
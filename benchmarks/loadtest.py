@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+端到端压力测试：模拟月底报销高峰
+大量员工通过 /invoice/upload 上传发票，同时财务执行 /api/search 和 generate_pdf，
+按配置的比例并发回放，统计每个接口的吞吐量、p50/p99 延迟和错误率
+
+两种运行方式：
+    进程内测试客户端（默认）：
+        python -m benchmarks.loadtest --employees 200 --concurrency 32 --duration 30
+    本地 HTTP 服务器（经过真实的 socket 和 WSGI 服务器）：
+        python -m benchmarks.loadtest --http --employees 200 --concurrency 32
+
+--mix 指定各流程的比例，如 upload=85,search=12,report=3
+"""
+import argparse
+import http.cookiejar
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_MIX = 'upload=85,search=12,report=3'
+
+SEARCH_FILTERS = [
+    {},
+    {'issuer': '京东'},
+    {'date_from': '2025-06-01', 'date_to': '2025-06-30'},
+    {'reimbursement_types': ['差旅费', '住宿费']},
+    {'reimbursement_person': '员工1'},
+]
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HttpSession:
+    """基于 urllib 的会话（保存 Cookie，不跟随重定向）"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def _open(self, path, data=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=300) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def get(self, path):
+        return self._open(path)
+
+    def post_form(self, path, fields):
+        return self._open(path, urllib.parse.urlencode(fields).encode('utf-8'),
+                          {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def post_json(self, path, payload):
+        return self._open(path, json.dumps(payload).encode('utf-8'), {'Content-Type': 'application/json'})
+
+    def post_file(self, path, fields, file_field, filename, content):
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for name, value in fields.items():
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                   f'filename="{filename}"\r\nContent-Type: application/pdf\r\n\r\n'.encode('utf-8'))
+        body.write(content)
+        body.write(f'\r\n--{boundary}--\r\n'.encode('utf-8'))
+        return self._open(path, body.getvalue(), {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+
+class TestClientSession:
+    """Flask 测试客户端会话，接口与 HttpSession 相同"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data()
+
+    def post_form(self, path, fields):
+        response = self.client.post(path, data=fields)
+        return response.status_code, response.get_data()
+
+    def post_json(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, response.get_data()
+
+    def post_file(self, path, fields, file_field, filename, content):
+        data = dict(fields)
+        data[file_field] = (io.BytesIO(content), filename)
+        response = self.client.post(path, data=data, content_type='multipart/form-data')
+        return response.status_code, response.get_data()
+
+
+def _is_success(status, body):
+    """2xx 且 JSON 响应中 success 不为 false"""
+    if not 200 <= status < 300:
+        return False
+    if body[:1] == b'{':
+        try:
+            return json.loads(body).get('success', True) is not False
+        except ValueError:
+            return False
+    return True
+
+
+class Recorder:
+    """按流程记录延迟和结果"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, flow, elapsed, status, ok):
+        with self.lock:
+            self.latencies.setdefault(flow, []).append(elapsed)
+            errors = self.errors.setdefault(flow, {})
+            if not ok:
+                errors[status] = errors.get(status, 0) + 1
+
+    def report(self, duration):
+        flows = {}
+        for flow, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            failed = sum(self.errors.get(flow, {}).values())
+
+            def percentile(p):
+                return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1)
+
+            flows[flow] = {
+                'requests': len(ordered),
+                'throughput_rps': round(len(ordered) / duration, 2),
+                'p50_ms': percentile(0.50),
+                'p99_ms': percentile(0.99),
+                'max_ms': round(ordered[-1] * 1000, 1),
+                'error_rate': round(failed / len(ordered), 4),
+                'errors': {str(code): count for code, count in self.errors.get(flow, {}).items()},
+            }
+        total = sum(len(samples) for samples in self.latencies.values())
+        return {
+            'duration_s': round(duration, 2),
+            'requests': total,
+            'throughput_rps': round(total / duration, 2),
+            'flows': flows,
+        }
+
+
+class InvoiceFactory:
+    """按需生成发票号码唯一的增值税发票PDF（内存中）"""
+
+    def __init__(self, seed):
+        self.counter = itertools.count(1)
+        # 每次压测都使用新的临时数据库，只需保证本次内唯一
+        self.prefix = 27000000000000000000 + seed * 10 ** 9
+        self.lock = threading.Lock()
+
+    def make(self):
+        from benchmarks.corpus import generate_vat_invoice, SELLERS, ITEMS
+
+        with self.lock:
+            n = next(self.counter)
+        rng = random.Random(n)
+        buffer = io.BytesIO()
+        generate_vat_invoice(buffer, str(self.prefix + n), date(2025, 1 + n % 12, 1 + n % 28),
+                             rng.choice(SELLERS), rng.randrange(500, 200000), rng.sample(ITEMS, 2))
+        return f'load_{n}.pdf', buffer.getvalue()
+
+
+def parse_mix(text):
+    """'upload=85,search=12,report=3' -> {'upload': 85.0, ...}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in FLOWS:
+            raise argparse.ArgumentTypeError(f'未知流程：{name}，可选 {", ".join(FLOWS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def flow_upload(actor, state):
+    filename, content = state['factory'].make()
+    return actor['session'].post_file('/invoice/upload', {'application_id': actor['application_id']},
+                                      'file', filename, content)
+
+
+def flow_search(actor, state):
+    return actor['session'].post_json('/api/search', random.choice(SEARCH_FILTERS))
+
+
+def flow_report(actor, state):
+    return actor['session'].get(f"/application/{random.choice(state['report_app_ids'])}/generate_pdf")
+
+
+# 流程名 -> (执行函数, 执行角色)
+FLOWS = {
+    'upload': (flow_upload, 'employee'),
+    'search': (flow_search, 'finance'),
+    'report': (flow_report, 'finance'),
+}
+
+
+def prepare_app(workdir, args):
+    """创建临时数据库和种子数据，返回 (app, {登录名: 申请ID}, 报销单候选申请ID)"""
+    from app import create_app
+    from models import db
+    from benchmarks.corpus import generate_corpus
+    from benchmarks.seed import seed_database
+
+    upload_folder = os.path.join(workdir, 'uploads')
+    for sub in ('invoices', 'receipts', 'reports'):
+        os.makedirs(os.path.join(upload_folder, sub), exist_ok=True)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'load.db')}",
+        'UPLOAD_FOLDER': upload_folder,
+        'SLOW_REQUEST_SECONDS': None,
+    })
+
+    with app.app_context():
+        db.create_all()
+        corpus = generate_corpus(os.path.join(workdir, 'corpus'), 20, seed=args.seed)
+        seed_database(args.employees, 1, args.details, corpus=corpus, upload_folder=upload_folder,
+                      seed=args.seed, statuses=['未提交'])
+        app_ids, report_app_ids = _application_map()
+        db.session.remove()
+    return app, app_ids, report_app_ids
+
+
+def _application_map():
+    """每个员工的第一个申请，以及有发票的申请（用于生成报销单）"""
+    from sqlalchemy import select, func
+    from models import db, User, InvoiceApplication
+
+    rows = db.session.execute(
+        select(User.login, func.min(InvoiceApplication.id))
+        .join(InvoiceApplication, InvoiceApplication.user_id == User.id)
+        .where(User.role == '普通用户', InvoiceApplication.is_paid.is_(False))
+        .group_by(User.login)
+    ).all()
+    report_app_ids = db.session.scalars(
+        select(InvoiceApplication.id).where(InvoiceApplication.invoice_count > 0).limit(50)
+    ).all()
+    return dict(rows), report_app_ids
+
+
+def login_actors(make_session, app_ids, finance_count, workers):
+    """并行登录员工和财务账户（密码校验较慢）"""
+    from benchmarks.seed import PASSWORD
+
+    def login(login_name):
+        session = make_session()
+        status, _ = session.post_form('/login', {'login': login_name, 'password': PASSWORD})
+        if status != 302:
+            raise RuntimeError(f'登录失败：{login_name}（{status}）')
+        return session
+
+    employees = sorted(app_ids)
+    finance = ['finance'] * finance_count
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        sessions = list(pool.map(login, employees + finance))
+    actors = {
+        'employee': [{'session': s, 'application_id': app_ids[name]}
+                     for name, s in zip(employees, sessions)],
+        'finance': [{'session': s} for s in sessions[len(employees):]],
+    }
+    return actors
+
+
+def run_load(actors, mix, state, concurrency, duration, max_requests=None):
+    """并发回放流程，返回 Recorder 和实际持续时间"""
+    recorder = Recorder()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    issued = itertools.count()
+    deadline = time.monotonic() + duration
+
+    def worker(worker_id):
+        rng = random.Random(worker_id)
+        while time.monotonic() < deadline:
+            if max_requests is not None and next(issued) >= max_requests:
+                return
+            flow = rng.choices(names, weights)[0]
+            func, role = FLOWS[flow]
+            actor = rng.choice(actors[role])
+            start = time.perf_counter()
+            try:
+                status, body = func(actor, state)
+                ok = _is_success(status, body)
+            except Exception as e:
+                status, ok = type(e).__name__, False
+            recorder.record(flow, time.perf_counter() - start, status, ok)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='发票报销系统端到端压力测试')
+    parser.add_argument('--employees', type=int, default=200, help='模拟员工数')
+    parser.add_argument('--finance', type=int, default=5, help='模拟财务会话数')
+    parser.add_argument('--details', type=int, default=10, help='每个员工申请中预置的发票数')
+    parser.add_argument('--concurrency', type=int, default=32, help='并发线程数')
+    parser.add_argument('--duration', type=float, default=30, help='持续时间（秒）')
+    parser.add_argument('--requests', type=int, help='最多发出的请求数（达到后提前结束）')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help='流程比例')
+    parser.add_argument('--http', action='store_true', help='启动本地 HTTP 服务器，经过 socket 压测')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='invoice_load_')
+    server = None
+    try:
+        app, app_ids, report_app_ids = prepare_app(workdir, args)
+        base_url = None
+        if args.http:
+            from werkzeug.serving import make_server, WSGIRequestHandler
+
+            class QuietHandler(WSGIRequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+
+            server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_port}'
+
+        if base_url:
+            make_session = lambda: HttpSession(base_url)
+        else:
+            make_session = lambda: TestClientSession(app)
+
+        if not app_ids:
+            raise SystemExit('没有可上传的员工申请，请检查种子数据')
+        login_start = time.perf_counter()
+        actors = login_actors(make_session, app_ids, args.finance, args.concurrency)
+        login_seconds = time.perf_counter() - login_start
+
+        state = {'factory': InvoiceFactory(args.seed), 'report_app_ids': report_app_ids or list(app_ids.values())}
+        recorder, elapsed = run_load(actors, args.mix, state, args.concurrency, args.duration, args.requests)
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = recorder.report(elapsed)
+    report.update({
+        'mode': 'http' if args.http else 'test_client',
+        'employees': len(actors['employee']),
+        'finance_sessions': len(actors['finance']),
+        'concurrency': args.concurrency,
+        'mix': args.mix,
+        'login_seconds': round(login_seconds, 2),
+    })
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"模式 {report['mode']}，员工 {report['employees']}，并发 {args.concurrency}，"
+          f"持续 {report['duration_s']}s，共 {report['requests']} 个请求，{report['throughput_rps']} req/s")
+    print(f"{'流程':<8}{'请求数':>8}{'req/s':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'错误率':>10}  错误")
+    for flow, stats in report['flows'].items():
+        print(f"{flow:<8}{stats['requests']:>8}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['error_rate']:>10.2%}  {stats['errors'] or ''}")
+
+
+if __name__ == '__main__':
+    main()
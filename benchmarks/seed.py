@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试数据库种子数据
+按指定数量批量生成用户、申请和发票明细，发票文件循环引用合成语料中的PDF
+"""
+import os
+import random
+import shutil
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from werkzeug.security import generate_password_hash
+
+from models import db, User, InvoiceApplication, InvoiceDetail
+from invoice_ops import refresh_application_totals
+from issuers import normalize_issuer
+from rollups import rebuild_rollups
+from benchmarks.corpus import SELLERS
+
+PASSWORD = 'bench'
+STATUSES = ['未提交', '已提交', '已提交', '已报销']
+
+
+def seed_database(users=20, applications=5, details=20, corpus=None, upload_folder=None, seed=0, statuses=None):
+    """
+    批量生成种子数据（需在应用上下文中调用，数据库表已创建）
+
+    Args:
+        users: 普通用户数（另外固定生成 admin 和 finance 两个账户）
+        applications: 每个用户的申请数
+        details: 每个申请的发票明细数
+        corpus: generate_corpus 的返回值，发票文件循环引用这些PDF
+        upload_folder: 上传文件夹，corpus 中的PDF会复制到其中的 invoices 目录
+        seed: 随机种子
+        statuses: 申请状态候选列表，默认随机混合各种状态
+
+    Returns:
+        dict: 各表生成的行数以及登录名列表
+    """
+    rng = random.Random(seed)
+    statuses = statuses or STATUSES
+    # 密码哈希很慢，所有账户共用一个
+    password_hash = generate_password_hash(PASSWORD)
+    accounts = [('admin', '管理员'), ('finance', '财务')]
+    accounts += [(f'user{i:04d}', '普通用户') for i in range(users)]
+    db.session.execute(User.__table__.insert(), [
+        {'login': login, 'name': login, 'password_hash': password_hash, 'role': role, 'created_at': datetime.now()}
+        for login, role in accounts
+    ])
+    user_ids = db.session.scalars(select(User.id).where(User.role == '普通用户').order_by(User.id)).all()
+
+    files = []
+    if corpus and upload_folder:
+        target_dir = os.path.join(upload_folder, 'invoices')
+        os.makedirs(target_dir, exist_ok=True)
+        for path, _ in corpus:
+            name = f'bench_{os.path.basename(path)}'
+            shutil.copyfile(path, os.path.join(target_dir, name))
+            files.append((f'/uploads/invoices/{name}', name))
+
+    now = datetime.now()
+    app_rows = []
+    for user_id in user_ids:
+        for index in range(applications):
+            status = rng.choice(statuses)
+            app_rows.append({
+                'sn': f'BENCH{user_id:05d}{index:04d}',
+                'name': f'基准申请{user_id}-{index}',
+                'reimbursement_person': f'员工{user_id}',
+                'status': status,
+                'is_paid': status == '已报销',
+                'user_id': user_id,
+                'invoice_count': 0,
+                'total_amount': 0,
+                'created_at': now - timedelta(minutes=len(app_rows)),
+            })
+    db.session.execute(InvoiceApplication.__table__.insert(), app_rows)
+    app_ids = db.session.scalars(
+        select(InvoiceApplication.id).where(InvoiceApplication.sn.like('BENCH%'))
+    ).all()
+
+    detail_rows = []
+    number = 0
+    for app_id in app_ids:
+        for _ in range(details):
+            number += 1
+            issuer = rng.choice(SELLERS)
+            file_url, filename = files[number % len(files)] if files else (None, None)
+            detail_rows.append({
+                'invoice_number': f'{26000000000000000000 + number}',
+                'invoice_date': (now - timedelta(days=rng.randrange(365))).date(),
+                'issuer': issuer,
+                'issuer_normalized': normalize_issuer(issuer),
+                'amount': rng.randrange(500, 200000),
+                'reimbursement_type': rng.choice(InvoiceDetail.REIMBURSEMENT_TYPES),
+                'file_url': file_url,
+                'filename': filename,
+                'application_id': app_id,
+                'created_at': now,
+            })
+            if len(detail_rows) >= 5000:
+                db.session.execute(InvoiceDetail.__table__.insert(), detail_rows)
+                detail_rows = []
+    if detail_rows:
+        db.session.execute(InvoiceDetail.__table__.insert(), detail_rows)
+
+    refresh_application_totals(app_ids)
+    db.session.commit()
+    rebuild_rollups()
+    return {
+        'users': len(accounts),
+        'applications': len(app_ids),
+        'details': number,
+        'logins': [login for login, _ in accounts],
+    }
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试套件：合成语料 + 种子数据库，测量关键路径耗时并输出 JSON，
+可与上一版本的结果比较，p50 变慢超过阈值时返回非零退出码
+
+测量项目：
+    extract_pdf_invoices      单个PDF提取（增值税发票 + 铁路电子客票），与上传相同的购买方主体自动机和页面进程池
+    api_search[...]           /api/search 的几种典型条件（财务账户）
+    dashboard[...]            /dashboard（财务账户、普通用户）
+    generate_reimbursement_pdf  生成报销单PDF
+
+用法：
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --details 50 --baseline bench.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEARCH_CASES = {
+    'all': {},
+    'issuer': {'issuer': '京东'},
+    'date_range': {'date_from': '2025-06-01', 'date_to': '2025-06-30'},
+    'types': {'reimbursement_types': ['差旅费', '住宿费']},
+}
+
+
+def _stats(samples):
+    """耗时样本（秒）转换为毫秒统计"""
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+    return {
+        'runs': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': round(percentile(0.50), 3),
+        'p95_ms': round(percentile(0.95), 3),
+        'min_ms': round(ordered[0] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def _timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _create_app(workdir):
+    from app import create_app
+    upload_folder = os.path.join(workdir, 'uploads')
+    for sub in ('invoices', 'receipts', 'reports'):
+        os.makedirs(os.path.join(upload_folder, sub), exist_ok=True)
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'UPLOAD_FOLDER': upload_folder,
+        'SLOW_REQUEST_SECONDS': None,
+        'TESTING': True,
+        # 只用 COMPANY_NAME_KEYWORD 一个主体，与语料的期望结果一致
+        'BUYER_ENTITIES_FILE': None,
+    })
+
+
+def bench_extract(app, corpus, repeat):
+    """按上传的方式逐个文件提取，返回 (统计, 识别出的发票与期望一致的比例)"""
+    from buyers import get_buyers
+    from readpdftxt import extract_pdf_invoices, page_executor, PAGE_KEYS
+
+    with app.app_context():
+        buyers = get_buyers()
+        executor = page_executor(app.config['PDF_PAGE_WORKERS'])
+    samples = []
+    correct = 0
+    for _ in range(repeat):
+        for path, expected in corpus:
+            start = time.perf_counter()
+            invoices = extract_pdf_invoices(path, buyers, executor=executor)
+            samples.append(time.perf_counter() - start)
+            # 每个语料文件一张发票，页码和页面文本不在期望结果中
+            correct += [{k: v for k, v in info.items() if k not in PAGE_KEYS} for info in invoices] == [expected]
+    return _stats(samples), round(correct / (len(corpus) * repeat), 4)
+
+
+def _login(app, login):
+    from benchmarks.seed import PASSWORD
+
+    client = app.test_client()
+    response = client.post('/login', data={'login': login, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'登录失败：{login}')
+    return client
+
+
+def bench_requests(app, repeat):
+    """/api/search 和 /dashboard"""
+    results = {}
+    finance = _login(app, 'finance')
+    employee = _login(app, 'user0000')
+
+    for name, filters in SEARCH_CASES.items():
+        def search():
+            response = finance.post('/api/search', json=filters)
+            assert response.status_code == 200, response.status_code
+        results[f'api_search[{name}]'] = _stats(_timed(search, repeat))
+
+    for name, client in (('finance', finance), ('employee', employee)):
+        def dashboard():
+            response = client.get('/dashboard')
+            assert response.status_code == 200, response.status_code
+        results[f'dashboard[{name}]'] = _stats(_timed(dashboard, repeat))
+    return results
+
+
+def bench_report(app, repeat):
+    """生成发票最多的申请的报销单"""
+    from models import db, InvoiceApplication
+    from pdf_generator import generate_reimbursement_pdf
+
+    with app.app_context():
+        application = (InvoiceApplication.query
+                       .order_by(InvoiceApplication.invoice_count.desc(), InvoiceApplication.id)
+                       .first())
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            pdf_path = generate_reimbursement_pdf(application, app.config['UPLOAD_FOLDER'])
+            samples.append(time.perf_counter() - start)
+            os.remove(pdf_path)
+        invoice_count = application.invoice_count
+        db.session.remove()
+    return _stats(samples), invoice_count
+
+
+def run_suite(args, workdir):
+    from benchmarks.corpus import generate_corpus
+    from benchmarks.seed import seed_database
+
+    corpus = generate_corpus(os.path.join(workdir, 'corpus'), args.corpus, args.railway_ratio, args.seed)
+    app = _create_app(workdir)
+    from models import db
+
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        seeded = seed_database(args.users, args.applications, args.details,
+                               corpus=corpus, upload_folder=app.config['UPLOAD_FOLDER'], seed=args.seed)
+        seed_seconds = time.perf_counter() - start
+        db.session.remove()
+
+    results = {}
+    results['extract_pdf_invoices'], accuracy = bench_extract(app, corpus, args.extract_repeat)
+    results.update(bench_requests(app, args.repeat))
+    results['generate_reimbursement_pdf'], report_invoices = bench_report(app, args.report_repeat)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': seeded['users'],
+            'applications': seeded['applications'],
+            'details': seeded['details'],
+            'corpus': len(corpus),
+            'seed_seconds': round(seed_seconds, 2),
+            'extract_accuracy': accuracy,
+            'report_invoices': report_invoices,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """返回 p50 变慢超过 tolerance（比例）的项目列表"""
+    regressions = []
+    for name, current in report['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous.get('p50_ms'):
+            continue
+        ratio = current['p50_ms'] / previous['p50_ms']
+        if ratio > 1 + tolerance:
+            regressions.append({
+                'name': name,
+                'baseline_p50_ms': previous['p50_ms'],
+                'p50_ms': current['p50_ms'],
+                'ratio': round(ratio, 2),
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='发票报销系统基准测试')
+    parser.add_argument('--users', type=int, default=20, help='普通用户数')
+    parser.add_argument('--applications', type=int, default=5, help='每个用户的申请数')
+    parser.add_argument('--details', type=int, default=20, help='每个申请的发票数')
+    parser.add_argument('--corpus', type=int, default=40, help='合成PDF数量')
+    parser.add_argument('--railway-ratio', type=float, default=0.2, help='铁路电子客票比例')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--repeat', type=int, default=20, help='每个请求的重复次数')
+    parser.add_argument('--extract-repeat', type=int, default=1, help='语料提取轮数')
+    parser.add_argument('--report-repeat', type=int, default=3, help='报销单生成次数')
+    parser.add_argument('--output', help='结果 JSON 输出文件（默认输出到标准输出）')
+    parser.add_argument('--baseline', help='上一版本的结果 JSON，用于检测性能回退')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='允许的 p50 变慢比例')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录（数据库和语料）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='invoice_bench_')
+    try:
+        report = run_suite(args, workdir)
+    finally:
+        if args.keep:
+            print(f'临时目录：{workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+        exit_code = 1 if report['regressions'] else 0
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    for item in report.get('regressions', []):
+        print(f"性能回退：{item['name']} p50 {item['baseline_p50_ms']}ms -> {item['p50_ms']}ms",
+              file=sys.stderr)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+购买方主体识别
+集团内的各个法人（名称、简称、统一社会信用代码）编译为一个 Aho-Corasick 自动机，
+每页文本扫描一次即可找出出现的全部主体，发票归属于文本中最先出现的主体（电子发票购买方信息在销售方之前）
+
+主体列表见 Config.BUYER_ENTITIES / BUYER_ENTITIES_FILE，未配置时只有 COMPANY_NAME_KEYWORD 一个主体
+"""
+import json
+from collections import deque
+
+from flask import current_app
+
+
+class BuyerMatcher:
+    """多模式匹配自动机（纯 Python，可被 pickle 传给进程池）"""
+
+    def __init__(self, entities):
+        """
+        Args:
+            entities: [{'name': 主体名称, 'tax_id': 统一社会信用代码, 'aliases': [简称, ...]}, ...]，
+                只有 name 是必需的
+        """
+        from readpdftxt import normalize_text
+
+        self.names = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]  # 每个状态结束的模式：((主体序号, 模式长度), ...)
+        for entity in entities:
+            index = len(self.names)
+            self.names.append(entity['name'])
+            patterns = [entity['name'], entity.get('tax_id')] + list(entity.get('aliases') or [])
+            for pattern in patterns:
+                if pattern:
+                    self._add(normalize_text(pattern), index)
+        self._build()
+
+    def _add(self, pattern, index):
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._out[state] += ((index, len(pattern)),)
+
+    def _build(self):
+        """按层计算失败指针，并合并失败指针指向状态的输出"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def finditer(self, text):
+        """扫描一次文本，逐个返回 (起始位置, 结束位置, 主体名称)，按结束位置排序"""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for pos, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for index, length in out[state]:
+                yield pos - length + 1, pos + 1, self.names[index]
+
+    def find(self, text):
+        """文本中出现的全部主体，按起始位置排序"""
+        return sorted(self.finditer(text))
+
+
+def load_buyer_entities(config):
+    """配置中的购买方主体列表（BUYER_ENTITIES_FILE 优先，其次 BUYER_ENTITIES，都没有时为 COMPANY_NAME_KEYWORD）"""
+    path = config.get('BUYER_ENTITIES_FILE')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return config.get('BUYER_ENTITIES') or [{'name': config['COMPANY_NAME_KEYWORD']}]
+
+
+def init_buyers(app):
+    app.extensions['buyers'] = BuyerMatcher(load_buyer_entities(app.config))
+
+
+def get_buyers():
+    """当前应用的购买方主体自动机（需在应用上下文中调用）"""
+    return current_app.extensions['buyers']
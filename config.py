@@ -10,14 +10,100 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///invoice_system.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # 数据库引擎配置（仅对 SQLite 生效）
+    # sqlite-wal：WAL 日志 + busy_timeout + 进程内单写入队列，适合多人同时上传
+    DB_ENGINE_PROFILE = os.environ.get('DB_ENGINE_PROFILE') or 'sqlite-wal'
+    DB_ENGINE_PROFILES = {
+        'sqlite-wal': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',  # WAL 模式下 NORMAL 已能保证数据库不损坏
+            'busy_timeout': 30000,  # 毫秒
+            'serialize_writes': True,
+            'write_retries': 5,
+            'write_retry_delay': 0.05,  # 秒，按重试次数指数退避
+        },
+        'default': {},
+    }
+    
     # 上传文件配置
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB
     ALLOWED_EXTENSIONS = {'pdf', 'jpg', 'jpeg', 'png'}
     
+    # 上传文件的发送方式：app 由应用发送；x-accel 交给 nginx（X-Accel-Redirect）；x-sendfile 交给 Apache/lighttpd
+    UPLOAD_SERVE_MODE = os.environ.get('UPLOAD_SERVE_MODE') or 'app'
+    UPLOAD_ACCEL_PREFIX = '/protected-uploads/'  # nginx 中 internal location 的路径
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600  # 秒，文件名带时间戳，内容不会变化
+    
+    # 发票预览图缓存（缩略图和报销单用的位图），按内容哈希命名，超过上限时淘汰最久未使用的
+    PREVIEW_CACHE_DIR = os.environ.get('PREVIEW_CACHE_DIR')  # 默认为 UPLOAD_FOLDER/previews
+    PREVIEW_CACHE_MAX_BYTES = 512 * 1024 * 1024
+    PREVIEW_THUMB_WIDTH = 240  # 像素
+    PREVIEW_PRINT_ZOOM = 2  # 相当于 144 DPI
+    
+    # 上传目录清理（flask cleanup-storage）：报销单保留时间；无引用的发票/回单文件在保存多久后才删除
+    REPORT_RETENTION_HOURS = 24
+    ORPHAN_GRACE_HOURS = 24
+    # 定时清理间隔（秒），0 表示不定时清理，只能手动执行命令
+    STORAGE_SWEEP_INTERVAL = int(os.environ.get('STORAGE_SWEEP_INTERVAL') or 0)
+    
+    # 已报销超过多少天的申请，其发票和回单归档到按月的归档文件（flask archive-settled）
+    ARCHIVE_AFTER_DAYS = 90
+    
+    # 上传文件存储后端：local（保存在 UPLOAD_FOLDER，默认）或 s3（S3 兼容的对象存储，需要安装 boto3）
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'local'
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = os.environ.get('S3_PREFIX') or ''
+    # MinIO 等非 AWS 服务的地址，如 http://127.0.0.1:9000
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    S3_REGION = os.environ.get('S3_REGION')
+    # 不设置时使用 boto3 的默认凭证（环境变量、~/.aws、实例角色）
+    S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+    S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+    # 下载文件时重定向到的预签名URL的有效期（秒）
+    S3_PRESIGN_EXPIRES = 300
+    
+    # 登录用户缓存（进程内，修改用户时失效）
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 300  # 秒
+    # 多进程部署时，其他进程修改的用户最多在此时间（秒）后失效
+    USER_CACHE_CHECK_SECONDS = 2
+    
+    # 开票方自动补全索引（每个进程一份）：超过此时间（秒）后在后台从数据库重建，同步其他进程新增的开票方
+    ISSUER_INDEX_MAX_AGE = 600
+    
+    # 生产部署（gunicorn.conf.py）：worker 进程数，0 表示 CPU 核数 * 2 + 1；每个进程的线程数
+    WEB_WORKERS = int(os.environ.get('WEB_WORKERS') or 0)
+    WEB_THREADS = int(os.environ.get('WEB_THREADS') or 4)
+    WEB_BIND = os.environ.get('WEB_BIND') or '0.0.0.0:5000'
+    
+    # 待处理队列实时推送（Server-Sent Events）：gthread 模式下每个连接占用一个线程，
+    # 每个进程最多保持 EVENT_STREAM_MAX 个连接（超过时客户端 30 秒后重连），单个连接最长 EVENT_STREAM_SECONDS 秒；
+    # 每 EVENT_POLL_INTERVAL 秒读取其他进程的事件，事件保留 EVENT_RETENTION_HOURS 小时
+    EVENT_STREAM_MAX = int(os.environ.get('EVENT_STREAM_MAX') or 2)
+    EVENT_STREAM_SECONDS = 300
+    EVENT_POLL_INTERVAL = 3
+    EVENT_RETENTION_HOURS = 24
+    
+    # 慢请求日志阈值（秒），超过时记录 SQL 明细；设为 0（或空字符串）表示不记录
+    SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0) or 0)
+    
+    # 慢文档日志阈值（毫秒），单个PDF提取超过时记录每页耗时
+    EXTRACTION_SLOW_MS = 2000
+    
+    # 多页PDF（一个文件多张发票）逐页并行提取的进程数（每个 worker 进程各一个进程池，第一次遇到多页文件时启动），
+    # 小于 2 时在请求线程中顺序提取
+    PDF_PAGE_WORKERS = int(os.environ.get('PDF_PAGE_WORKERS') or 2)
+    
     # 发票提取公司名称关键词（用于PDF提取）
     COMPANY_NAME_KEYWORD = '标度'
     
+    # 集团内的购买方主体（一次扫描识别多个法人的发票，报表可按主体汇总）：
+    # [{'name': '主体名称', 'tax_id': '统一社会信用代码', 'aliases': ['简称', ...]}, ...]
+    # BUYER_ENTITIES_FILE 为同样格式的 JSON 文件，优先使用；都未配置时只有 COMPANY_NAME_KEYWORD 一个主体
+    BUYER_ENTITIES = []
+    BUYER_ENTITIES_FILE = os.environ.get('BUYER_ENTITIES_FILE')
+    
     @staticmethod
     def init_app(app):
         # 确保上传文件夹存在
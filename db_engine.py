@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""数据库引擎配置
+SQLite 下多人同时上传容易出现 database is locked：
+- 连接时设置 WAL、busy_timeout 和 synchronous（见 Config.DB_ENGINE_PROFILES）
+- 进程内所有写事务经过同一把写锁串行执行
+- 热点写入路径通过 run_write 在遇到锁冲突时有限次重试
+另外提供 upgrade_schema，给已有数据库补上新增的列和索引
+"""
+import threading
+import time
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+from models import db, InvoiceDetail, SpendRollup
+from issuers import normalize_issuer
+
+# 当前生效的引擎配置
+_profile = {}
+
+# 进程内的单写入锁
+_write_lock = threading.RLock()
+
+
+def is_database_locked(error):
+    """判断是否为 SQLite 锁冲突"""
+    message = str(getattr(error, 'orig', error)).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def init_engine(app):
+    """根据 DB_ENGINE_PROFILE 配置数据库引擎，需在 db.init_app 之后调用"""
+    profile = app.config['DB_ENGINE_PROFILES'].get(app.config['DB_ENGINE_PROFILE'], {})
+    _profile.clear()
+    _profile.update(profile)
+
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+    if profile.get('serialize_writes'):
+        _install_write_serializer()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新连接设置 PRAGMA"""
+    cursor = dbapi_connection.cursor()
+    if _profile.get('busy_timeout'):
+        cursor.execute(f"PRAGMA busy_timeout = {int(_profile['busy_timeout'])}")
+    if _profile.get('journal_mode'):
+        cursor.execute(f"PRAGMA journal_mode = {_profile['journal_mode']}")
+    if _profile.get('synchronous'):
+        cursor.execute(f"PRAGMA synchronous = {_profile['synchronous']}")
+    cursor.close()
+
+
+_serializer_installed = False
+
+
+def _install_write_serializer():
+    """第一次 flush 时获取写锁，事务结束时释放"""
+    global _serializer_installed
+    if _serializer_installed:
+        return
+    _serializer_installed = True
+
+    @event.listens_for(db.session, 'before_flush')
+    def acquire_write_lock(session, flush_context, instances):
+        _acquire(session)
+
+    @event.listens_for(db.session, 'do_orm_execute')
+    def acquire_for_dml(orm_execute_state):
+        if not orm_execute_state.is_select:
+            _acquire(orm_execute_state.session)
+
+    @event.listens_for(db.session, 'after_transaction_end')
+    def release_write_lock(session, transaction):
+        if transaction.parent is None and session.info.pop('write_lock_held', False):
+            _write_lock.release()
+
+
+def _acquire(session):
+    if session.info.get('write_lock_held'):
+        return
+    # 超时后不再等待，交给 busy_timeout 处理，避免异常情况下死锁
+    timeout = _profile.get('busy_timeout', 30000) / 1000
+    if _write_lock.acquire(timeout=timeout):
+        session.info['write_lock_held'] = True
+
+
+def run_write(func, *args, **kwargs):
+    """
+    执行一个写事务函数，遇到 SQLite 锁冲突时回滚并按指数退避重试
+
+    func 内部负责修改数据并 commit，重试时会被完整地再执行一次
+    """
+    retries = _profile.get('write_retries', 0)
+    delay = _profile.get('write_retry_delay', 0.05)
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_database_locked(e) or attempt == retries:
+                raise
+            time.sleep(delay * (2 ** attempt))
+
+
+def upgrade_schema():
+    """
+    给已有数据库补上模型中新增的列和索引（db.create_all 只会创建缺失的表），
+    并回填新增列的数据。需在 db.create_all 之后、应用上下文中调用
+
+    Returns:
+        set: 新增的列（表名.列名）和索引名
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    added = set()
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                added.add(f'{table.name}.{column.name}')
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    added.add(index.name)
+
+    if 'invoice_details.issuer_normalized' in added:
+        _backfill_issuer_normalized()
+    if 'ix_invoice_details_duplicate_of_id' in added:
+        # 此前删除发票时没有清除疑似重复标记，升级时清理一次指向已删除发票的标记
+        _clear_dangling_duplicates()
+    if 'spend_rollups.buyer_entity' in added:
+        # 汇总键变了（唯一约束需要包含新列），重建空表，启动时由 ensure_rollups 重新生成
+        SpendRollup.__table__.drop(engine)
+        SpendRollup.__table__.create(engine)
+    return added
+
+
+def _clear_dangling_duplicates():
+    """清除指向已删除发票的疑似重复标记"""
+    details = InvoiceDetail.__table__
+    db.session.execute(
+        details.update()
+        .where(details.c.duplicate_of_id.is_not(None), details.c.duplicate_of_id.not_in(select(details.c.id)))
+        .values(duplicate_of_id=None)
+    )
+    db.session.commit()
+
+
+def _backfill_issuer_normalized(batch_size=1000):
+    """回填归一化开票方"""
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(InvoiceDetail.id, InvoiceDetail.issuer)
+            .where(InvoiceDetail.id > last_id)
+            .order_by(InvoiceDetail.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(
+            InvoiceDetail.__table__.update()
+            .where(InvoiceDetail.__table__.c.id == db.bindparam('detail_id'))
+            .values(issuer_normalized=db.bindparam('normalized')),
+            [{'detail_id': row.id, 'normalized': normalize_issuer(row.issuer)} for row in rows]
+        )
+        db.session.commit()
+        last_id = rows[-1].id
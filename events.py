@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+待处理队列的实时推送（Server-Sent Events）
+申请提交、标记报销、删除以及已提交的申请新增发票时，在同一事务中写入 application_events，
+财务和管理员的主页通过 /dashboard/events 保持一个空闲连接，收到消息后只更新对应的一行，不再刷新整页
+
+多进程部署时变化可能发生在其他 worker：每个进程一个推送线程，本进程提交后立即读取新事件，
+其他进程的事件每 EVENT_POLL_INTERVAL 秒读取一次（一条按主键的查询，与连接数无关，没有连接时不查询）；
+读到的消息保存在内存的环形缓冲区，各连接从中读取
+
+gthread 模式下每个连接占用一个线程：每个进程最多 EVENT_STREAM_MAX 个连接，单个连接最长 EVENT_STREAM_SECONDS 秒，
+超过上限或到期时关闭连接，浏览器（EventSource）按 retry 间隔自动重连并带上 Last-Event-ID 继续接收
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete, func
+
+from models import db, InvoiceApplication, ApplicationEvent
+
+logger = logging.getLogger(__name__)
+
+# 连接数超过上限时客户端的重连间隔（毫秒）
+BUSY_RETRY_MS = 30000
+# 正常断开（连接到期、服务重启）后的重连间隔（毫秒）
+RETRY_MS = 3000
+# 没有消息时发送注释行的间隔（秒），保持代理不断开连接，也用于发现已关闭的连接
+HEARTBEAT_SECONDS = 20
+# 每次读取的事件数
+BATCH_SIZE = 500
+
+
+def record_application_event(application_id, kind):
+    """
+    在当前事务中记录申请变化，事务提交后唤醒本进程的推送线程
+
+    Args:
+        application_id: 申请ID
+        kind: submitted（提交）、paid（标记已报销）、deleted（删除）、updated（已提交的申请新增发票）
+    """
+    db.session.add(ApplicationEvent(application_id=application_id, kind=kind))
+    db.session.info['application_events'] = True
+
+
+def _format(event_id, data):
+    return f"id: {event_id}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ApplicationFeed:
+    """进程内的事件缓冲区和推送线程"""
+
+    def __init__(self, poll_interval=3, buffer_size=1000, max_streams=2, stream_seconds=300, retention_hours=24):
+        self.poll_interval = poll_interval
+        self.max_streams = max_streams
+        self.stream_seconds = stream_seconds
+        self.retention_hours = retention_hours
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=buffer_size)  # (事件ID, 消息)
+        self._last_id = None  # 已读取的最大事件ID
+        self._floor = None  # 不在缓冲区中的最大事件ID（启动前的事件和被挤出缓冲区的事件）
+        self._streams = 0
+        self._woken = False
+        self._thread = None
+        self._app = None
+        self._pruned_at = 0
+
+    def latest_id(self):
+        """数据库中最新的事件ID（需在应用上下文中调用）"""
+        return db.session.scalar(select(func.max(ApplicationEvent.id))) or 0
+
+    def wake(self):
+        """有新事件提交，立即读取"""
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def _start(self, app):
+        """第一个连接时启动推送线程（需在应用上下文中调用；gunicorn 预加载时不会在 master 中启动）"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._app = app
+            self._last_id = self._floor = self.latest_id()
+            self._thread = threading.Thread(target=self._run, name='application-events', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._streams:
+                    self._cond.wait()
+                if not self._woken:
+                    self._cond.wait(self.poll_interval)
+                self._woken = False
+            try:
+                with self._app.app_context():
+                    self._poll()
+                    self._prune()
+                    db.session.remove()
+            except Exception:
+                logger.exception('读取申请事件失败')
+                time.sleep(self.poll_interval)
+
+    def _read(self, after, until=None):
+        """读取 after 之后（until 之前，含）的事件，转换为 (事件ID, 消息)"""
+        stmt = select(ApplicationEvent).where(ApplicationEvent.id > after)
+        if until is not None:
+            stmt = stmt.where(ApplicationEvent.id <= until)
+        rows = db.session.scalars(stmt.order_by(ApplicationEvent.id).limit(BATCH_SIZE)).all()
+        app_ids = {row.application_id for row in rows}
+        applications = {}
+        if app_ids:
+            applications = {
+                application.id: application
+                for application in InvoiceApplication.query.filter(InvoiceApplication.id.in_(app_ids))
+            }
+        messages = []
+        for row in rows:
+            # 发送申请的当前状态（同一申请的多个事件内容相同，客户端按最后一条更新）
+            application = applications.get(row.application_id)
+            messages.append((row.id, {
+                'kind': row.kind,
+                'application_id': row.application_id,
+                'application': application.to_dict() if application else None,
+            }))
+        return messages
+
+    def _poll(self):
+        messages = self._read(self._last_id)
+        if not messages:
+            return
+        with self._cond:
+            overflow = len(self._events) + len(messages) - self._events.maxlen
+            if overflow > 0:
+                self._floor = (list(self._events) + messages)[overflow - 1][0]
+            self._events.extend(messages)
+            self._last_id = messages[-1][0]
+            # 一次没有读完时不等待，继续读取
+            self._woken = len(messages) == BATCH_SIZE
+            self._cond.notify_all()
+
+    def _prune(self):
+        """每小时删除一次超过保留时间的事件（保留最新的一条，SQLite 的自增ID不会回退）"""
+        if time.monotonic() - self._pruned_at < 3600:
+            return
+        self._pruned_at = time.monotonic()
+        from db_engine import run_write
+
+        def prune():
+            cutoff = datetime.now() - timedelta(hours=self.retention_hours)
+            db.session.execute(
+                delete(ApplicationEvent).where(ApplicationEvent.created_at < cutoff, ApplicationEvent.id < self._last_id)
+            )
+            db.session.commit()
+
+        run_write(prune)
+
+    def backlog(self, app, after):
+        """
+        连接建立时，读取缓冲区之前的事件（需在应用上下文中调用）
+
+        Returns:
+            list: [(事件ID, 消息), ...]；相差太多（或事件已被清理）时为 None，客户端需要重新加载页面
+        """
+        self._start(app)
+        with self._cond:
+            floor = self._floor
+        if after >= floor:
+            return []
+        oldest = db.session.scalar(select(func.min(ApplicationEvent.id)))
+        if oldest is None or after < oldest - 1:
+            return None
+        messages = self._read(after, floor)
+        if len(messages) == BATCH_SIZE:
+            return None
+        return messages
+
+    def stream(self, after, backlog):
+        """
+        生成一个连接的 SSE 消息
+
+        Args:
+            after: 客户端已收到的最后一个事件ID
+            backlog: backlog() 的结果
+        """
+        with self._cond:
+            if self._streams >= self.max_streams:
+                yield f"retry: {BUSY_RETRY_MS}\n\n"
+                return
+            self._streams += 1
+            self._cond.notify_all()
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            if backlog is None:
+                yield _format(after, {'kind': 'reset'})
+                return
+            cursor = after
+            for event_id, message in backlog:
+                yield _format(event_id, message)
+                cursor = event_id
+
+            deadline = time.monotonic() + self.stream_seconds
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with self._cond:
+                    pending = [item for item in self._events if item[0] > cursor]
+                    if not pending:
+                        self._cond.wait(min(HEARTBEAT_SECONDS, remaining))
+                        pending = [item for item in self._events if item[0] > cursor]
+                    # 未发送的事件已被挤出缓冲区
+                    lost = self._floor > cursor
+                if lost:
+                    yield _format(cursor, {'kind': 'reset'})
+                    return
+                if not pending:
+                    yield ': keep-alive\n\n'
+                    continue
+                for event_id, message in pending:
+                    yield _format(event_id, message)
+                    cursor = event_id
+        finally:
+            with self._cond:
+                self._streams -= 1
+
+
+feed = ApplicationFeed()
+
+
+def _wake_after_commit(session):
+    if session.info.pop('application_events', None):
+        feed.wake()
+
+
+def _discard_after_rollback(session):
+    session.info.pop('application_events', None)
+
+
+def init_events(app):
+    """根据配置设置推送参数，并在事务提交后唤醒推送线程"""
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    feed.max_streams = app.config.get('EVENT_STREAM_MAX', 2)
+    feed.stream_seconds = app.config.get('EVENT_STREAM_SECONDS', 300)
+    feed.poll_interval = app.config.get('EVENT_POLL_INTERVAL', 3)
+    feed.retention_hours = app.config.get('EVENT_RETENTION_HOURS', 24)
+    if not event.contains(Session, 'after_commit', _wake_after_commit):
+        event.listen(Session, 'after_commit', _wake_after_commit)
+        event.listen(Session, 'after_rollback', _discard_after_rollback)
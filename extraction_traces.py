@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+PDF提取记录
+extract_pdf_info(..., trace=...) 写入的过程记录保存到 extraction_traces 表，
+超过 EXTRACTION_SLOW_MS 的文件额外写慢文档日志；管理员页面按 (解析分支, 开票方, 页数) 汇总，
+找出占用提取时间最多的发票类型
+"""
+import json
+import logging
+
+from sqlalchemy import select, func, case
+
+from models import db, ExtractionTrace
+
+logger = logging.getLogger('invoice.extraction')
+
+
+def trace_values(trace, info, filename=None, file_url=None, source='upload', user_id=None):
+    """
+    把提取过程记录转换为 extraction_traces 表的一行
+
+    Args:
+        trace: extract_pdf_info 写入的过程记录
+        info: extract_pdf_info 的返回值
+        filename: 原始文件名
+        file_url: 文件存储路径
+        source: 来源（upload / import）
+        user_id: 操作用户ID
+
+    Returns:
+        dict: 可直接用于 insert 的列值
+    """
+    return {
+        'filename': (filename or '')[:200],
+        'file_url': file_url,
+        'source': source,
+        'file_size': trace.get('file_size'),
+        'page_count': trace.get('page_count'),
+        'pages_read': len(trace.get('pages') or []),
+        'text_ms': trace.get('text_ms'),
+        'parse_ms': trace.get('parse_ms'),
+        'total_ms': trace.get('total_ms'),
+        'parser': trace.get('parser'),
+        'issuer': ((info or {}).get('开票方') or '')[:200] or None,
+        'fields': ','.join(trace.get('fields') or [])[:200],
+        'page_timings': json.dumps(trace.get('pages') or []),
+        'error': trace.get('error'),
+        'user_id': user_id,
+    }
+
+
+def log_slow_extraction(values, threshold_ms):
+    """提取耗时超过阈值时写慢文档日志"""
+    if threshold_ms is None or (values['total_ms'] or 0) < threshold_ms:
+        return
+    logger.warning(
+        '慢文档 %s 耗时=%.1fms（文本 %.1fms，解析 %.1fms）页数=%s/%s 分支=%s 字段=%s 每页=%s',
+        values['filename'], values['total_ms'] or 0, values['text_ms'] or 0, values['parse_ms'] or 0,
+        values['pages_read'], values['page_count'], values['parser'], values['fields'], values['page_timings'],
+    )
+
+
+def record_extraction_trace(trace, info, threshold_ms=None, **kwargs):
+    """
+    保存一条提取记录（加入当前会话，由调用方提交）
+
+    Args:
+        trace: extract_pdf_info 写入的过程记录
+        info: extract_pdf_info 的返回值
+        threshold_ms: 慢文档日志阈值（毫秒）
+        **kwargs: 传给 trace_values 的其他列
+    """
+    values = trace_values(trace, info, **kwargs)
+    log_slow_extraction(values, threshold_ms)
+    db.session.add(ExtractionTrace(**values))
+
+
+def summarize_traces(limit=50):
+    """
+    按 (解析分支, 开票方, 页数) 汇总提取耗时，按总耗时倒序
+
+    Returns:
+        list: 每行包含 parser, issuer, page_count, count, failed, total_ms, avg_ms, max_ms
+    """
+    failed = func.sum(case((ExtractionTrace.fields.notlike('%发票号码%'), 1), else_=0))
+    stmt = (
+        select(
+            ExtractionTrace.parser,
+            ExtractionTrace.issuer,
+            ExtractionTrace.page_count,
+            func.count(ExtractionTrace.id).label('count'),
+            failed.label('failed'),
+            func.sum(ExtractionTrace.total_ms).label('total_ms'),
+            func.avg(ExtractionTrace.total_ms).label('avg_ms'),
+            func.max(ExtractionTrace.total_ms).label('max_ms'),
+        )
+        .group_by(ExtractionTrace.parser, ExtractionTrace.issuer, ExtractionTrace.page_count)
+        .order_by(func.sum(ExtractionTrace.total_ms).desc())
+        .limit(limit)
+    )
+    return db.session.execute(stmt).all()
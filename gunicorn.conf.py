@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 配置：多进程 + 每进程多线程（gthread）
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+进程数、线程数和监听地址见 config.py 的 WEB_WORKERS / WEB_THREADS / WEB_BIND（可用同名环境变量设置）
+"""
+import multiprocessing
+
+from config import Config
+
+bind = Config.WEB_BIND
+workers = Config.WEB_WORKERS or multiprocessing.cpu_count() * 2 + 1
+worker_class = 'gthread'
+threads = Config.WEB_THREADS
+# 上传和生成报销单可能较慢
+timeout = 120
+# 在 master 中导入 wsgi 模块完成预热，worker 通过 fork 共享
+preload_app = True
+
+
+def post_fork(server, worker):
+    """fork 之后丢弃从 master 继承的数据库连接，每个 worker 使用自己的连接池；启动定时清理线程"""
+    from wsgi import application
+    from models import db
+    from lifecycle import start_scheduler
+    with application.app_context():
+        db.engine.dispose(close=False)
+    start_scheduler(application)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+历史发票批量导入
+遍历目录树，每个包含PDF的目录作为一个申请；多进程提取发票信息，按批次 executemany 插入，
+每批提交后写入日志（journal），中断后再次执行会跳过日志中已处理的文件
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import select
+
+from models import db, InvoiceApplication, InvoiceDetail, InvoiceText, ExtractionTrace
+from invoice_ops import refresh_application_totals, dialect_insert, find_near_duplicate
+from issuers import normalize_issuer, note_issuer
+from readpdftxt import extract_pdf_invoices, PAGE_KEYS
+from rollups import track_rollups
+from storage import get_storage
+from extraction_traces import trace_values, log_slow_extraction
+from text_layer import text_layer_row
+
+JOURNAL_NAME = '.import_journal.jsonl'
+
+
+def _extract(args):
+    """进程池任务：提取单个PDF中的全部发票（进程池已按文件并行，文件内逐页顺序提取）"""
+    path, company_name = args
+    trace = {}
+    invoices = extract_pdf_invoices(path, company_name, trace=trace)
+    return path, invoices, trace
+
+
+def scan_directory(root):
+    """返回 {相对目录: [PDF绝对路径, ...]}，按路径排序"""
+    groups = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        pdfs = sorted(name for name in filenames if name.lower().endswith('.pdf'))
+        if pdfs:
+            rel_dir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            groups[rel_dir] = [os.path.join(dirpath, name) for name in pdfs]
+    return groups
+
+
+class ImportJournal:
+    """导入日志：每行一个JSON，记录已处理的文件和目录对应的申请"""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.applications = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 中断时可能写了半行
+                        continue
+                    if 'file' in entry:
+                        self.files[entry['file']] = entry
+                    elif 'dir' in entry:
+                        self.applications[entry['dir']] = entry['application_id']
+
+    def append(self, entries):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        for entry in entries:
+            if 'file' in entry:
+                self.files[entry['file']] = entry
+            elif 'dir' in entry:
+                self.applications[entry['dir']] = entry['application_id']
+
+
+def _get_or_create_application(journal, rel_dir, user, person, status):
+    app_id = journal.applications.get(rel_dir)
+    if app_id and db.session.get(InvoiceApplication, app_id):
+        return app_id
+
+    digest = hashlib.sha1(f'{user.id}:{rel_dir}'.encode('utf-8')).hexdigest()[:12]
+    sn = f'IMP{digest}'
+    application = InvoiceApplication.query.filter_by(sn=sn).first()
+    if application is None:
+        name = os.path.basename(rel_dir) if rel_dir != '.' else '历史导入'
+        application = InvoiceApplication(
+            sn=sn,
+            name=name,
+            reimbursement_person=person or user.name,
+            is_paid=status == '已报销',
+            status=status,
+            remarks=f'批量导入：{rel_dir}',
+            user_id=user.id,
+        )
+        db.session.add(application)
+        db.session.commit()
+    journal.append([{'dir': rel_dir, 'application_id': application.id}])
+    return application.id
+
+
+def _store_file(path):
+    """复制文件到存储后端，返回 (file_url, 原始文件名)"""
+    filename = os.path.basename(path).replace('/', '').replace('\\', '')
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    unique_filename = f'imp_{digest}_{filename}'
+    key = f'invoices/{unique_filename}'
+    storage = get_storage()
+    if not storage.exists(key):
+        storage.put_file(key, path)
+    return f'/uploads/invoices/{unique_filename}', filename
+
+
+def _flush_batch(batch, journal, root, user_id=None, slow_ms=None):
+    """
+    插入一批提取结果和提取记录并写日志
+
+    Args:
+        batch: [(path, application_id, invoices, trace), ...]，invoices 为 extract_pdf_invoices 的结果
+
+    Returns:
+        dict: imported、duplicate 为发票数，failed 为文件数
+    """
+    counts = {'imported': 0, 'duplicate': 0, 'failed': 0}
+    entries = []
+    rows = []
+    traces = []
+    texts = {}
+    seen = set()
+
+    numbers = [info['发票号码'] for _, _, invoices, _ in batch for info in invoices if '发票号码' in info]
+    existing = set()
+    if numbers:
+        existing = set(db.session.scalars(
+            select(InvoiceDetail.invoice_number).where(InvoiceDetail.invoice_number.in_(numbers))
+        ))
+
+    for path, app_id, invoices, trace in batch:
+        rel_path = os.path.relpath(path, root).replace(os.sep, '/')
+        first = {k: v for k, v in invoices[0].items() if k not in PAGE_KEYS} if invoices else {}
+        values = trace_values(trace, first, filename=rel_path, source='import', user_id=user_id)
+        log_slow_extraction(values, slow_ms)
+        traces.append(values)
+        invoices = [info for info in invoices if '发票号码' in info]
+        if not invoices:
+            counts['failed'] += 1
+            entries.append({'file': rel_path, 'status': 'failed'})
+            continue
+
+        # 一个文件多张发票时各明细共用同一个文件
+        stored = None
+        imported = []
+        for info in invoices:
+            number = info['发票号码']
+            if number in existing or number in seen:
+                counts['duplicate'] += 1
+                continue
+            seen.add(number)
+
+            invoice_date = None
+            if '开票日期' in info:
+                try:
+                    invoice_date = datetime.strptime(info['开票日期'], '%Y-%m-%d').date()
+                except ValueError:
+                    pass
+            amount = info.get('价税合计', 0)
+            if not isinstance(amount, int):
+                amount = 0
+            issuer_normalized = normalize_issuer(info.get('开票方', ''))
+            if stored is None:
+                stored = _store_file(path)
+            file_url, filename = stored
+            rows.append({
+                'invoice_number': number,
+                'invoice_date': invoice_date,
+                'issuer': info.get('开票方', ''),
+                'issuer_normalized': issuer_normalized,
+                'duplicate_of_id': find_near_duplicate(issuer_normalized, amount, invoice_date),
+                'amount': amount,
+                'file_url': file_url,
+                'filename': filename,
+                'application_id': app_id,
+                'created_at': datetime.now(),
+                'page_start': info['起始页'],
+                'page_end': info['结束页'],
+                'buyer_entity': info.get('购买方主体'),
+            })
+            texts[number] = (file_url, info)
+            counts['imported'] += 1
+            imported.append(number)
+
+        entry = {'file': rel_path, 'status': 'imported' if imported else 'duplicate',
+                 'invoice_number': (imported or [invoices[0]['发票号码']])[0]}
+        if len(invoices) > 1:
+            entry['invoice_numbers'] = [info['发票号码'] for info in invoices]
+        entries.append(entry)
+
+    if rows:
+        app_ids = {row['application_id'] for row in rows}
+        stmt = dialect_insert(InvoiceDetail)
+        if stmt is not None:
+            # 与网页上传并发时，已存在的发票号码直接跳过
+            stmt = stmt.on_conflict_do_nothing(index_elements=['invoice_number'])
+        else:
+            stmt = InvoiceDetail.__table__.insert()
+        with track_rollups(app_ids=app_ids):
+            db.session.execute(stmt, rows)
+        refresh_application_totals(app_ids)
+
+        # 文本层：按发票号码取回插入的明细ID（跳过并发上传抢先插入的同号发票）
+        inserted = db.session.execute(
+            select(InvoiceDetail.id, InvoiceDetail.invoice_number, InvoiceDetail.file_url)
+            .where(InvoiceDetail.invoice_number.in_(list(texts)))
+        ).all()
+        inserted = [row for row in inserted if row.file_url == texts[row.invoice_number][0]]
+        text_rows = [text_layer_row(row.id, texts[row.invoice_number][1]) for row in inserted]
+        for row in inserted:
+            note_issuer(db.session, texts[row.invoice_number][1].get('开票方'))
+        text_rows = [row for row in text_rows if row]
+        if text_rows:
+            db.session.execute(InvoiceText.__table__.insert(), text_rows)
+    if traces:
+        db.session.execute(ExtractionTrace.__table__.insert(), traces)
+    db.session.commit()
+    journal.append(entries)
+    return counts
+
+
+def import_invoices(root, user, company_name, person=None, status='已报销',
+                    workers=None, batch_size=200, journal_path=None, progress=print, slow_ms=None):
+    """
+    导入目录树中的历史发票
+
+    Args:
+        root: 发票根目录
+        user: 申请的创建用户
+        company_name: 公司名称关键词或 buyers.BuyerMatcher（同 extract_pdf_invoices）
+        person: 报销人，默认为创建用户姓名
+        status: 导入后的申请状态
+        workers: 提取进程数
+        batch_size: 每批插入的发票数
+        journal_path: 日志文件路径，默认为 <root>/.import_journal.jsonl
+        progress: 进度输出函数
+        slow_ms: 慢文档日志阈值（毫秒）
+
+    Returns:
+        dict: imported、duplicate（发票数），failed、skipped（文件数）
+    """
+    root = os.path.abspath(root)
+    journal = ImportJournal(journal_path or os.path.join(root, JOURNAL_NAME))
+    groups = scan_directory(root)
+
+    tasks = []
+    for rel_dir, paths in groups.items():
+        pending = [p for p in paths if os.path.relpath(p, root).replace(os.sep, '/') not in journal.files]
+        if not pending:
+            continue
+        app_id = _get_or_create_application(journal, rel_dir, user, person, status)
+        tasks.extend((path, app_id) for path in pending)
+
+    total = sum(len(paths) for paths in groups.values())
+    counts = {'imported': 0, 'duplicate': 0, 'failed': 0, 'skipped': total - len(tasks)}
+    progress(f'共 {total} 个PDF，已处理 {counts["skipped"]} 个，待导入 {len(tasks)} 个')
+    if not tasks:
+        return counts
+
+    app_by_path = dict(tasks)
+    batch = []
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_extract, [(path, company_name) for path, _ in tasks], chunksize=8)
+        for path, invoices, trace in results:
+            batch.append((path, app_by_path[path], invoices, trace))
+            if len(batch) >= batch_size:
+                for key, value in _flush_batch(batch, journal, root, user.id, slow_ms).items():
+                    counts[key] += value
+                done += len(batch)
+                batch = []
+                progress(f'进度 {done}/{len(tasks)}')
+        if batch:
+            for key, value in _flush_batch(batch, journal, root, user.id, slow_ms).items():
+                counts[key] += value
+            done += len(batch)
+            progress(f'进度 {done}/{len(tasks)}')
+    return counts
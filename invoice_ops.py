@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""发票明细的集合式操作
+批量修改类型、批量删除、批量移动都用一条联表查询做权限检查，
+再用集合式 UPDATE/DELETE 语句完成修改，避免逐条加载明细（N+1 查询）
+新增发票使用 INSERT ... ON CONFLICT(invoice_number) 一条语句完成排重和插入，
+插入前用 (归一化开票方, 金额, 开票日期) 复合索引做一次近似重复查找
+"""
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, InvoiceApplication, InvoiceDetail, InvoiceText
+from rollups import apply_rollup_delta, track_rollups
+from issuers import normalize_issuer, note_issuer
+
+
+def load_bulk_targets(invoice_ids):
+    """
+    一次联表查询取出批量操作涉及的发票及其所属申请信息
+
+    Args:
+        invoice_ids: 发票明细ID列表
+
+    Returns:
+        list: 每行包含 id, application_id, user_id, is_paid, file_url, issuer
+    """
+    stmt = (
+        select(
+            InvoiceDetail.id,
+            InvoiceDetail.application_id,
+            InvoiceApplication.user_id,
+            InvoiceApplication.is_paid,
+            InvoiceDetail.file_url,
+            InvoiceDetail.issuer,
+        )
+        .join(InvoiceApplication, InvoiceDetail.application_id == InvoiceApplication.id)
+        .where(InvoiceDetail.id.in_(invoice_ids))
+    )
+    return db.session.execute(stmt).all()
+
+
+def refresh_application_totals(app_ids):
+    """用一条 UPDATE 语句重新计算多个申请的发票数量和总金额"""
+    app_ids = list(set(app_ids))
+    if not app_ids:
+        return
+    count_sq = (
+        select(func.count(InvoiceDetail.id))
+        .where(InvoiceDetail.application_id == InvoiceApplication.id)
+        .scalar_subquery()
+    )
+    amount_sq = (
+        select(func.coalesce(func.sum(InvoiceDetail.amount), 0))
+        .where(InvoiceDetail.application_id == InvoiceApplication.id)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        update(InvoiceApplication)
+        .where(InvoiceApplication.id.in_(app_ids))
+        .values(invoice_count=count_sq, total_amount=amount_sq)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def add_to_application_totals(app_id, count, amount):
+    """用一条 UPDATE 语句增量调整申请的发票数量和总金额"""
+    db.session.execute(
+        update(InvoiceApplication)
+        .where(InvoiceApplication.id == app_id)
+        .values(
+            invoice_count=func.coalesce(InvoiceApplication.invoice_count, 0) + count,
+            total_amount=func.coalesce(InvoiceApplication.total_amount, 0) + (amount or 0),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def dialect_insert(model):
+    """返回支持 ON CONFLICT 的方言 insert()，不支持的数据库返回 None"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert(model)
+
+
+def find_near_duplicate(issuer_normalized, amount, invoice_date, exclude_id=None):
+    """
+    查找开票方、金额、开票日期都相同的已有发票（走复合索引，一次查找）
+
+    Returns:
+        int: 已有发票ID，没有时返回 None
+    """
+    if not (issuer_normalized and amount and invoice_date):
+        return None
+    stmt = select(InvoiceDetail.id).where(
+        InvoiceDetail.issuer_normalized == issuer_normalized,
+        InvoiceDetail.amount == amount,
+        InvoiceDetail.invoice_date == invoice_date,
+    )
+    if exclude_id is not None:
+        stmt = stmt.where(InvoiceDetail.id != exclude_id)
+    return db.session.scalars(stmt.order_by(InvoiceDetail.id).limit(1)).first()
+
+
+def insert_invoice_detail(**values):
+    """
+    插入发票明细，发票号码已存在时不插入
+
+    SQLite/PostgreSQL 使用一条 INSERT ... ON CONFLICT(invoice_number) DO NOTHING RETURNING 语句，
+    其他数据库退化为 SAVEPOINT + 捕获唯一约束冲突。插入成功时同时增量更新申请统计
+
+    Returns:
+        tuple: (detail, inserted)，发票号码已存在时为 (None, False)；
+        疑似重复时 detail.duplicate_of_id 为已有发票ID
+    """
+    values['issuer_normalized'] = normalize_issuer(values.get('issuer'))
+    values['duplicate_of_id'] = find_near_duplicate(
+        values['issuer_normalized'], values.get('amount'), values.get('invoice_date')
+    )
+
+    stmt = dialect_insert(InvoiceDetail)
+    if stmt is not None:
+        stmt = (
+            stmt.values(**values)
+            .on_conflict_do_nothing(index_elements=['invoice_number'])
+            .returning(InvoiceDetail)
+        )
+        detail = db.session.scalars(stmt).first()
+    else:
+        detail = InvoiceDetail(**values)
+        try:
+            with db.session.begin_nested():
+                db.session.add(detail)
+        except IntegrityError:
+            detail = None
+
+    if detail is None:
+        return None, False
+    note_issuer(db.session, detail.issuer)
+
+    add_to_application_totals(detail.application_id, 1, detail.amount)
+    apply_rollup_delta(1, detail_ids=[detail.id])
+    return detail, True
+
+
+def update_invoice_file(invoice_number, file_url, filename, page_start=None, page_end=None):
+    """更新已存在发票的文件（重复上传时使用）"""
+    db.session.execute(
+        update(InvoiceDetail)
+        .where(InvoiceDetail.invoice_number == invoice_number)
+        .values(file_url=file_url, filename=filename, page_start=page_start, page_end=page_end)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def bulk_retype(invoice_ids, reimbursement_type):
+    """批量修改报销类型，返回更新行数"""
+    with track_rollups(detail_ids=invoice_ids):
+        result = db.session.execute(
+            update(InvoiceDetail)
+            .where(InvoiceDetail.id.in_(invoice_ids))
+            .values(reimbursement_type=reimbursement_type)
+            .execution_options(synchronize_session=False)
+        )
+    return result.rowcount
+
+
+def bulk_delete(targets):
+    """
+    批量删除发票明细并刷新所属申请的统计
+
+    Args:
+        targets: load_bulk_targets 返回的行
+
+    Returns:
+        int: 删除行数
+    """
+    invoice_ids = [row.id for row in targets]
+    with track_rollups(detail_ids=invoice_ids):
+        result = db.session.execute(
+            delete(InvoiceDetail)
+            .where(InvoiceDetail.id.in_(invoice_ids))
+            .execution_options(synchronize_session=False)
+        )
+    # 批量 DELETE 不触发 ORM 事件，文本层一并删除
+    db.session.execute(
+        delete(InvoiceText)
+        .where(InvoiceText.detail_id.in_(invoice_ids))
+        .execution_options(synchronize_session=False)
+    )
+    # 同样不会执行外键的 SET NULL，清除指向被删除发票的疑似重复标记
+    db.session.execute(
+        update(InvoiceDetail)
+        .where(InvoiceDetail.duplicate_of_id.in_(invoice_ids))
+        .values(duplicate_of_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    refresh_application_totals(row.application_id for row in targets)
+    for row in targets:
+        note_issuer(db.session, row.issuer, -1)
+    return result.rowcount
+
+
+def bulk_move(targets, target_app_id):
+    """
+    批量把发票明细移动到另一个申请，并刷新来源和目标申请的统计
+
+    Args:
+        targets: load_bulk_targets 返回的行
+        target_app_id: 目标申请ID
+
+    Returns:
+        int: 移动行数
+    """
+    invoice_ids = [row.id for row in targets]
+    with track_rollups(detail_ids=invoice_ids):
+        result = db.session.execute(
+            update(InvoiceDetail)
+            .where(InvoiceDetail.id.in_(invoice_ids))
+            .values(application_id=target_app_id)
+            .execution_options(synchronize_session=False)
+        )
+    affected = {row.application_id for row in targets}
+    affected.add(target_app_id)
+    refresh_application_totals(affected)
+    return result.rowcount
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""开票方名称处理：归一化（近似重复检测）和前缀索引（输入时自动补全）"""
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter
+
+# 归一化时去掉的字符：空白、标点、括号等
+_STRIP_CHARS = re.compile(r'[\s\-_.,，。、·•:：;；\'"“”‘’()（）\[\]【】<>《》]+')
+# 补全最多返回的候选数
+SUGGEST_LIMIT = 50
+# 匹配的名称超过此数量的前缀（通常只有一两个字）缓存排序结果
+_CACHE_THRESHOLD = 256
+
+
+def normalize_issuer(name):
+    """
+    开票方名称归一化，用于近似重复检测
+
+    全角转半角、去掉空白和标点、英文小写，
+    例如 "北京 某某（科技）有限公司" 和 "北京某某(科技)有限公司" 归一化后相同
+    """
+    if not name:
+        return ''
+    name = unicodedata.normalize('NFKC', name)
+    return _STRIP_CHARS.sub('', name).casefold()
+
+
+class IssuerIndex:
+    """
+    开票方前缀索引（进程内），用于输入开票方时的自动补全
+
+    归一化名称排序后保存在数组中，前缀查询用二分查找定位区间，不需要查询数据库；
+    每个归一化名称记录使用次数和最常用的写法，补全时按使用次数排序，
+    输入 "北京某某(科技)" 和 "北京某某（科技）" 得到同一个写法，避免同一开票方的多种写法分散在报表中
+    """
+
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._keys = []  # 排序的归一化名称
+        self._names = {}  # 归一化名称 -> Counter(写法 -> 次数)
+        self._totals = {}  # 归一化名称 -> 总次数
+        self._top = {}  # 前缀 -> 使用次数最多的 SUGGEST_LIMIT 个归一化名称（只缓存匹配很多的短前缀）
+        self._built_at = None
+        self._refreshing = False
+
+    def build(self, rows):
+        """
+        用全部开票方重建索引
+
+        Args:
+            rows: [(开票方, 次数), ...]
+        """
+        names = {}
+        for issuer, count in rows:
+            key = normalize_issuer(issuer)
+            if key:
+                names.setdefault(key, Counter())[issuer.strip()] += count
+        with self._lock:
+            self._names = names
+            self._totals = {key: sum(counter.values()) for key, counter in names.items()}
+            self._keys = sorted(names)
+            self._top = {}
+            self._built_at = time.monotonic()
+
+    def add(self, issuer, count=1):
+        """增加（count 为负数时减少）一个开票方的使用次数，减到 0 的写法和名称从索引中移除"""
+        key = normalize_issuer(issuer)
+        if not key:
+            return
+        name = issuer.strip()
+        with self._lock:
+            for i in range(1, len(key) + 1):
+                self._top.pop(key[:i], None)
+            counter = self._names.get(key)
+            if counter is None:
+                if count <= 0:
+                    return
+                counter = self._names[key] = Counter()
+                insort(self._keys, key)
+            counter[name] += count
+            if counter[name] <= 0:
+                del counter[name]
+            if counter:
+                self._totals[key] = sum(counter.values())
+            else:
+                del self._names[key]
+                self._totals.pop(key, None)
+                del self._keys[bisect_left(self._keys, key)]
+
+    @property
+    def built(self):
+        return self._built_at is not None
+
+    @property
+    def stale(self):
+        return self._built_at is None or time.monotonic() - self._built_at > self.max_age
+
+    def suggest(self, prefix, limit=10):
+        """
+        以 prefix 开头（归一化后比较）的开票方，按使用次数从多到少
+
+        Returns:
+            list: [(最常用的写法, 次数), ...]
+        """
+        key = normalize_issuer(prefix)
+        if not key:
+            return []
+        limit = min(max(limit, 1), SUGGEST_LIMIT)
+        with self._lock:
+            top = self._top.get(key)
+            if top is None:
+                start = bisect_left(self._keys, key)
+                # 归一化名称中不会出现 U+10FFFF，以 key 开头的名称都小于 key + '\U0010ffff'
+                end = bisect_left(self._keys, key + '\U0010ffff', start)
+                top = heapq.nlargest(SUGGEST_LIMIT, self._keys[start:end], key=self._totals.__getitem__)
+                if end - start > _CACHE_THRESHOLD:
+                    self._top[key] = top
+            top = top[:limit]
+            return [(self._names[k].most_common(1)[0][0], self._totals[k]) for k in top]
+
+
+issuer_index = IssuerIndex()
+
+
+def refresh_issuer_index():
+    """从发票明细重建开票方索引（需在应用上下文中调用）"""
+    from sqlalchemy import select, func
+    from models import db, InvoiceDetail
+
+    rows = db.session.execute(
+        select(InvoiceDetail.issuer, func.count())
+        .where(InvoiceDetail.issuer.is_not(None), InvoiceDetail.issuer != '')
+        .group_by(InvoiceDetail.issuer)
+    ).all()
+    issuer_index.build(rows)
+
+
+def refresh_issuer_index_async(app):
+    """索引过期时在后台线程重建（多进程部署时其他 worker 新增的开票方由此同步），重建期间继续使用旧索引"""
+    with issuer_index._lock:
+        if issuer_index._refreshing:
+            return
+        issuer_index._refreshing = True
+
+    def run():
+        try:
+            with app.app_context():
+                refresh_issuer_index()
+                from models import db
+                db.session.remove()
+        except Exception as e:
+            print(f"重建开票方索引失败: {e}")
+        finally:
+            issuer_index._refreshing = False
+
+    threading.Thread(target=run, name='issuer-index', daemon=True).start()
+
+
+def note_issuer(session, issuer, count=1):
+    """记录本事务中新增（或减少）的开票方，事务提交后再更新索引，回滚时丢弃"""
+    if issuer:
+        session.info.setdefault('issuer_updates', []).append((issuer, count))
+
+
+def _apply_issuer_updates(session):
+    for issuer, count in session.info.pop('issuer_updates', ()):
+        issuer_index.add(issuer, count)
+
+
+def _discard_issuer_updates(session):
+    session.info.pop('issuer_updates', None)
+
+
+def init_issuer_index(app):
+    """根据配置设置索引过期时间，并在会话提交/回滚时更新索引"""
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    issuer_index.max_age = app.config.get('ISSUER_INDEX_MAX_AGE', 600)
+    if not event.contains(Session, 'after_commit', _apply_issuer_updates):
+        event.listen(Session, 'after_commit', _apply_issuer_updates)
+        event.listen(Session, 'after_rollback', _discard_issuer_updates)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+上传目录的清理
+    reports   生成的报销单只在下载时使用，超过 REPORT_RETENTION_HOURS 的删除
+    invoices / receipts  不再被 InvoiceDetail.file_url 或 InvoiceApplication.bank_receipt_url 引用的文件
+              （无法识别的上传、重复上传替换下来的旧文件等）超过 ORPHAN_GRACE_HOURS 后删除，
+              通过存储后端列出和删除（对象存储中同样适用）
+
+命令行：flask cleanup-storage [--dry-run]
+STORAGE_SWEEP_INTERVAL 大于 0 时由 gunicorn.conf.py 在每个 worker 中启动后台线程定期执行
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from sqlalchemy import select
+
+from models import db, InvoiceApplication, InvoiceDetail
+
+logger = logging.getLogger('invoice.lifecycle')
+
+# 保存被引用文件的子目录
+REFERENCED_FOLDERS = ('invoices', 'receipts')
+
+# 定时清理的锁文件（位于上传目录）
+LOCK_NAME = '.cleanup.lock'
+
+
+def _remove(path, dry_run):
+    """删除文件，返回释放的字节数（文件已不存在时为 0）"""
+    try:
+        size = os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _files(folder):
+    """目录下的全部文件 [(路径, stat), ...]"""
+    result = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                result.append((path, os.stat(path)))
+            except FileNotFoundError:
+                continue
+    return result
+
+
+def prune_reports(upload_folder, retention_hours, dry_run=False, now=None):
+    """
+    删除超过保留时间的报销单（包括生成失败留下的临时文件）
+
+    Returns:
+        dict: files（删除的文件数）、bytes（释放的字节数）
+    """
+    now = now or time.time()
+    cutoff = now - retention_hours * 3600
+    files = 0
+    reclaimed = 0
+    for path, stat in _files(os.path.join(upload_folder, 'reports')):
+        if stat.st_mtime < cutoff:
+            reclaimed += _remove(path, dry_run)
+            files += 1
+    return {'files': files, 'bytes': reclaimed}
+
+
+def referenced_urls():
+    """数据库中引用的全部文件URL（需在应用上下文中调用）"""
+    urls = set(db.session.scalars(select(InvoiceDetail.file_url).where(InvoiceDetail.file_url.isnot(None))))
+    urls.update(db.session.scalars(
+        select(InvoiceApplication.bank_receipt_url).where(InvoiceApplication.bank_receipt_url.isnot(None))
+    ))
+    return urls
+
+
+def sweep_orphans(storage, grace_hours, dry_run=False, now=None):
+    """
+    删除没有被数据库引用的发票和回单文件
+
+    存储中的文件集合和数据库中的URL集合各取一次，做一次差集；
+    只删除修改时间早于 grace_hours 的文件，避免误删刚保存、还没写入数据库的上传
+
+    Returns:
+        dict: files、bytes、paths（删除的文件URL，最多100个）
+    """
+    now = now or time.time()
+    cutoff = now - grace_hours * 3600
+    stored = {}
+    for folder in REFERENCED_FOLDERS:
+        for key, mtime, size in storage.iter_files(folder):
+            if mtime < cutoff:
+                stored[f'/uploads/{key}'] = (key, size)
+
+    orphans = sorted(stored.keys() - referenced_urls())
+    reclaimed = 0
+    for url in orphans:
+        key, size = stored[url]
+        reclaimed += size if dry_run else storage.delete(key)
+    return {'files': len(orphans), 'bytes': reclaimed, 'paths': orphans[:100]}
+
+
+def cleanup_storage(app, dry_run=False):
+    """
+    执行一次全部清理（需在应用上下文中调用）
+
+    Returns:
+        dict: reports、orphans 两项的统计，以及合计释放的字节数 bytes
+    """
+    from storage import get_storage
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    result = {
+        'reports': prune_reports(upload_folder, app.config['REPORT_RETENTION_HOURS'], dry_run=dry_run),
+        'orphans': sweep_orphans(get_storage(), app.config['ORPHAN_GRACE_HOURS'], dry_run=dry_run),
+    }
+    result['bytes'] = result['reports']['bytes'] + result['orphans']['bytes']
+    logger.info('%s清理上传目录：报销单 %d 个，无引用文件 %d 个，释放 %.1f MB',
+                '（试运行）' if dry_run else '', result['reports']['files'], result['orphans']['files'],
+                result['bytes'] / 1024 / 1024)
+    return result
+
+
+def application_files(application):
+    """申请的发票文件和银行回单的URL（删除申请前调用，提交后再用 remove_files 删除文件）"""
+    urls = [detail.file_url for detail in application.details if detail.file_url]
+    if application.bank_receipt_url:
+        urls.append(application.bank_receipt_url)
+    return urls
+
+
+def remove_files(urls):
+    """
+    从存储后端删除文件（删除明细或申请并提交后调用），返回释放的字节数
+
+    一个文件包含多张发票时各明细共用同一个文件，仍被其他明细引用的文件不删除；已归档的文件留在归档中
+    """
+    from archive import is_archive_url
+    from storage import get_storage, url_to_key
+
+    urls = {url for url in urls if url and not is_archive_url(url)}
+    if not urls:
+        return 0
+    urls -= set(db.session.scalars(select(InvoiceDetail.file_url).where(InvoiceDetail.file_url.in_(urls))))
+    storage = get_storage()
+    keys = [url_to_key(url) for url in urls]
+    return sum(storage.delete(key) for key in keys if key)
+
+
+def run_if_due(app, interval):
+    """
+    距上次清理超过 interval 秒时执行一次清理
+
+    多个 worker 进程各自运行定时线程，用上传目录中的锁文件保证同一时间只有一个进程清理，
+    锁文件的修改时间记录上次清理的时间
+
+    Returns:
+        dict: cleanup_storage 的结果；未到时间或其他进程正在清理时为 None
+    """
+    lock_path = os.path.join(app.config['UPLOAD_FOLDER'], LOCK_NAME)
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        if time.time() - os.path.getmtime(lock_path) < interval:
+            return None
+        try:
+            with app.app_context():
+                result = cleanup_storage(app)
+                db.session.remove()
+        finally:
+            os.utime(lock_path)
+    return result
+
+
+def start_scheduler(app):
+    """
+    STORAGE_SWEEP_INTERVAL（秒）大于 0 时启动后台线程定期清理
+    在 gunicorn 的 post_fork 中调用（每个 worker 一个线程，由 run_if_due 保证不重复清理）
+
+    Returns:
+        threading.Thread 或 None
+    """
+    interval = app.config.get('STORAGE_SWEEP_INTERVAL') or 0
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            # 错开各 worker 检查的时间
+            time.sleep(min(interval, 60) * (0.5 + random.random()))
+            try:
+                run_if_due(app, interval)
+            except Exception:
+                logger.exception('清理上传目录失败')
+
+    thread = threading.Thread(target=run, name='storage-lifecycle', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+运行指标采集
+- 每个路由的请求耗时直方图
+- 每个请求的 SQL 语句数和耗时（SQLAlchemy 引擎事件）
+- PDF提取、报销单生成等阶段耗时（timed_stage）
+以 Prometheus 文本格式在 /metrics 输出（仅管理员），慢请求写日志并附带 SQL 明细
+指标保存在进程内，多进程部署时每个 worker 各自统计
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger('invoice.metrics')
+
+# 直方图分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """带标签的累计直方图"""
+
+    def __init__(self, name, help_text, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, count, total) in sorted(self._series.items()):
+                label_text = _format_labels(self.label_names, labels)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_count{{{label_text}}} {count}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {total:.6f}')
+        return lines
+
+
+class Counter:
+    """带标签的计数器"""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{_format_labels(self.label_names, labels)}}} {value}')
+        return lines
+
+
+def _format_labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', '请求耗时', ('endpoint', 'method', 'status'))
+SQL_STATEMENTS = Counter('sql_statements_total', 'SQL 语句数', ('endpoint',))
+SQL_TIME = Counter('sql_statement_seconds_total', 'SQL 执行耗时', ('endpoint',))
+STAGE_LATENCY = Histogram('stage_duration_seconds', '处理阶段耗时', ('stage',))
+
+ALL_METRICS = (REQUEST_LATENCY, SQL_STATEMENTS, SQL_TIME, STAGE_LATENCY)
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    记录一个处理阶段的耗时
+
+    用法：
+        with timed_stage('extract_pdf'):
+            invoices = extract_pdf_invoices(...)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.observe((stage,), elapsed)
+        if has_request_context() and hasattr(g, 'metrics_stages'):
+            g.metrics_stages.append((stage, elapsed))
+
+
+def render_metrics():
+    """Prometheus 文本格式"""
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _endpoint_label():
+    return request.endpoint or 'unknown'
+
+
+def init_metrics(app):
+    """注册请求钩子和 SQL 引擎事件，需在 db.init_app 之后调用"""
+    with app.app_context():
+        engine = db.engine
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = []
+        g.metrics_stages = []
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        endpoint = _endpoint_label()
+        REQUEST_LATENCY.observe((endpoint, request.method, str(response.status_code)), elapsed)
+
+        queries = g.pop('metrics_queries', [])
+        stages = g.pop('metrics_stages', [])
+        SQL_STATEMENTS.inc((endpoint,), len(queries))
+        SQL_TIME.inc((endpoint,), sum(duration for _, duration in queries))
+
+        threshold = app.config.get('SLOW_REQUEST_SECONDS')
+        if threshold and elapsed >= threshold:
+            _log_slow_request(endpoint, elapsed, queries, stages)
+        return response
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['metrics_query_start'].pop()
+        if has_request_context() and hasattr(g, 'metrics_queries'):
+            g.metrics_queries.append((statement, time.perf_counter() - start))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # 执行失败的语句不会触发 after_cursor_execute，丢弃它的开始时间，避免之后的计时错位
+        conn = context.connection
+        if conn is not None and conn.info.get('metrics_query_start'):
+            conn.info['metrics_query_start'].pop()
+
+
+def _log_slow_request(endpoint, elapsed, queries, stages):
+    """慢请求日志：总耗时、SQL 数量和耗时最长的语句、各阶段耗时"""
+    sql_time = sum(duration for _, duration in queries)
+    lines = [
+        f'慢请求 {request.method} {request.path} endpoint={endpoint} '
+        f'耗时={elapsed * 1000:.1f}ms SQL={len(queries)}条/{sql_time * 1000:.1f}ms'
+    ]
+    for stage, duration in stages:
+        lines.append(f'  阶段 {stage}: {duration * 1000:.1f}ms')
+
+    # 相同语句合并统计，按总耗时排序
+    grouped = {}
+    for statement, duration in queries:
+        key = ' '.join(statement.split())[:200]
+        count, total = grouped.get(key, (0, 0.0))
+        grouped[key] = (count + 1, total + duration)
+    for statement, (count, total) in sorted(grouped.items(), key=lambda item: -item[1][1])[:10]:
+        lines.append(f'  SQL x{count} {total * 1000:.1f}ms: {statement}')
+    logger.warning('\n'.join(lines))
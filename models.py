@@ -2,6 +2,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+import json
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
@@ -91,12 +92,24 @@ class InvoiceDetail(db.Model):
     invoice_number = db.Column(db.String(100), unique=True, nullable=False)  # 发票号码（全表唯一）
     invoice_date = db.Column(db.Date)  # 开票日期
     issuer = db.Column(db.String(200))  # 开票方
+    issuer_normalized = db.Column(db.String(200))  # 归一化的开票方（近似重复检测）
     amount = db.Column(db.Integer)  # 价税合计（分为单位）
     file_url = db.Column(db.String(500))  # 发票文件URL地址
     filename = db.Column(db.String(255))  # 原始文件名
     reimbursement_type = db.Column(db.String(50))  # 报销类型
     application_id = db.Column(db.Integer, db.ForeignKey('invoice_applications.id'), nullable=False)  # 申请表ID
     created_at = db.Column(db.DateTime, default=datetime.now)  # 创建时间
+    duplicate_of_id = db.Column(db.Integer, db.ForeignKey('invoice_details.id', ondelete='SET NULL'), index=True)  # 疑似重复的已有发票ID
+    page_start = db.Column(db.Integer)  # 发票在文件中的起始页（从1开始，一个文件多张发票时各不相同）
+    page_end = db.Column(db.Integer)  # 发票在文件中的结束页
+    buyer_entity = db.Column(db.String(100))  # 购买方主体（集团内的法人，见 Config.BUYER_ENTITIES）
+    
+    __table_args__ = (
+        # 近似重复检测：同一开票方、金额、开票日期
+        db.Index('ix_invoice_details_near_duplicate', 'issuer_normalized', 'amount', 'invoice_date'),
+        # 编辑页按申请分页加载明细、按类型小计
+        db.Index('ix_invoice_details_application', 'application_id', 'reimbursement_type'),
+    )
     
     # 报销类型选项
     REIMBURSEMENT_TYPES = [
@@ -104,6 +117,16 @@ class InvoiceDetail(db.Model):
         '办公费', '交通费', '通讯费', '餐饮费', '住宿费', '其他'
     ]
     
+    @property
+    def thumbnail_url(self):
+        """发票所在页（默认第一页）缩略图的地址"""
+        if not self.file_url or not self.file_url.startswith('/uploads/'):
+            return None
+        url = '/previews/thumb/' + self.file_url[len('/uploads/'):]
+        if self.page_start and self.page_start > 1:
+            url += f'?page={self.page_start}'
+        return url
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -113,8 +136,124 @@ class InvoiceDetail(db.Model):
             'amount': self.amount / 100 if self.amount else 0,  # 转换为元
             'amount_yuan': f'{self.amount / 100:.2f}' if self.amount else '0.00',
             'file_url': self.file_url,
+            'thumbnail_url': self.thumbnail_url,
             'filename': self.filename,
             'reimbursement_type': self.reimbursement_type,
             'application_id': self.application_id,
+            'duplicate_of_id': self.duplicate_of_id,
+            'page_start': self.page_start,
+            'page_end': self.page_end,
+            'buyer_entity': self.buyer_entity,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+
+class SpendRollup(db.Model):
+    """报销金额汇总表（按开票月份、报销类型、报销人、申请状态、购买方主体汇总，随明细和申请状态增量维护）"""
+    __tablename__ = 'spend_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False, default='')  # 开票月份 YYYY-MM（无开票日期为空字符串）
+    reimbursement_type = db.Column(db.String(50), nullable=False, default='')  # 报销类型（未分类为空字符串）
+    reimbursement_person = db.Column(db.String(100), nullable=False, default='')  # 报销人
+    status = db.Column(db.String(20), nullable=False, default='')  # 申请状态
+    buyer_entity = db.Column(db.String(100), nullable=False, default='')  # 购买方主体（未识别为空字符串）
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)  # 发票数量
+    total_amount = db.Column(db.Integer, nullable=False, default=0)  # 金额合计（分为单位）
+    
+    __table_args__ = (
+        db.UniqueConstraint('month', 'reimbursement_type', 'reimbursement_person', 'status', 'buyer_entity',
+                            name='uq_spend_rollup_key'),
+    )
+    
+    def to_dict(self):
+        return {
+            'month': self.month,
+            'reimbursement_type': self.reimbursement_type,
+            'reimbursement_person': self.reimbursement_person,
+            'status': self.status,
+            'buyer_entity': self.buyer_entity,
+            'invoice_count': self.invoice_count,
+            'total_amount': self.total_amount / 100 if self.total_amount else 0
+        }
+
+
+class ExtractionTrace(db.Model):
+    """PDF提取记录（每次提取一条，用于查找提取慢或提取失败的发票类型）"""
+    __tablename__ = 'extraction_traces'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(200))  # 原始文件名
+    file_url = db.Column(db.String(500))  # 文件存储路径
+    source = db.Column(db.String(20))  # 来源：upload / import
+    file_size = db.Column(db.Integer)  # 文件大小（字节）
+    page_count = db.Column(db.Integer)  # 总页数
+    pages_read = db.Column(db.Integer)  # 实际读取的页数
+    text_ms = db.Column(db.Float)  # 文本提取耗时（毫秒）
+    parse_ms = db.Column(db.Float)  # 文本解析耗时（毫秒）
+    total_ms = db.Column(db.Float, index=True)  # 总耗时（毫秒）
+    parser = db.Column(db.String(20))  # 匹配的解析分支：huochepiao / generic，未匹配为空
+    issuer = db.Column(db.String(200))  # 提取到的开票方
+    fields = db.Column(db.String(200))  # 提取到的字段，逗号分隔
+    page_timings = db.Column(db.Text)  # 每页耗时（JSON）
+    error = db.Column(db.String(500))  # 错误信息
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))  # 操作用户
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)  # 创建时间
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'file_url': self.file_url,
+            'source': self.source,
+            'file_size': self.file_size,
+            'page_count': self.page_count,
+            'pages_read': self.pages_read,
+            'text_ms': self.text_ms,
+            'parse_ms': self.parse_ms,
+            'total_ms': self.total_ms,
+            'parser': self.parser,
+            'issuer': self.issuer,
+            'fields': self.fields.split(',') if self.fields else [],
+            'page_timings': json.loads(self.page_timings) if self.page_timings else [],
+            'error': self.error,
+            'user_id': self.user_id,
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
-        }
\ No newline at end of file
+        }
+
+
+class InvoiceText(db.Model):
+    """发票文本层（提取时保存的发票所在页规范化文本，修正解析规则后直接重新解析，不需要再读取PDF）"""
+    __tablename__ = 'invoice_texts'
+    
+    detail_id = db.Column(db.Integer, db.ForeignKey('invoice_details.id', ondelete='CASCADE'), primary_key=True)  # 发票明细ID
+    content = db.Column(db.LargeBinary, nullable=False)  # zlib 压缩的 UTF-8 文本，页之间以换页符分隔
+    fields = db.Column(db.Text)  # 上次从文本解析出的字段值（JSON），为空表示未知（补充的历史发票）
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)  # 更新时间
+
+
+class ApplicationEvent(db.Model):
+    """申请变化记录（提交、报销、删除、已提交申请新增发票），供待处理队列的实时推送读取，定期清理"""
+    __tablename__ = 'application_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    application_id = db.Column(db.Integer, nullable=False)  # 申请ID（申请删除后仍保留，不加外键）
+    kind = db.Column(db.String(20), nullable=False)  # submitted / paid / deleted / updated
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)  # 创建时间
+
+
+class UserChange(db.Model):
+    """用户修改记录（创建、修改、删除），各进程定期读取，使登录用户缓存失效，定期清理"""
+    __tablename__ = 'user_changes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)  # 用户ID（用户删除后仍保留，不加外键）
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)  # 创建时间
+
+
+@db.event.listens_for(InvoiceDetail, 'after_delete')
+def _delete_invoice_text(mapper, connection, target):
+    """删除明细时删除文本层，并清除指向它的疑似重复标记（SQLite 默认不执行外键的级联删除和 SET NULL）"""
+    connection.execute(InvoiceText.__table__.delete().where(InvoiceText.__table__.c.detail_id == target.id))
+    details = InvoiceDetail.__table__
+    connection.execute(details.update().where(details.c.duplicate_of_id == target.id).values(duplicate_of_id=None))
@@ -14,29 +14,46 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from PyPDF2 import PdfReader, PdfWriter
 import os
+import threading
 from datetime import datetime
 # 安装文泉驿字体
 # sudo apt-get install fonts-wqy-zenhei fonts-wqy-microhei
 
 # 或安装Noto字体
 # sudo apt-get install fonts-noto-cjk
-# 注册中文字体（跨平台支持）
-try:
-    # Windows
-    pdfmetrics.registerFont(TTFont('SimSun', 'C:/Windows/Fonts/simsun.ttc'))
-    FONT_NAME = 'SimSun'
-except:
-    try:
-        # Ubuntu/Linux - 文泉驿正黑
-        pdfmetrics.registerFont(TTFont('WQY', '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc'))
-        FONT_NAME = 'WQY'
-    except:
-        try:
-            # Ubuntu/Linux - Noto字体
-            pdfmetrics.registerFont(TTFont('Noto', '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc'))
-            FONT_NAME = 'Noto'
-        except:
-            FONT_NAME = 'Helvetica'
+
+# 中文字体候选（跨平台支持），TTC 字体文件较大，第一次生成报销单时才注册
+FONT_CANDIDATES = [
+    ('SimSun', 'C:/Windows/Fonts/simsun.ttc'),  # Windows
+    ('WQY', '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc'),  # Ubuntu/Linux - 文泉驿正黑
+    ('Noto', '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc'),  # Ubuntu/Linux - Noto字体
+]
+
+_font_name = None
+_font_lock = threading.Lock()
+
+def get_font_name():
+    """
+    注册中文字体并返回字体名（只在第一次调用时注册）
+    
+    多进程部署时由 app.warm_up 在 fork 之前调用，worker 共享已注册的字体
+    
+    Returns:
+        str: 字体名，没有可用的中文字体时为 Helvetica
+    """
+    global _font_name
+    with _font_lock:
+        if _font_name is None:
+            font_name = 'Helvetica'
+            for name, path in FONT_CANDIDATES:
+                try:
+                    pdfmetrics.registerFont(TTFont(name, path))
+                    font_name = name
+                    break
+                except Exception:
+                    continue
+            _font_name = font_name
+    return _font_name
 
 def generate_reimbursement_pdf(application, upload_folder):
     """
@@ -80,6 +97,7 @@ def generate_reimbursement_pdf(application, upload_folder):
 
 def generate_summary_page(application, output_path):
     """生成汇总页"""
+    font_name = get_font_name()
     doc = SimpleDocTemplate(output_path, pagesize=A4)
     story = []
     
@@ -92,14 +110,14 @@ def generate_summary_page(application, output_path):
         textColor=colors.HexColor('#333333'),
         spaceAfter=30,
         alignment=TA_CENTER,
-        fontName=FONT_NAME
+        fontName=font_name
     )
     
     normal_style = ParagraphStyle(
         'CustomNormal',
         parent=styles['Normal'],
         fontSize=10,
-        fontName=FONT_NAME
+        fontName=font_name
     )
     
     # 标题
@@ -111,7 +129,7 @@ def generate_summary_page(application, output_path):
         'SNStyle',
         parent=styles['Normal'],
         fontSize=12,
-        fontName=FONT_NAME,
+        fontName=font_name,
         alignment=TA_LEFT,  # 使用 TA_LEFT，通过表格实现右对齐
         textColor=colors.HexColor('#666666'),
         spaceAfter=20
@@ -139,7 +157,7 @@ def generate_summary_page(application, output_path):
     
     info_table = Table(info_data, colWidths=[3*cm, 6*cm, 3*cm, 6*cm])
     info_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), FONT_NAME),
+        ('FONTNAME', (0, 0), (-1, -1), font_name),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('TEXTCOLOR', (0, 0), (0, -1), colors.HexColor('#666666')),
         ('TEXTCOLOR', (2, 0), (2, -1), colors.HexColor('#666666')),
@@ -164,7 +182,7 @@ def generate_summary_page(application, output_path):
         'SummaryTitle',
         parent=styles['Heading2'],
         fontSize=14,
-        fontName=FONT_NAME,
+        fontName=font_name,
         spaceAfter=10
     ))
     story.append(summary_title)
@@ -184,7 +202,7 @@ def generate_summary_page(application, output_path):
     
     summary_table = Table(summary_data, colWidths=[8*cm, 4*cm, 4*cm])
     summary_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, -1), FONT_NAME),
+        ('FONTNAME', (0, 0), (-1, -1), font_name),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
@@ -192,7 +210,7 @@ def generate_summary_page(application, output_path):
         ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
         ('GRID', (0, 0), (-1, -1), 1, colors.grey),
         ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#E7E6E6')),
-        ('FONTNAME', (0, -1), (-1, -1), FONT_NAME),
+        ('FONTNAME', (0, -1), (-1, -1), font_name),
         ('FONTSIZE', (0, -1), (-1, -1), 11),
         ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, colors.HexColor('#F2F2F2')]),
     ]))
@@ -204,32 +222,43 @@ def generate_summary_page(application, output_path):
 def generate_invoice_pages(application, upload_folder, output_path):
     """
     生成发票页：每页放置2个发票（2行1列布局）
-    - PDF文件：使用PyMuPDF转换为图片后嵌入
+    - PDF文件：嵌入预览图缓存中的第一页位图（PyMuPDF 渲染）
     - 图片文件：直接缩放嵌入
     """
+    from contextlib import ExitStack
+    
+    from previews import preview_cache, PreviewCache
+    from storage import local_copy
+    
+    # PDF第一页的打印分辨率位图取自预览图缓存，同一发票只渲染一次（没有初始化应用时使用报销单目录下的缓存）
+    if not preview_cache.directory:
+        preview_cache = PreviewCache(os.path.join(upload_folder, 'previews'))
+    
+    # 对象存储中的文件下载到临时文件，生成完成后统一删除
+    with ExitStack() as stack:
+        # 获取所有发票文件
+        invoice_files = []
+        for detail in application.details:
+            if not detail.file_url:
+                continue
+            
+            # 本地路径，已归档的文件为 ArchiveMember
+            file_path = stack.enter_context(local_copy(detail.file_url))
+            if file_path is not None:
+                invoice_files.append({
+                    'path': file_path,
+                    'detail': detail
+                })
+        
+        _draw_invoice_pages(invoice_files, preview_cache, output_path)
+
+
+def _draw_invoice_pages(invoice_files, preview_cache, output_path):
+    """把发票文件按2行1列绘制到 output_path"""
     from PIL import Image
     from reportlab.pdfgen import canvas
-    import io
     
-    try:
-        import fitz  # PyMuPDF
-        pymupdf_available = True
-    except ImportError:
-        pymupdf_available = False
-        print("警告：PyMuPDF 未安装，PDF文件将以文本信息显示")
-    
-    # 获取所有发票文件
-    invoice_files = []
-    for detail in application.details:
-        if not detail.file_url:
-            continue
-        
-        file_path = os.path.join(upload_folder, detail.file_url.lstrip('/uploads/'))
-        if os.path.exists(file_path):
-            invoice_files.append({
-                'path': file_path,
-                'detail': detail
-            })
+    font_name = get_font_name()
     
     if not invoice_files:
         # 如果没有发票，创建空文件
@@ -268,7 +297,7 @@ def generate_invoice_pages(application, upload_folder, output_path):
         y = page_height - margin - (row + 1) * cell_height - row * spacing
         
         file_path = invoice_file['path']
-        file_ext = os.path.splitext(file_path)[1].lower()
+        file_ext = os.path.splitext(invoice_file['detail'].file_url)[1].lower()
         
         # 绘制边框
         c.setStrokeColor(colors.grey)
@@ -276,34 +305,16 @@ def generate_invoice_pages(application, upload_folder, output_path):
         c.rect(x, y, cell_width, cell_height)
         
         img_to_draw = None
-        temp_img_path = None
         
         try:
             if file_ext == '.pdf':
-                # 处理PDF文件：使用PyMuPDF转换为图片
-                if pymupdf_available:
-                    try:
-                        pdf_doc = fitz.open(file_path)
-                        if len(pdf_doc) > 0:
-                            # 获取第一页
-                            page = pdf_doc[0]
-                            # 设置缩放比例（zoom=2 相当于 144 DPI）
-                            zoom = 2
-                            mat = fitz.Matrix(zoom, zoom)
-                            # 渲染为图片
-                            pix = page.get_pixmap(matrix=mat)
-                            # 保存为临时文件
-                            temp_img_path = os.path.join(upload_folder, 'reports', f'temp_pdf_img_{idx}.png')
-                            pix.save(temp_img_path)
-                            img_to_draw = temp_img_path
-                        pdf_doc.close()
-                    except Exception as e:
-                        print(f"PDF转图片失败 {file_path}: {e}")
+                # 处理PDF文件：使用缓存的位图（一个文件多张发票时取这张发票所在的页）
+                img_to_draw = preview_cache.get(file_path, 'print', page=invoice_file['detail'].page_start or 1)
                 
                 # 如果转换失败或PyMuPDF不可用，显示文本信息
                 if not img_to_draw:
                     detail = invoice_file['detail']
-                    c.setFont(FONT_NAME if FONT_NAME != 'Helvetica' else 'Helvetica', 8)
+                    c.setFont(font_name, 8)
                     text_x = x + 5
                     text_y = y + cell_height - 15
                     
@@ -315,8 +326,8 @@ def generate_invoice_pages(application, upload_folder, output_path):
                     continue
                     
             elif file_ext in ['.jpg', '.jpeg', '.png', '.bmp', '.gif']:
-                # 直接使用图片文件
-                img_to_draw = file_path
+                # 直接使用图片文件（已归档的图片取缓存中的副本）
+                img_to_draw = preview_cache.get(file_path, 'print')
             
             # 如果有图片需要绘制
             if img_to_draw:
@@ -349,27 +360,13 @@ def generate_invoice_pages(application, upload_folder, output_path):
                 # 绘制图片
                 c.drawImage(img_to_draw, img_x, img_y, width=new_width, height=new_height, preserveAspectRatio=True)
                 
-                # 删除临时文件
-                if temp_img_path and os.path.exists(temp_img_path):
-                    try:
-                        os.remove(temp_img_path)
-                    except:
-                        pass
-                
         except Exception as e:
             # 如果处理失败，显示错误信息
-            c.setFont(FONT_NAME if FONT_NAME != 'Helvetica' else 'Helvetica', 8)
+            c.setFont(font_name, 8)
             c.setFillColor(colors.red)
             c.drawString(x + 5, y + cell_height / 2, f"无法加载文件")
             c.setFillColor(colors.black)
             print(f"处理文件失败 {file_path}: {e}")
-            
-            # 清理临时文件
-            if temp_img_path and os.path.exists(temp_img_path):
-                try:
-                    os.remove(temp_img_path)
-                except:
-                    pass
     
     c.save()
 
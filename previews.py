@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""发票预览图缓存
+发票第一页渲染一次后保存在磁盘上，编辑页、搜索页的缩略图和报销单中的发票图片都直接复用：
+    thumb  缩略图（JPEG，宽 PREVIEW_THUMB_WIDTH 像素）
+    print  打印分辨率位图（PNG，PDF 按 PREVIEW_PRINT_ZOOM 倍渲染，图片文件直接使用原文件）
+一个文件包含多张发票时按页生成（第一页以外的页文件名带 _p<页码>）
+
+缓存按文件内容的 SHA-256 命名，同一张发票重复上传或被导入多次只渲染一次；
+缓存目录总大小超过 PREVIEW_CACHE_MAX_BYTES 时按最近使用时间（文件 mtime，命中时更新）淘汰，
+多个 worker 进程共享同一个目录
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
+VARIANTS = {'thumb': '.jpg', 'print': '.png'}
+
+
+class PreviewCache:
+    """按内容哈希命名、总大小受限的磁盘 LRU 缓存"""
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024, thumb_width=240, print_zoom=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.thumb_width = thumb_width
+        self.print_zoom = print_zoom
+        self._lock = threading.Lock()
+        self._size = None  # 缓存目录当前大小（字节），第一次写入时统计
+        # (路径, 修改时间, 大小) -> 内容哈希，避免每次访问都重新读文件计算哈希
+        self._digests = OrderedDict()
+        # 文件URL -> 内容哈希（上传文件名带时间戳，同一URL内容不变），命中时不需要读取或下载源文件
+        self._url_digests = OrderedDict()
+
+    def digest(self, path):
+        """文件内容的 SHA-256"""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+                return digest
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with self._lock:
+            self._digests[key] = digest
+            while len(self._digests) > 4096:
+                self._digests.popitem(last=False)
+        return digest
+
+    def cache_path(self, digest, variant, page=1):
+        suffix = f'_p{page}' if page > 1 else ''
+        return os.path.join(self.directory, digest[:2], f'{digest}_{variant}{suffix}{VARIANTS[variant]}')
+
+    def contains(self, path):
+        """path 是否位于缓存目录内（缓存文件本身不再生成预览）"""
+        if not self.directory or not isinstance(path, str):
+            return False
+        directory = os.path.abspath(self.directory)
+        return os.path.commonpath([directory, os.path.abspath(path)]) == directory
+
+    def lookup(self, url, variant, page=1):
+        """按文件URL查找已生成的预览，没有时为 None"""
+        if not self.directory or variant not in VARIANTS:
+            return None
+        with self._lock:
+            digest = self._url_digests.get(url)
+        if digest is None:
+            return None
+        target = self.cache_path(digest, variant, page)
+        try:
+            os.utime(target)
+            return target
+        except FileNotFoundError:
+            return None
+
+    def get(self, path, variant, url=None, page=1):
+        """
+        返回文件某个预览的路径，缓存中没有时渲染并写入缓存
+
+        Args:
+            path: 上传的发票文件（PDF 或图片）的路径，或归档中的文件（archive.ArchiveMember）
+            variant: thumb 或 print
+            url: 文件URL，记录下来供 lookup 使用
+            page: PDF的页码（从1开始）
+
+        Returns:
+            str: 预览图路径；无法渲染（PyMuPDF 未安装、文件损坏、缓存未配置）时为 None
+        """
+        if not self.directory or variant not in VARIANTS:
+            return None
+        archived = not isinstance(path, str)
+        ext = os.path.splitext(path.name if archived else path)[1].lower()
+        if variant == 'print' and ext in IMAGE_EXTENSIONS and not archived:
+            # 图片文件本身就是打印分辨率
+            return path
+
+        # 归档索引中保存了内容哈希
+        digest = path.digest if archived else self.digest(path)
+        if url:
+            with self._lock:
+                self._url_digests[url] = digest
+                self._url_digests.move_to_end(url)
+                while len(self._url_digests) > 65536:
+                    self._url_digests.popitem(last=False)
+        target = self.cache_path(digest, variant, page)
+        try:
+            # 更新 mtime 作为最近使用时间
+            os.utime(target)
+            return target
+        except FileNotFoundError:
+            pass
+
+        data = self._render(path, ext, variant, page)
+        if data is None:
+            return None
+        self._store(target, data)
+        return target
+
+    def _render(self, path, ext, variant, page_number=1):
+        """渲染一页，返回编码后的图片字节"""
+        import io
+        
+        archived = not isinstance(path, str)
+        try:
+            if ext == '.pdf':
+                try:
+                    import pymupdf as fitz  # PyMuPDF >= 1.24
+                except ImportError:
+                    import fitz
+                source = {'stream': path.getvalue(), 'filetype': 'pdf'} if archived else {'filename': path}
+                with fitz.open(**source) as doc:
+                    if not 1 <= page_number <= len(doc):
+                        return None
+                    page = doc[page_number - 1]
+                    if variant == 'print':
+                        zoom = self.print_zoom
+                    else:
+                        zoom = self.thumb_width / page.rect.width
+                    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                    return pix.tobytes('jpeg' if variant == 'thumb' else 'png')
+            if ext in IMAGE_EXTENSIONS:
+                from PIL import Image
+                with Image.open(io.BytesIO(path.getvalue()) if archived else path) as img:
+                    img = img.convert('RGB')
+                    buffer = io.BytesIO()
+                    if variant == 'print':
+                        # 只有归档的图片需要（未归档的直接使用原文件）
+                        img.save(buffer, 'PNG')
+                    else:
+                        img.thumbnail((self.thumb_width, self.thumb_width * 4))
+                        img.save(buffer, 'JPEG', quality=85)
+                    return buffer.getvalue()
+        except Exception as e:
+            print(f"生成预览失败 {path.name if archived else path}: {e}")
+        return None
+
+    def _store(self, target, data):
+        """先写临时文件再改名，并发渲染同一文件时不会读到半个文件"""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f'{target}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, target)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict(keep=target)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, keep=None):
+        """删除最久未使用的预览，直到总大小降到上限的 90%（其他进程也在写，每次都重新扫描目录）"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """删除全部预览"""
+        with self._lock:
+            for _, _, path in list(self._entries()):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+            self._digests.clear()
+            self._url_digests.clear()
+
+
+preview_cache = PreviewCache()
+
+
+def init_previews(app):
+    """根据配置设置缓存目录和大小"""
+    preview_cache.directory = app.config.get('PREVIEW_CACHE_DIR') or os.path.join(app.config['UPLOAD_FOLDER'], 'previews')
+    preview_cache.max_bytes = app.config.get('PREVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+    preview_cache.thumb_width = app.config.get('PREVIEW_THUMB_WIDTH', 240)
+    preview_cache.print_zoom = app.config.get('PREVIEW_PRINT_ZOOM', 2)
+    preview_cache._size = None
+    os.makedirs(preview_cache.directory, exist_ok=True)
+
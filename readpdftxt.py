@@ -1,8 +1,40 @@
 # -*- coding:utf-8 -*-
 
-import pdfplumber
 import re
+import os
+import time
 import datetime
+import threading
+from bisect import bisect_right
+from functools import lru_cache
+
+# 提取用的正则（模块加载时编译，多进程部署时在 fork 前完成）
+RAILWAY_NUMBER_RE = re.compile(r'\d{20,}')
+INVOICE_NUMBER_RE = re.compile(r'(\d{10,})')
+DATE_RE = re.compile(r'(\d{4}年\d{1,2}月\d{1,2}日)')
+AMOUNT_RE = re.compile(r'¥(\d+\.\d{2})')
+NEWLINE_RE = re.compile(r'\n')
+
+# 多发票PDF并行提取时每个任务处理的页数
+PAGES_PER_TASK = 2
+# extract_pdf_invoices 附加在信息字典中的页码和发票所在页的规范化文本（列表，每页一项）
+PAGE_KEYS = ("起始页", "结束页", "页面文本")
+
+# 中文发票常用的 CMap，pdfminer 首次使用时才从磁盘加载
+PRELOAD_CMAPS = ['UniGB-UCS2-H', 'UniGB-UTF16-H']
+PRELOAD_UNICODE_MAPS = ['Adobe-GB1']
+
+
+def warm_up():
+    """预先导入 pdfplumber 并加载 pdfminer 的中文 CMap（多进程部署时在 fork 前调用，子进程共享）"""
+    # 只为导入（加载到 sys.modules），fork 后子进程不用再各自导入
+    import pdfplumber  # noqa: F401
+    from pdfminer.cmapdb import CMapDB
+    for name in PRELOAD_CMAPS:
+        CMapDB.get_cmap(name)
+    for name in PRELOAD_UNICODE_MAPS:
+        CMapDB.get_unicode_map(name, False)
+
 
 def get_huochepiao(text):
     lines = text.split("\n")
@@ -12,13 +44,13 @@ def get_huochepiao(text):
         if "发票号码" in line:
             # 发票号码:25129110172000044123天津市税务局开票日期:2025年11月04日
             # 使用正则提取连续的数字
-            match = re.search(r'\d{20,}', line)
+            match = RAILWAY_NUMBER_RE.search(line)
             if match:
                 ret["发票号码"] = match.group()
         if "开票日期" in line:
             # 发票号码:25129110172000044123天津市税务局开票日期:2025年11月04日
             # 使用正则提取日期
-            date_match = re.search(r'(\d{4}年\d{1,2}月\d{1,2}日)', line)
+            date_match = DATE_RE.search(line)
             if date_match:
                 ret["开票日期"] = datetime.datetime.strptime(date_match.group(1), "%Y年%m月%d日").strftime("%Y-%m-%d")
         if "￥" in line:
@@ -28,79 +60,318 @@ def get_huochepiao(text):
     return ret 
     
 
-def extract_pdf_info(pdf_path, company_name):
+def normalize_text(text):
+    """规范化页面文本（括号转为全角、去掉空格），重复调用结果不变"""
+    return text.replace("(", "（").replace(")", "）").replace(" ", "")
+
+
+@lru_cache(maxsize=16)
+def _keyword_matcher(keyword):
+    from buyers import BuyerMatcher
+    return BuyerMatcher([{'name': keyword}])
+
+
+def parse_page_text(text, company_name):
+    """
+    解析一页文本
+
+    Args:
+        text: 页面文本
+        company_name: 公司名称关键词，或 buyers.BuyerMatcher（集团内多个购买方主体，一次扫描全部匹配）
+
+    Returns:
+        tuple: (信息字典, 解析分支 huochepiao/generic)，信息字典中 购买方主体 为匹配到的主体名称；
+        不是本公司（任何主体）的发票时为 ({}, None)
+    """
+    ret = {}
+    text = normalize_text(text)
+    gongsi = ""
+    matcher = _keyword_matcher(company_name) if isinstance(company_name, str) else company_name
+    matches = matcher.find(text)
+    if not matches:
+        return ret, None
+    # 购买方信息在销售方之前，取最先出现的主体
+    entity = matches[0][2]
+    if "电子客票号" in text:
+        ret = get_huochepiao(text)
+        ret["购买方主体"] = entity
+        return ret, 'huochepiao'
+        
+    # 出现主体的行（购买方所在行）
+    line_starts = [0] + [m.end() for m in NEWLINE_RE.finditer(text)]
+    buyer_lines = {bisect_right(line_starts, start) - 1 for start, _, _ in matches}
+    lines = text.split("\n")
+    for line_index, line in enumerate(lines):
+        is_buyer = line_index in buyer_lines
+        if "公司" in line and not is_buyer:
+            gongsi = line
+        if "价税合计" in line:
+            # 提取 ¥23.40 格式的金额（两位小数）
+            amount_match = AMOUNT_RE.search(line)
+            if amount_match:
+                ret["价税合计"] = int(float(amount_match.group(1))*100)
+            else:
+                ret["价税合计"] = line
+        elif "发票号码" in line:
+            # 提取至少10位连续数字
+            invoice_match = INVOICE_NUMBER_RE.search(line)
+            if invoice_match:
+                ret["发票号码"] = invoice_match.group(1)
+            else:
+                ret["发票号码"] = line
+        elif "开票日期" in line:
+            # 提取 YYYY年MM月DD日 格式的日期
+            date_match = DATE_RE.search(line)
+            if date_match:
+                ret["开票日期"] = datetime.datetime.strptime(date_match.group(1), "%Y年%m月%d日").strftime("%Y-%m-%d")
+            else:
+                ret["开票日期"] = line
+        elif is_buyer:
+            ret["公司名称"] = line
+        if "售" in line and len(ret.get("开票方") or "") < 8:
+            ret["开票方"] = line
+        if ("销" in line) and len(ret.get("开票方") or "") < 8:
+            ret["开票方"] = line
+        
+
+    if len(ret.get("开票方") or "") < 8 and "公司名称" in ret:
+        ret["开票方"] = gongsi
+
+    if "开票方" in ret:
+        ret["开票方"] = ret["开票方"].replace("：", ":").rsplit(":", 1)[-1].strip()
+    if "公司名称" in ret:
+        del ret["公司名称"]
+    ret["购买方主体"] = entity
+    return ret, 'generic'
+
+
+def _new_trace(trace):
+    trace.update({'file_size': None, 'page_count': 0, 'pages': [], 'text_ms': 0.0,
+                  'parse_ms': 0.0, 'parser': None, 'fields': [], 'error': None})
+
+
+def _finish_trace(trace, ret, start):
+    trace['fields'] = sorted(ret)
+    trace['text_ms'] = round(trace['text_ms'], 2)
+    trace['parse_ms'] = round(trace['parse_ms'], 2)
+    trace['total_ms'] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def extract_pdf_info(pdf_path, company_name, trace=None):
     """
     提取单个PDF文件的信息
     
     Args:
         pdf_path: PDF文件路径
-        company_name: 公司名称关键词
+        company_name: 公司名称关键词或 buyers.BuyerMatcher（同 parse_page_text）
+        trace: 可选的字典，传入时写入提取过程记录：
+            file_size, page_count, pages（每页 page/chars/text_ms），text_ms, parse_ms,
+            total_ms, parser（huochepiao/generic，未匹配为 None），fields, error
     
     Returns:
         dict: 提取到的信息字典，包含发票号码、开票日期、开票方、价税合计等
     """
+    # pdfplumber/pdfminer 导入较慢，只在真正解析PDF时导入
+    import pdfplumber
+    
+    if trace is None:
+        trace = {}
+    _new_trace(trace)
+    start = time.perf_counter()
     ret = {}
     try:
+        trace['file_size'] = os.path.getsize(pdf_path)
         with pdfplumber.open(pdf_path) as pdf:
+            trace['page_count'] = len(pdf.pages)
             # 读取所有页面的文本
             for page_num, page in enumerate(pdf.pages, 1):
+                page_start = time.perf_counter()
                 text = page.extract_text()
+                text_ms = (time.perf_counter() - page_start) * 1000
+                trace['pages'].append({'page': page_num, 'chars': len(text or ''), 'text_ms': round(text_ms, 2)})
+                trace['text_ms'] += text_ms
                 if not text:
                     continue
-                text = text.replace("(", "（").replace(")", "）")
-                text = text.replace(" ", "")
-                gongsi = ""
-                if company_name in text:
-                    if "电子客票号" in text:
-                        return get_huochepiao(text)
-                        
-                    lines = text.split("\n")
-                    for line in lines:
-                        if "公司" in line and company_name not in line:
-                            gongsi = line
-                        if "价税合计" in line:
-                            # 提取 ¥23.40 格式的金额（两位小数）
-                            amount_match = re.search(r'¥(\d+\.\d{2})', line)
-                            if amount_match:
-                                ret["价税合计"] = int(float(amount_match.group(1))*100)
-                            else:
-                                ret["价税合计"] = line
-                        elif "发票号码" in line:
-                            # 提取至少10位连续数字
-                            invoice_match = re.search(r'(\d{10,})', line)
-                            if invoice_match:
-                                ret["发票号码"] = invoice_match.group(1)
-                            else:
-                                ret["发票号码"] = line
-                        elif "开票日期" in line:
-                            # 提取 YYYY年MM月DD日 格式的日期
-                            date_match = re.search(r'(\d{4}年\d{1,2}月\d{1,2}日)', line)
-                            if date_match:
-                                ret["开票日期"] = datetime.datetime.strptime(date_match.group(1), "%Y年%m月%d日").strftime("%Y-%m-%d")
-                            else:
-                                ret["开票日期"] = line
-                        elif company_name in line:
-                            ret["公司名称"] = line
-                        if "售" in line and len(ret.get("开票方") or "") < 8:
-                            ret["开票方"] = line
-                        if ("销" in line) and len(ret.get("开票方") or "") < 8:
-                            ret["开票方"] = line
-                        
-
-                    if len(ret.get("开票方") or "") < 8 and "公司名称" in ret:
-                        ret["开票方"] = gongsi
-
-                    if "开票方" in ret:
-                        ret["开票方"] = ret["开票方"].replace("：", ":").rsplit(":", 1)[-1].strip()
-                    if "公司名称" in ret:
-                        del ret["公司名称"]                                               
+                parse_start = time.perf_counter()
+                ret, parser = parse_page_text(text, company_name)
+                if parser:
+                    trace['parser'] = parser
+                trace['parse_ms'] += (time.perf_counter() - parse_start) * 1000
                 if ret:  # 如果已经找到信息，不需要继续读取其他页面
                     break
     except Exception as e:
+        trace['error'] = f'{type(e).__name__}: {e}'[:500]
         print(f"读取文件出错: {pdf_path}, 错误: {e}")
+    _finish_trace(trace, ret, start)
     return ret
 
 
+def _extract_pages(args):
+    """
+    提取并解析连续的几页（进程池任务，每个任务单独打开文件）
+
+    Returns:
+        list: [(页码, 字符数, 文本耗时ms, 解析耗时ms, 信息字典, 解析分支, 规范化文本), ...]
+    """
+    import pdfplumber
+
+    pdf_path, company_name, first, last = args
+    results = []
+    with pdfplumber.open(pdf_path, pages=range(first, last + 1)) as pdf:
+        for page in pdf.pages:
+            page_num = page.page_number
+            page_start = time.perf_counter()
+            text = page.extract_text()
+            text_ms = (time.perf_counter() - page_start) * 1000
+            parse_start = time.perf_counter()
+            normalized = normalize_text(text) if text else ''
+            ret, parser = parse_page_text(normalized, company_name) if normalized else ({}, None)
+            parse_ms = (time.perf_counter() - parse_start) * 1000
+            results.append((page_num, len(text or ''), text_ms, parse_ms, ret, parser, normalized))
+            # 及时释放已解析页面的对象，长文档不会占用过多内存
+            page.flush_cache()
+    return results
+
+
+def _group_invoices(page_results):
+    """
+    按页合并为发票：出现新的发票号码的页开始一张发票，之后没有发票号码（或号码相同）的页属于这张发票
+
+    Returns:
+        list: 信息字典，附带 起始页、结束页、页面文本
+    """
+    invoices = []
+    seen = set()
+    partial = None
+    for page_num, _, _, _, ret, _, text in page_results:
+        number = ret.get("发票号码")
+        if number and number not in seen:
+            seen.add(number)
+            invoices.append(dict(ret, 起始页=page_num, 结束页=page_num, 页面文本=[text]))
+        elif invoices and (not number or number == invoices[-1]["发票号码"]):
+            invoices[-1]["结束页"] = page_num
+            invoices[-1]["页面文本"].append(text)
+        elif ret and partial is None:
+            partial = dict(ret, 起始页=page_num, 结束页=page_num, 页面文本=[text])
+    if not invoices and partial:
+        # 没有识别出发票号码时与 extract_pdf_info 相同，返回第一页有信息的结果
+        return [partial]
+    return invoices
+
+
+def extract_pdf_invoices(pdf_path, company_name, trace=None, executor=None):
+    """
+    提取PDF中的全部发票（火车票、平台开具的合并发票等一个文件多张发票，每页一张）
+
+    读取每一页，每个新的发票号码作为一张发票，记录所在的页码范围；
+    传入进程池时按 PAGES_PER_TASK 页一组并行提取（只有一两页的文件直接在当前进程提取）
+
+    Args:
+        pdf_path: PDF文件路径
+        company_name: 公司名称关键词或 buyers.BuyerMatcher（同 parse_page_text）
+        trace: 同 extract_pdf_info，另外写入 invoice_count（识别出的发票数）；
+            text_ms、parse_ms 为各页耗时之和，并行时可能大于 total_ms
+        executor: 可选的 concurrent.futures 进程池（见 page_executor）
+
+    Returns:
+        list: 每张发票的信息字典（同 extract_pdf_info），另有 起始页、结束页（从1开始）和 页面文本；
+        没有识别出任何信息时为空列表
+    """
+    import pdfplumber
+
+    if trace is None:
+        trace = {}
+    _new_trace(trace)
+    start = time.perf_counter()
+    invoices = []
+    try:
+        trace['file_size'] = os.path.getsize(pdf_path)
+        with pdfplumber.open(pdf_path) as pdf:
+            page_count = len(pdf.pages)
+        trace['page_count'] = page_count
+        chunks = [(pdf_path, company_name, first, min(first + PAGES_PER_TASK - 1, page_count))
+                  for first in range(1, page_count + 1, PAGES_PER_TASK)]
+        page_results = None
+        if executor is not None and len(chunks) > 1:
+            from concurrent.futures import BrokenExecutor
+            try:
+                page_results = [item for chunk in executor.map(_extract_pages, chunks) for item in chunk]
+            except BrokenExecutor as e:
+                # 子进程异常退出后进程池不能再用，丢弃后在当前进程提取
+                print(f"并行提取失败，改为顺序提取: {e}")
+                _discard_executor(executor)
+        if page_results is None:
+            page_results = [item for chunk in chunks for item in _extract_pages(chunk)]
+
+        for page_num, chars, text_ms, parse_ms, ret, parser, _ in page_results:
+            trace['pages'].append({'page': page_num, 'chars': chars, 'text_ms': round(text_ms, 2)})
+            trace['text_ms'] += text_ms
+            trace['parse_ms'] += parse_ms
+            if parser and trace['parser'] is None:
+                trace['parser'] = parser
+        invoices = _group_invoices(page_results)
+    except Exception as e:
+        trace['error'] = f'{type(e).__name__}: {e}'[:500]
+        print(f"读取文件出错: {pdf_path}, 错误: {e}")
+    trace['invoice_count'] = len(invoices)
+    _finish_trace(trace, {k: v for k, v in (invoices[0] if invoices else {}).items() if k not in PAGE_KEYS}, start)
+    return invoices
+
+
+def read_page_texts(source, first=1, last=None):
+    """
+    读取页面的规范化文本（为没有文本层的历史发票补充文本层时使用）
+
+    Args:
+        source: PDF文件路径或文件内容（bytes）
+        first, last: 页码范围（从1开始，last 为 None 时到最后一页）
+
+    Returns:
+        list: 每页的规范化文本
+    """
+    import io
+    import pdfplumber
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with pdfplumber.open(source) as pdf:
+        pages = pdf.pages[first - 1:last]
+        return [normalize_text(page.extract_text() or '') for page in pages]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def page_executor(workers):
+    """
+    多页PDF并行提取用的进程池，第一次调用时创建，之后复用；workers 小于 2 时为 None（在当前进程提取）
+
+    使用 spawn 启动子进程：gunicorn 的 worker 是多线程的，fork 出的子进程可能继承被其他线程持有的锁
+    """
+    global _executor
+    if not workers or workers < 2:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=warm_up,
+            )
+        return _executor
+
+
+def _discard_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
 if __name__ == "__main__":        
     # 单独提取某个文件的信息
     single_file = r"D:\winuserfile\document\fapiao\21101023.pdf"
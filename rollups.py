@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""报销金额汇总表维护
+按 (开票月份, 报销类型, 报销人, 申请状态, 购买方主体) 维护发票数量和金额，
+财务报表直接读取汇总表，不再扫描全部发票明细
+
+维护方式：修改前减去受影响明细的贡献，修改后再加回来，
+两步都是一条 INSERT ... SELECT ... GROUP BY ... ON CONFLICT DO UPDATE 语句，
+与业务修改在同一个事务中提交
+"""
+from contextlib import contextmanager
+
+from sqlalchemy import select, delete, func, literal
+
+from models import db, InvoiceApplication, InvoiceDetail, SpendRollup
+
+# 报表支持的分组维度（没有报销类型的明细与搜索、汇总页面一致显示为“未分类”）
+GROUP_COLUMNS = {
+    'month': SpendRollup.month,
+    'type': func.coalesce(func.nullif(SpendRollup.reimbursement_type, ''), '未分类'),
+    'person': SpendRollup.reimbursement_person,
+    'status': SpendRollup.status,
+    'entity': SpendRollup.buyer_entity,
+}
+
+_KEY_COLUMNS = ['month', 'reimbursement_type', 'reimbursement_person', 'status', 'buyer_entity']
+
+
+def _month_expr(dialect):
+    """开票日期转换为 YYYY-MM 的 SQL 表达式"""
+    if dialect == 'postgresql':
+        month = func.to_char(InvoiceDetail.invoice_date, 'YYYY-MM')
+    elif dialect == 'mysql':
+        month = func.date_format(InvoiceDetail.invoice_date, '%Y-%m')
+    else:
+        month = func.strftime('%Y-%m', InvoiceDetail.invoice_date)
+    return func.coalesce(month, '')
+
+
+def _contribution_select(sign, dialect, app_ids=None, detail_ids=None):
+    """按汇总键分组的明细贡献（sign 为 1 或 -1）"""
+    month = _month_expr(dialect)
+    rtype = func.coalesce(InvoiceDetail.reimbursement_type, '')
+    person = func.coalesce(InvoiceApplication.reimbursement_person, '')
+    status = func.coalesce(InvoiceApplication.status, '')
+    entity = func.coalesce(InvoiceDetail.buyer_entity, '')
+    stmt = (
+        select(
+            month, rtype, person, status, entity,
+            func.count(InvoiceDetail.id) * literal(sign),
+            func.coalesce(func.sum(InvoiceDetail.amount), 0) * literal(sign),
+        )
+        .join(InvoiceApplication, InvoiceDetail.application_id == InvoiceApplication.id)
+        .group_by(month, rtype, person, status, entity)
+    )
+    if app_ids is not None:
+        stmt = stmt.where(InvoiceDetail.application_id.in_(app_ids))
+    if detail_ids is not None:
+        stmt = stmt.where(InvoiceDetail.id.in_(detail_ids))
+    return stmt
+
+
+def apply_rollup_delta(sign, app_ids=None, detail_ids=None):
+    """
+    把指定申请（或指定明细）的当前数据加到汇总表（sign=1）或从汇总表减去（sign=-1）
+
+    Args:
+        sign: 1 或 -1
+        app_ids: 申请ID列表
+        detail_ids: 发票明细ID列表
+    """
+    if app_ids is not None:
+        app_ids = list(set(app_ids))
+        if not app_ids:
+            return
+    if detail_ids is not None:
+        detail_ids = list(set(detail_ids))
+        if not detail_ids:
+            return
+
+    dialect = db.session.get_bind().dialect.name
+    source = _contribution_select(sign, dialect, app_ids, detail_ids)
+    columns = _KEY_COLUMNS + ['invoice_count', 'total_amount']
+
+    with db.session.no_autoflush:
+        if dialect in ('sqlite', 'postgresql'):
+            if dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(SpendRollup).from_select(columns, source)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=_KEY_COLUMNS,
+                set_={
+                    'invoice_count': SpendRollup.invoice_count + stmt.excluded.invoice_count,
+                    'total_amount': SpendRollup.total_amount + stmt.excluded.total_amount,
+                },
+            )
+            db.session.execute(stmt)
+        else:
+            # 其他数据库：逐个汇总键更新（受影响的键通常只有几个）
+            for row in db.session.execute(source).all():
+                size = len(_KEY_COLUMNS)
+                key = dict(zip(_KEY_COLUMNS, row[:size]))
+                rollup = SpendRollup.query.filter_by(**key).first()
+                if rollup is None:
+                    rollup = SpendRollup(invoice_count=0, total_amount=0, **key)
+                    db.session.add(rollup)
+                rollup.invoice_count += row[size]
+                rollup.total_amount += row[size + 1]
+            db.session.flush()
+
+        if sign < 0:
+            db.session.execute(delete(SpendRollup).where(SpendRollup.invoice_count <= 0))
+
+
+@contextmanager
+def track_rollups(app_ids=None, detail_ids=None):
+    """
+    在修改明细或申请前后维护汇总表
+
+    用法：
+        with track_rollups(app_ids=[application.id]):
+            application.status = '已提交'
+        db.session.commit()
+    """
+    apply_rollup_delta(-1, app_ids, detail_ids)
+    yield
+    db.session.flush()
+    apply_rollup_delta(1, app_ids, detail_ids)
+
+
+def rebuild_rollups():
+    """清空并从发票明细重新生成汇总表"""
+    db.session.execute(delete(SpendRollup))
+    dialect = db.session.get_bind().dialect.name
+    source = _contribution_select(1, dialect)
+    db.session.execute(
+        SpendRollup.__table__.insert().from_select(_KEY_COLUMNS + ['invoice_count', 'total_amount'], source)
+    )
+    db.session.commit()
+
+
+def ensure_rollups():
+    """汇总表为空但已有发票明细时（如升级后首次启动）重新生成"""
+    if db.session.query(SpendRollup.id).first() is None and db.session.query(InvoiceDetail.id).first() is not None:
+        rebuild_rollups()
+
+
+def query_spend_report(group_by, month_from=None, month_to=None, statuses=None, entities=None):
+    """
+    从汇总表查询报销金额
+
+    Args:
+        group_by: 分组维度列表，取值见 GROUP_COLUMNS
+        month_from: 起始月份 YYYY-MM（含）
+        month_to: 结束月份 YYYY-MM（含）
+        statuses: 申请状态列表
+        entities: 购买方主体列表
+
+    Returns:
+        list: 每行包含分组维度、invoice_count 和 total_amount（分）
+    """
+    columns = [GROUP_COLUMNS[name].label(name) for name in group_by]
+    stmt = select(
+        *columns,
+        func.sum(SpendRollup.invoice_count).label('invoice_count'),
+        func.sum(SpendRollup.total_amount).label('total_amount'),
+    )
+    if month_from:
+        stmt = stmt.where(SpendRollup.month >= month_from)
+    if month_to:
+        stmt = stmt.where(SpendRollup.month <= month_to)
+    if statuses:
+        stmt = stmt.where(SpendRollup.status.in_(statuses))
+    if entities:
+        stmt = stmt.where(SpendRollup.buyer_entity.in_(entities))
+    if columns:
+        stmt = stmt.group_by(*columns).order_by(*columns)
+    return db.session.execute(stmt).all()
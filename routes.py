@@ -2,15 +2,49 @@
 """额外的路由模块，包含发票明细管理、搜索、文件操作等
 这些路由需要在 app.py 中导入并注册
 """
-from flask import request, jsonify, send_file, flash, redirect, url_for, render_template
+from flask import request, jsonify, send_file, flash, redirect, url_for, render_template, Response, stream_with_context, abort
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 from datetime import datetime
+from decimal import Decimal
+from urllib.parse import quote
 from sqlalchemy import or_, and_, func
+from sqlalchemy.exc import OperationalError
 import os
+import json
+import mimetypes
 
 from models import db, InvoiceApplication, InvoiceDetail
-from readpdftxt import extract_pdf_info
+from db_engine import run_write, is_database_locked
+from invoice_ops import (load_bulk_targets, bulk_retype, bulk_delete, bulk_move,
+                        insert_invoice_detail, update_invoice_file, find_near_duplicate)
+from issuers import normalize_issuer, note_issuer, issuer_index, refresh_issuer_index, refresh_issuer_index_async
+from readpdftxt import extract_pdf_invoices, page_executor
+from metrics import timed_stage, render_metrics
+from extraction_traces import record_extraction_trace
+from previews import preview_cache, VARIANTS
+from archive import is_archive_url, open_member
+from storage import get_storage, url_to_key, local_copy, temp_path
+from buyers import get_buyers
+from lifecycle import remove_files
+from text_layer import save_text_layer
+from events import record_application_event
+from exporter import iter_csv, iter_xlsx
+from rollups import track_rollups, query_spend_report, GROUP_COLUMNS
+
+# 申请发票明细分页接口允许的排序字段
+DETAIL_SORT_COLUMNS = {
+    'filename': InvoiceDetail.filename,
+    'invoice_number': InvoiceDetail.invoice_number,
+    'invoice_date': InvoiceDetail.invoice_date,
+    'issuer': InvoiceDetail.issuer,
+    'amount': InvoiceDetail.amount,
+    'reimbursement_type': InvoiceDetail.reimbursement_type,
+    'created_at': InvoiceDetail.created_at,
+}
+DETAIL_PAGE_SIZE = 50
+DETAIL_MAX_PAGE_SIZE = 200
 
 def register_routes(app):
     """注册额外的路由"""
@@ -48,64 +82,119 @@ def register_routes(app):
                 filename = file.filename.replace("..", "").replace("/", "").replace("\\", "").replace("<", "").replace(">", "")
                 timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
                 unique_filename = f"{timestamp}_{filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'invoices', unique_filename)
-                file.save(filepath)
+                file_url = f"/uploads/invoices/{unique_filename}"
+                # 先保存到本机临时文件提取信息，再交给存储后端
+                filepath = temp_path(os.path.splitext(filename)[1])
+                try:
+                    file.save(filepath)
+                    
+                    # 提取PDF信息（火车票等一个文件多张发票时逐页并行提取）
+                    trace = {}
+                    with timed_stage('extract_pdf'):
+                        invoices = extract_pdf_invoices(
+                            filepath, get_buyers(), trace=trace,
+                            executor=page_executor(app.config['PDF_PAGE_WORKERS'])
+                        )
+                    pdf_info = invoices[0] if invoices else {}
+                    
+                    # 预先生成缩略图，编辑页刷新后直接显示（其余发票所在页的缩略图在第一次访问时生成）
+                    with timed_stage('render_preview'):
+                        preview_cache.get(filepath, 'thumb', url=file_url, page=pdf_info.get('起始页', 1))
+                    
+                    get_storage().put_file(f"invoices/{unique_filename}", filepath, move=True)
+                finally:
+                    if os.path.exists(filepath):
+                        os.remove(filepath)
                 
-                # 提取PDF信息
-                pdf_info = extract_pdf_info(filepath, app.config['COMPANY_NAME_KEYWORD'])
+                def record_trace():
+                    record_extraction_trace(
+                        trace, pdf_info, threshold_ms=app.config['EXTRACTION_SLOW_MS'],
+                        filename=filename, file_url=file_url,
+                        source='upload', user_id=current_user.id
+                    )
                 
-                if not pdf_info or '发票号码' not in pdf_info:
+                recognized = [info for info in invoices if '发票号码' in info]
+                if not recognized:
+                    def save_trace():
+                        record_trace()
+                        db.session.commit()
+                    
+                    run_write(save_trace)
                     return jsonify({
                         'success': False, 
                         'message': '无法提取发票信息，请手动填写',
-                        'file_url': f"/uploads/invoices/{unique_filename}",
+                        'file_url': file_url,
                         'filename': filename
                     }), 200
                 
-                # 检查发票号码是否已存在
-                existing = InvoiceDetail.query.filter_by(invoice_number=pdf_info['发票号码']).first()
-                if existing:
-                    # 更新现有记录的文件名和文件URL
-                    existing.filename = filename
-                    existing.file_url = f"/uploads/invoices/{unique_filename}"
+                def parse_date(info):
+                    try:
+                        return datetime.strptime(info['开票日期'], '%Y-%m-%d').date()
+                    except (KeyError, ValueError):
+                        return None
+                
+                def save_details():
+                    record_trace()
+                    # 每张发票一条明细，共用同一个文件，各自记录所在页
+                    saved = []
+                    updated = []
+                    for info in recognized:
+                        # 一条 INSERT ... ON CONFLICT 完成排重和插入
+                        detail, inserted = insert_invoice_detail(
+                            invoice_number=info['发票号码'],
+                            invoice_date=parse_date(info),
+                            issuer=info.get('开票方', ''),
+                            amount=info.get('价税合计', 0),
+                            file_url=file_url,
+                            filename=filename,
+                            application_id=application.id,
+                            page_start=info['起始页'],
+                            page_end=info['结束页'],
+                            buyer_entity=info.get('购买方主体')
+                        )
+                        if inserted:
+                            saved.append(detail.to_dict())
+                            save_text_layer(info, detail.id)
+                        else:
+                            # 发票号码已存在：更新现有记录的文件名和文件URL
+                            update_invoice_file(info['发票号码'], file_url, filename, info['起始页'], info['结束页'])
+                            save_text_layer(info)
+                            updated.append(info['发票号码'])
+                    if saved and application.status == '已提交':
+                        record_application_event(application.id, 'updated')
                     db.session.commit()
-                    
+                    return saved, updated
+                
+                saved, updated = run_write(save_details)
+                if not saved:
+                    message = (f"发票号码 {updated[0]} 已存在，已更新文件" if len(updated) == 1
+                               else f"文件中的 {len(updated)} 张发票均已存在，已更新文件")
                     return jsonify({
                         'success': False, 
-                        'message': f"发票号码 {pdf_info['发票号码']} 已存在，已更新文件",
+                        'message': message,
                         'filename': filename
                     }), 400
                 
-                # 创建发票明细
-                invoice_date = None
-                if '开票日期' in pdf_info:
-                    try:
-                        invoice_date = datetime.strptime(pdf_info['开票日期'], '%Y-%m-%d').date()
-                    except:
-                        pass
-                
-                detail = InvoiceDetail(
-                    invoice_number=pdf_info.get('发票号码', ''),
-                    invoice_date=invoice_date,
-                    issuer=pdf_info.get('开票方', ''),
-                    amount=pdf_info.get('价税合计', 0),
-                    file_url=f"/uploads/invoices/{unique_filename}",
-                    filename=filename,
-                    application_id=app_id
-                )
-                db.session.add(detail)
-                
-                # 更新申请表统计
-                application.update_totals()
-                db.session.commit()
-                
+                message = '上传成功'
+                if len(recognized) > 1:
+                    message += f'，文件包含 {len(recognized)} 张发票'
+                    if updated:
+                        message += f'（{len(updated)} 张已存在，已更新文件）'
+                if any(detail['duplicate_of_id'] for detail in saved):
+                    message += '（疑似重复发票，已提示财务核对）'
                 return jsonify({
                     'success': True, 
-                    'message': '上传成功',
+                    'message': message,
                     'filename': filename,
-                    'detail': detail.to_dict()
+                    'detail': saved[0],
+                    'details': saved
                 })
                 
+            except OperationalError as e:
+                db.session.rollback()
+                if is_database_locked(e):
+                    return jsonify({'success': False, 'message': '系统繁忙，请稍后重试'}), 503
+                return jsonify({'success': False, 'message': f'上传失败: {str(e)}'}), 500
             except Exception as e:
                 db.session.rollback()
                 return jsonify({'success': False, 'message': f'上传失败: {str(e)}'}), 500
@@ -123,6 +212,9 @@ def register_routes(app):
         if current_user.role == '普通用户' and application.user_id != current_user.id:
             return jsonify({'success': False, 'message': '没有权限'}), 403
         
+        if application.is_paid:
+            return jsonify({'success': False, 'message': '已付款的申请不能修改发票'}), 400
+        
         try:
             data = request.get_json()
             
@@ -131,16 +223,27 @@ def register_routes(app):
                 existing = InvoiceDetail.query.filter_by(invoice_number=data['invoice_number']).first()
                 if existing:
                     return jsonify({'success': False, 'message': '发票号码已存在'}), 400
-                detail.invoice_number = data['invoice_number']
             
-            if 'invoice_date' in data:
-                detail.invoice_date = datetime.strptime(data['invoice_date'], '%Y-%m-%d').date()
-            if 'issuer' in data:
-                detail.issuer = data['issuer']
-            if 'amount' in data:
-                detail.amount = int(float(data['amount']) * 100)  # 转换为分
-            if 'reimbursement_type' in data:
-                detail.reimbursement_type = data['reimbursement_type']
+            with track_rollups(detail_ids=[detail.id]):
+                if 'invoice_number' in data:
+                    detail.invoice_number = data['invoice_number']
+                if 'invoice_date' in data:
+                    detail.invoice_date = datetime.strptime(data['invoice_date'], '%Y-%m-%d').date()
+                if 'issuer' in data and data['issuer'] != detail.issuer:
+                    note_issuer(db.session, detail.issuer, -1)
+                    note_issuer(db.session, data['issuer'])
+                    detail.issuer = data['issuer']
+                if 'amount' in data:
+                    detail.amount = int(float(data['amount']) * 100)  # 转换为分
+                if 'reimbursement_type' in data:
+                    detail.reimbursement_type = data['reimbursement_type']
+            
+            # 开票方、金额或日期变化后重新检测近似重复
+            if {'issuer', 'amount', 'invoice_date'} & set(data):
+                detail.issuer_normalized = normalize_issuer(detail.issuer)
+                detail.duplicate_of_id = find_near_duplicate(
+                    detail.issuer_normalized, detail.amount, detail.invoice_date, exclude_id=detail.id
+                )
             
             # 更新申请表统计
             application.update_totals()
@@ -151,6 +254,27 @@ def register_routes(app):
             db.session.rollback()
             return jsonify({'success': False, 'message': f'更新失败: {str(e)}'}), 500
     
+    def load_authorized_targets(invoice_ids):
+        """批量操作的权限检查：一次联表查询，返回 (targets, 错误响应)"""
+        try:
+            invoice_ids = [int(i) for i in invoice_ids]
+        except (TypeError, ValueError):
+            return None, (jsonify({'success': False, 'message': '发票ID格式错误'}), 400)
+        
+        targets = load_bulk_targets(invoice_ids)
+        if not targets:
+            return None, (jsonify({'success': False, 'message': '未找到发票'}), 404)
+        
+        # 检查权限（检查所有发票是否属于用户有权限的申请）
+        if current_user.role == '普通用户' and any(row.user_id != current_user.id for row in targets):
+            return None, (jsonify({'success': False, 'message': '没有权限修改部分发票'}), 403)
+        
+        # 已付款申请的金额已经支付，不允许修改其中的发票
+        if any(row.is_paid for row in targets):
+            return None, (jsonify({'success': False, 'message': '已付款的申请不能修改发票'}), 400)
+        
+        return targets, None
+    
     @app.route('/invoice/batch_update', methods=['POST'])
     @login_required
     def batch_update_invoices():
@@ -166,24 +290,12 @@ def register_routes(app):
             if not reimbursement_type:
                 return jsonify({'success': False, 'message': '请选择报销类型'}), 400
             
-            # 获取所有发票并检查权限
-            details = InvoiceDetail.query.filter(InvoiceDetail.id.in_(invoice_ids)).all()
-            
-            if not details:
-                return jsonify({'success': False, 'message': '未找到发票'}), 404
-            
-            # 检查权限（检查所有发票是否属于用户有权限的申请）
-            for detail in details:
-                application = detail.application
-                if current_user.role == '普通用户' and application.user_id != current_user.id:
-                    return jsonify({'success': False, 'message': '没有权限修改部分发票'}), 403
+            targets, error = load_authorized_targets(invoice_ids)
+            if error:
+                return error
             
             # 批量更新
-            updated_count = 0
-            for detail in details:
-                detail.reimbursement_type = reimbursement_type
-                updated_count += 1
-            
+            updated_count = bulk_retype([row.id for row in targets], reimbursement_type)
             db.session.commit()
             
             return jsonify({
@@ -195,6 +307,74 @@ def register_routes(app):
             db.session.rollback()
             return jsonify({'success': False, 'message': f'批量更新失败: {str(e)}'}), 500
     
+    @app.route('/invoice/batch_delete', methods=['POST'])
+    @login_required
+    def batch_delete_invoices():
+        """批量删除发票明细"""
+        try:
+            data = request.get_json()
+            invoice_ids = data.get('invoice_ids', [])
+            
+            if not invoice_ids:
+                return jsonify({'success': False, 'message': '请选择至少一个发票'}), 400
+            
+            targets, error = load_authorized_targets(invoice_ids)
+            if error:
+                return error
+            
+            deleted_count = bulk_delete(targets)
+            db.session.commit()
+            
+            # 提交成功后再删除文件
+            remove_files([row.file_url for row in targets])
+            
+            return jsonify({
+                'success': True,
+                'message': f'成功删除 {deleted_count} 个发票',
+                'deleted_count': deleted_count
+            })
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': f'批量删除失败: {str(e)}'}), 500
+    
+    @app.route('/invoice/batch_move', methods=['POST'])
+    @login_required
+    def batch_move_invoices():
+        """批量移动发票明细到另一个申请"""
+        try:
+            data = request.get_json()
+            invoice_ids = data.get('invoice_ids', [])
+            target_app_id = data.get('target_application_id')
+            
+            if not invoice_ids:
+                return jsonify({'success': False, 'message': '请选择至少一个发票'}), 400
+            
+            target = db.session.get(InvoiceApplication, int(target_app_id)) if target_app_id else None
+            if not target:
+                return jsonify({'success': False, 'message': '目标申请不存在'}), 404
+            
+            if current_user.role == '普通用户' and target.user_id != current_user.id:
+                return jsonify({'success': False, 'message': '没有权限'}), 403
+            
+            if target.is_paid:
+                return jsonify({'success': False, 'message': '已付款的申请不能添加发票'}), 400
+            
+            targets, error = load_authorized_targets(invoice_ids)
+            if error:
+                return error
+            
+            moved_count = bulk_move(targets, target.id)
+            db.session.commit()
+            
+            return jsonify({
+                'success': True,
+                'message': f'成功移动 {moved_count} 个发票',
+                'moved_count': moved_count
+            })
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': f'批量移动失败: {str(e)}'}), 500
+    
     @app.route('/invoice/<int:detail_id>/delete', methods=['POST'])
     @login_required
     def delete_invoice(detail_id):
@@ -206,19 +386,22 @@ def register_routes(app):
         if current_user.role == '普通用户' and application.user_id != current_user.id:
             return jsonify({'success': False, 'message': '没有权限'}), 403
         
+        if application.is_paid:
+            return jsonify({'success': False, 'message': '已付款的申请不能修改发票'}), 400
+        
         try:
-            # 删除文件
-            if detail.file_url:
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], detail.file_url.replace('/uploads/', ''))
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            
-            db.session.delete(detail)
+            file_url = detail.file_url
+            with track_rollups(detail_ids=[detail.id]):
+                db.session.delete(detail)
+            note_issuer(db.session, detail.issuer, -1)
             
             # 更新申请表统计
             application.update_totals()
             db.session.commit()
             
+            # 提交成功后再删除文件
+            remove_files([file_url])
+            
             return jsonify({'success': True, 'message': '删除成功'})
         except Exception as e:
             db.session.rollback()
@@ -241,11 +424,6 @@ def register_routes(app):
         try:
             invoice_number = request.form.get('invoice_number')
             
-            # 检查发票号码唯一性
-            existing = InvoiceDetail.query.filter_by(invoice_number=invoice_number).first()
-            if existing:
-                return jsonify({'success': False, 'message': '发票号码已存在'}), 400
-            
             # 处理文件上传（可选）
             file_url = None
             original_filename = None
@@ -256,8 +434,7 @@ def register_routes(app):
                     filename = secure_filename(file.filename)
                     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
                     unique_filename = f"{timestamp}_{filename}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'invoices', unique_filename)
-                    file.save(filepath)
+                    get_storage().save(f"invoices/{unique_filename}", file.stream)
                     file_url = f"/uploads/invoices/{unique_filename}"
             
             # 创建发票明细
@@ -269,23 +446,41 @@ def register_routes(app):
             if request.form.get('amount'):
                 amount = int(float(request.form.get('amount')) * 100)
             
-            detail = InvoiceDetail(
-                invoice_number=invoice_number,
-                invoice_date=invoice_date,
-                issuer=request.form.get('issuer', ''),
-                amount=amount,
-                file_url=file_url,
-                filename=original_filename,
-                reimbursement_type=request.form.get('reimbursement_type'),
-                application_id=app_id
-            )
-            db.session.add(detail)
+            def save_detail():
+                # 一条 INSERT ... ON CONFLICT 完成唯一性检查和插入
+                detail, inserted = insert_invoice_detail(
+                    invoice_number=invoice_number,
+                    invoice_date=invoice_date,
+                    issuer=request.form.get('issuer', ''),
+                    amount=amount,
+                    file_url=file_url,
+                    filename=original_filename,
+                    reimbursement_type=request.form.get('reimbursement_type'),
+                    application_id=application.id
+                )
+                if not inserted:
+                    db.session.rollback()
+                    return None
+                
+                if application.status == '已提交':
+                    record_application_event(application.id, 'updated')
+                detail_dict = detail.to_dict()
+                db.session.commit()
+                return detail_dict
             
-            # 更新申请表统计
-            application.update_totals()
-            db.session.commit()
+            detail_dict = run_write(save_detail)
+            if detail_dict is None:
+                if file_url:
+                    get_storage().delete(url_to_key(file_url))
+                return jsonify({'success': False, 'message': '发票号码已存在'}), 400
             
-            return jsonify({'success': True, 'message': '添加成功', 'detail': detail.to_dict()})
+            message = '添加成功（疑似重复发票，已提示财务核对）' if detail_dict['duplicate_of_id'] else '添加成功'
+            return jsonify({'success': True, 'message': message, 'detail': detail_dict})
+        except OperationalError as e:
+            db.session.rollback()
+            if is_database_locked(e):
+                return jsonify({'success': False, 'message': '系统繁忙，请稍后重试'}), 503
+            return jsonify({'success': False, 'message': f'添加失败: {str(e)}'}), 500
         except Exception as e:
             db.session.rollback()
             return jsonify({'success': False, 'message': f'添加失败: {str(e)}'}), 500
@@ -311,7 +506,8 @@ def register_routes(app):
             if 'reimbursement_person' in data:
                 if not data['reimbursement_person'] or not data['reimbursement_person'].strip():
                     return jsonify({'success': False, 'message': '报销人不能为空'}), 400
-                application.reimbursement_person = data['reimbursement_person'].strip()
+                with track_rollups(app_ids=[application.id]):
+                    application.reimbursement_person = data['reimbursement_person'].strip()
             
             db.session.commit()
             
@@ -324,6 +520,85 @@ def register_routes(app):
             db.session.rollback()
             return jsonify({'success': False, 'message': f'更新失败: {str(e)}'}), 500
     
+    @app.route('/application/<int:app_id>/details')
+    @login_required
+    def application_details(app_id):
+        """
+        申请的发票明细（分页，编辑页按需加载）
+        
+        查询参数：
+            page / per_page: 页码（从1开始）和每页条数
+            sort / order: 排序字段（见 DETAIL_SORT_COLUMNS）和 asc/desc
+            q: 按发票号码、开票方、文件名模糊筛选
+            type: 按报销类型筛选，"未分类" 表示没有设置类型
+        
+        type_summary 是整个申请按报销类型的小计，由数据库聚合，不受分页和筛选影响
+        """
+        application = InvoiceApplication.query.get_or_404(app_id)
+        
+        # 权限检查
+        if current_user.role == '普通用户' and application.user_id != current_user.id:
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', DETAIL_PAGE_SIZE, type=int), 1), DETAIL_MAX_PAGE_SIZE)
+        sort = request.args.get('sort') or 'created_at'
+        if sort not in DETAIL_SORT_COLUMNS:
+            return jsonify({'success': False, 'message': f'不支持的排序字段：{sort}'}), 400
+        descending = request.args.get('order') == 'desc'
+        
+        query = InvoiceDetail.query.filter(InvoiceDetail.application_id == application.id)
+        keyword = (request.args.get('q') or '').strip()
+        if keyword:
+            pattern = f'%{keyword}%'
+            query = query.filter(or_(
+                InvoiceDetail.invoice_number.like(pattern),
+                InvoiceDetail.issuer.like(pattern),
+                InvoiceDetail.filename.like(pattern)
+            ))
+        rtype = request.args.get('type')
+        if rtype == '未分类':
+            query = query.filter(or_(InvoiceDetail.reimbursement_type.is_(None), InvoiceDetail.reimbursement_type == ''))
+        elif rtype:
+            query = query.filter(InvoiceDetail.reimbursement_type == rtype)
+        
+        column = DETAIL_SORT_COLUMNS[sort]
+        # 空值排在最后，相同值按ID保持稳定顺序
+        query = query.order_by(
+            column.is_(None),
+            column.desc() if descending else column.asc(),
+            InvoiceDetail.id.desc() if descending else InvoiceDetail.id.asc()
+        )
+        
+        total = query.order_by(None).count()
+        details = query.offset((page - 1) * per_page).limit(per_page).all()
+        
+        summary_rows = db.session.query(
+            InvoiceDetail.reimbursement_type,
+            func.count(InvoiceDetail.id),
+            func.coalesce(func.sum(InvoiceDetail.amount), 0)
+        ).filter(
+            InvoiceDetail.application_id == application.id
+        ).group_by(InvoiceDetail.reimbursement_type).all()
+        
+        type_summary = {}
+        for reimbursement_type, count, amount in summary_rows:
+            item = type_summary.setdefault(reimbursement_type or '未分类', {'count': 0, 'amount': 0})
+            item['count'] += count
+            item['amount'] += amount
+        
+        return jsonify({
+            'success': True,
+            'details': [detail.to_dict() for detail in details],
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'pages': (total + per_page - 1) // per_page,
+            'invoice_count': sum(item['count'] for item in type_summary.values()),
+            'total_amount': sum(item['amount'] for item in type_summary.values()) / 100,
+            'type_summary': {k: {'count': v['count'], 'amount': v['amount'] / 100} for k, v in type_summary.items()}
+        })
+    
     # ==================== 搜索功能 ====================
     
     @app.route('/search')
@@ -332,15 +607,23 @@ def register_routes(app):
         """搜索发票明细"""
         return render_template('search.html', reimbursement_types=InvoiceDetail.REIMBURSEMENT_TYPES)
     
-    @app.route('/api/search', methods=['POST'])
+    @app.route('/api/issuers/suggest')
     @login_required
-    def api_search():
-        """搜索API"""
-        data = request.get_json()
-        
-        # 构建查询
-        query = db.session.query(InvoiceDetail).join(InvoiceApplication)
+    def suggest_issuers():
+        """开票方自动补全（读取进程内的前缀索引，不查询数据库）"""
+        prefix = request.args.get('q', '').strip()
+        limit = request.args.get('limit', 10, type=int) or 10
         
+        if not issuer_index.built:
+            # 未经 warm_up 启动（如 flask run）时第一次请求建立索引
+            refresh_issuer_index()
+        elif issuer_index.stale:
+            refresh_issuer_index_async(app)
+        results = [{'issuer': name, 'count': count} for name, count in issuer_index.suggest(prefix, limit)]
+        return jsonify({'success': True, 'results': results})
+    
+    def build_search_filters(query, data):
+        """把搜索条件应用到已联接 InvoiceApplication 的查询上（搜索和导出共用）"""
         # 普通用户只能搜索自己的
         if current_user.role == '普通用户':
             query = query.filter(InvoiceApplication.user_id == current_user.id)
@@ -374,6 +657,21 @@ def register_routes(app):
         if data.get('reimbursement_types'):
             query = query.filter(InvoiceDetail.reimbursement_type.in_(data['reimbursement_types']))
         
+        # 只看疑似重复的发票
+        if data.get('suspected_duplicate'):
+            query = query.filter(InvoiceDetail.duplicate_of_id.isnot(None))
+        
+        return query
+    
+    @app.route('/api/search', methods=['POST'])
+    @login_required
+    def api_search():
+        """搜索API"""
+        data = request.get_json()
+        
+        # 构建查询
+        query = build_search_filters(db.session.query(InvoiceDetail).join(InvoiceApplication), data)
+        
         # 执行查询
         results = query.all()
         
@@ -397,13 +695,224 @@ def register_routes(app):
             'type_summary': {k: {'count': v['count'], 'amount': v['amount'] / 100} for k, v in type_summary.items()}
         })
     
+    @app.route('/api/search/export', methods=['POST'])
+    @login_required
+    def export_search():
+        """导出搜索结果（CSV/XLSX 流式输出，按报销类型分组并附小计）"""
+        try:
+            data = json.loads(request.form.get('filters') or '{}')
+        except ValueError:
+            return jsonify({'success': False, 'message': '搜索条件格式错误'}), 400
+        
+        export_format = request.form.get('format', 'csv')
+        if export_format not in ('csv', 'xlsx'):
+            return jsonify({'success': False, 'message': '不支持的导出格式'}), 400
+        
+        type_key = func.coalesce(InvoiceDetail.reimbursement_type, '')
+        query = db.session.query(
+            InvoiceDetail.invoice_number,
+            InvoiceDetail.invoice_date,
+            InvoiceDetail.issuer,
+            InvoiceDetail.amount,
+            InvoiceDetail.reimbursement_type,
+            InvoiceApplication.name.label('application_name'),
+            InvoiceApplication.reimbursement_person,
+            InvoiceApplication.status,
+        ).join(InvoiceApplication)
+        query = build_search_filters(query, data)
+        # 按类型排序，边读边输出小计；yield_per 使用服务端游标分批读取
+        query = query.order_by(type_key, InvoiceDetail.invoice_date, InvoiceDetail.id).yield_per(1000)
+        
+        def export_rows():
+            yield ['发票号码', '开票日期', '开票方', '价税合计（元）', '报销类型', '申请名称', '报销人', '状态']
+            
+            current_type = None
+            type_count = type_amount = 0
+            total_count = total_amount = 0
+            for row in query:
+                rtype = row.reimbursement_type or '未分类'
+                if current_type is not None and rtype != current_type:
+                    yield ['', '', f'{current_type} 小计（{type_count} 个）', Decimal(type_amount).scaleb(-2), current_type]
+                    type_count = type_amount = 0
+                current_type = rtype
+                amount = row.amount or 0
+                type_count += 1
+                type_amount += amount
+                total_count += 1
+                total_amount += amount
+                yield [
+                    row.invoice_number,
+                    row.invoice_date.strftime('%Y-%m-%d') if row.invoice_date else '',
+                    row.issuer,
+                    Decimal(amount).scaleb(-2),
+                    rtype,
+                    row.application_name,
+                    row.reimbursement_person,
+                    row.status,
+                ]
+            
+            if current_type is not None:
+                yield ['', '', f'{current_type} 小计（{type_count} 个）', Decimal(type_amount).scaleb(-2), current_type]
+            yield ['', '', f'合计（{total_count} 个）', Decimal(total_amount).scaleb(-2)]
+        
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        if export_format == 'xlsx':
+            body = iter_xlsx(export_rows())
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        else:
+            body = iter_csv(export_rows())
+            mimetype = 'text/csv'
+        
+        response = Response(stream_with_context(body), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(f'发票搜索结果_{timestamp}.{export_format}')}"
+        return response
+    
+    # ==================== 报表 ====================
+    
+    @app.route('/api/reports/spend')
+    @login_required
+    def api_spend_report():
+        """报销金额报表API（读取汇总表，按月份/类型/报销人/状态/购买方主体分组）"""
+        if current_user.role not in ['管理员', '财务']:
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        
+        group_by = [name for name in request.args.get('group_by', 'month,type').split(',') if name]
+        invalid = [name for name in group_by if name not in GROUP_COLUMNS]
+        if invalid:
+            return jsonify({'success': False, 'message': f"不支持的分组：{','.join(invalid)}"}), 400
+        
+        # 年份或月份范围（YYYY-MM）
+        year = request.args.get('year')
+        month_from = request.args.get('month_from') or (f'{year}-01' if year else None)
+        month_to = request.args.get('month_to') or (f'{year}-12' if year else None)
+        statuses = request.args.getlist('status')
+        entities = request.args.getlist('entity')
+        
+        rows = query_spend_report(group_by, month_from, month_to, statuses, entities)
+        
+        results = []
+        for row in rows:
+            item = {name: row[i] for i, name in enumerate(group_by)}
+            item['invoice_count'] = row.invoice_count or 0
+            item['amount'] = (row.total_amount or 0) / 100
+            results.append(item)
+        
+        return jsonify({
+            'success': True,
+            'group_by': group_by,
+            'results': results,
+            'total_count': sum(item['invoice_count'] for item in results),
+            'total_amount': sum(row.total_amount or 0 for row in rows) / 100
+        })
+    
+    # ==================== 运行指标 ====================
+    
+    @app.route('/metrics')
+    @login_required
+    def metrics():
+        """Prometheus 文本格式的运行指标（仅管理员）"""
+        if current_user.role != '管理员':
+            return jsonify({'success': False, 'message': '没有权限'}), 403
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+    
     # ==================== 文件操作 ====================
     
+    def cache_immutable(response):
+        """内容不变的文件允许浏览器长期缓存"""
+        response.cache_control.no_cache = None
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.max_age = app.config['UPLOAD_CACHE_MAX_AGE']
+        response.cache_control.immutable = True
+        return response
+    
+    def send_archive_member(member):
+        """发送归档中的文件，支持 ETag（内容哈希）、Last-Modified 和 Range 请求"""
+        response = Response(
+            wrap_file(request.environ, member),
+            mimetype=mimetypes.guess_type(member.name)[0] or 'application/octet-stream',
+            direct_passthrough=True
+        )
+        response.content_length = member.length
+        response.accept_ranges = 'bytes'
+        response.last_modified = member.mtime
+        response.set_etag(member.digest)
+        return response.make_conditional(request, accept_ranges=True, complete_length=member.length)
+    
     @app.route('/uploads/<path:filename>')
     @login_required
     def uploaded_file(filename):
-        """访问上传的文件"""
-        return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        """
+        访问上传的文件
+        
+        上传文件名都带时间戳或内容哈希，同一路径内容不变，允许浏览器长期缓存（private, immutable）；
+        send_file 负责 ETag/If-None-Match、Last-Modified 和 Range 请求。
+        UPLOAD_SERVE_MODE 为 x-accel / x-sendfile 时只做登录检查，文件交给前端代理发送；
+        已归档的文件（archive/...）总是由应用从归档文件的内存映射中发送；
+        使用对象存储时重定向到预签名的下载地址，文件内容不经过应用
+        """
+        file_url = '/uploads/' + filename
+        key = url_to_key(file_url)
+        if key is None:
+            abort(404)
+        
+        if is_archive_url(file_url):
+            member = open_member(app.config['UPLOAD_FOLDER'], key)
+            if member is None:
+                abort(404)
+            return cache_immutable(send_archive_member(member))
+        
+        storage = get_storage()
+        download_url = storage.download_url(key)
+        if download_url:
+            # 预签名地址有有效期，重定向本身不缓存
+            if not storage.exists(key):
+                abort(404)
+            return redirect(download_url)
+        
+        source = storage.local_path(key)
+        if source is None:
+            abort(404)
+        
+        mode = app.config['UPLOAD_SERVE_MODE']
+        if mode == 'x-accel':
+            # nginx：location <UPLOAD_ACCEL_PREFIX> { internal; alias <UPLOAD_FOLDER>/; }
+            response = Response(mimetype=mimetypes.guess_type(source)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + quote(filename)
+        elif mode == 'x-sendfile':
+            # Apache mod_xsendfile / lighttpd
+            response = Response(mimetype=mimetypes.guess_type(source)[0] or 'application/octet-stream')
+            response.headers['X-Sendfile'] = os.path.abspath(source)
+        else:
+            response = send_file(source, conditional=True, etag=True)
+        return cache_immutable(response)
+    
+    @app.route('/previews/<variant>/<path:filename>')
+    @login_required
+    def invoice_preview(variant, filename):
+        """
+        上传文件某一页（?page=N，默认第一页）的预览图（thumb 缩略图 / print 打印分辨率）
+        
+        第一次访问时渲染并写入缓存，之后直接发送缓存文件；预览图随源文件内容确定，允许浏览器长期缓存
+        """
+        file_url = '/uploads/' + filename
+        page = request.args.get('page', 1, type=int)
+        if variant not in VARIANTS or url_to_key(file_url) is None or page < 1:
+            abort(404)
+        
+        # 已知内容哈希时不需要读取（或从对象存储下载）源文件
+        preview_path = preview_cache.lookup(file_url, variant, page)
+        if preview_path is not None:
+            return cache_immutable(send_file(preview_path, conditional=True, etag=True))
+        
+        with local_copy(file_url) as source:
+            if source is None or preview_cache.contains(source):
+                abort(404)
+            preview_path = preview_cache.get(source, variant, url=file_url, page=page)
+            if preview_path is None:
+                abort(404)
+            # 在临时文件（对象存储下载的图片）删除前打开
+            return cache_immutable(send_file(preview_path, conditional=True, etag=True))
     
     @app.route('/application/<int:app_id>/generate_pdf', methods=['GET', 'POST'])
     @login_required
@@ -419,7 +928,8 @@ def register_routes(app):
             from pdf_generator import generate_reimbursement_pdf
             
             # 生成PDF
-            pdf_path = generate_reimbursement_pdf(application, app.config['UPLOAD_FOLDER'])
+            with timed_stage('generate_report'):
+                pdf_path = generate_reimbursement_pdf(application, app.config['UPLOAD_FOLDER'])
             
             return send_file(pdf_path, as_attachment=True, download_name=f"{application.name}_报销单.pdf")
         except Exception as e:
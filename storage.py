@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件存储
+发票、银行回单等上传文件通过存储后端读写，文件URL仍为 /uploads/<key>（key 如 invoices/xxx.pdf）：
+    local  保存在 UPLOAD_FOLDER 下（默认）
+    s3     保存在 S3 兼容的对象存储（AWS S3、MinIO 等，需要安装 boto3），
+           访问文件时重定向到预签名URL，文件内容不经过应用进程
+
+生成的报销单、预览图缓存和上传时的临时文件始终在本机的 UPLOAD_FOLDER 下
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from flask import current_app
+
+# 读写时的缓冲区大小
+CHUNK_SIZE = 1024 * 1024
+
+
+def url_to_key(file_url):
+    """/uploads/<key> 形式的文件URL转换为存储键，不是上传文件的URL时为 None"""
+    if not file_url or not file_url.startswith('/uploads/'):
+        return None
+    key = file_url[len('/uploads/'):]
+    # 与 safe_join 相同的规则，不允许跳出上传目录
+    parts = key.split('/')
+    if not key or key.startswith('/') or '\\' in key or '..' in parts or '' in parts:
+        return None
+    return key
+
+
+class LocalStorage:
+    """本地文件系统"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def local_path(self, key):
+        """文件的本地路径，不存在时为 None"""
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def save(self, key, stream):
+        """从文件对象流式写入"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+
+    def put_file(self, key, source_path, move=False):
+        """保存本地文件；move 为 True 时移动（同一文件系统内只是改名）"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if move:
+            shutil.move(source_path, path)
+        else:
+            shutil.copyfile(source_path, path)
+
+    def open(self, key):
+        """以二进制流读取"""
+        return open(self.path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        """删除文件，返回释放的字节数（文件不存在时为 0）"""
+        try:
+            path = self.path(key)
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def iter_files(self, prefix):
+        """prefix 目录下的文件 (key, 修改时间, 大小)"""
+        folder = self.path(prefix)
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                yield key, stat.st_mtime, stat.st_size
+
+    def download_url(self, key, filename=None):
+        """本地文件由应用发送，没有直接下载地址"""
+        return None
+
+
+class S3Storage:
+    """S3 兼容的对象存储"""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key=None, secret_key=None, presign_expires=300):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError('STORAGE_BACKEND=s3 需要安装 boto3：pip install boto3')
+        from botocore.config import Config as BotoConfig
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix and prefix.strip('/') else ''
+        self.presign_expires = presign_expires
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=BotoConfig(signature_version='s3v4', retries={'max_attempts': 5, 'mode': 'standard'}),
+        )
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def save(self, key, stream):
+        """流式上传（大文件自动分段上传）"""
+        self.client.upload_fileobj(stream, self.bucket, self._object_key(key))
+
+    def put_file(self, key, source_path, move=False):
+        self.client.upload_file(source_path, self.bucket, self._object_key(key))
+        if move:
+            os.remove(source_path)
+
+    def open(self, key):
+        """返回可按块读取的响应流"""
+        response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        return response['Body']
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def delete(self, key):
+        """删除对象，返回释放的字节数（对象不存在时为 0）"""
+        from botocore.exceptions import ClientError
+
+        try:
+            size = self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))['ContentLength']
+        except ClientError:
+            return 0
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        return size
+
+    def iter_files(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix.rstrip('/') + '/')):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['LastModified'].timestamp(), item['Size']
+
+    def download_url(self, key, filename=None):
+        """预签名的下载地址"""
+        import mimetypes
+        from urllib.parse import quote
+
+        params = {'Bucket': self.bucket, 'Key': self._object_key(key)}
+        content_type = mimetypes.guess_type(key)[0]
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if filename:
+            params['ResponseContentDisposition'] = f"inline; filename*=UTF-8''{quote(filename)}"
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.presign_expires)
+
+
+def create_storage(config):
+    """根据配置创建存储后端"""
+    backend = config.get('STORAGE_BACKEND') or 'local'
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        if not config.get('S3_BUCKET'):
+            raise RuntimeError('STORAGE_BACKEND=s3 需要设置 S3_BUCKET')
+        return S3Storage(
+            config['S3_BUCKET'],
+            prefix=config.get('S3_PREFIX') or '',
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            access_key=config.get('S3_ACCESS_KEY'),
+            secret_key=config.get('S3_SECRET_KEY'),
+            presign_expires=config.get('S3_PRESIGN_EXPIRES', 300),
+        )
+    raise RuntimeError(f'不支持的存储后端：{backend}')
+
+
+def init_storage(app):
+    app.extensions['storage'] = create_storage(app.config)
+
+
+def get_storage():
+    """当前应用的存储后端（需在应用上下文中调用）"""
+    return current_app.extensions['storage']
+
+
+def temp_path(suffix=''):
+    """本机临时文件路径（位于 UPLOAD_FOLDER/tmp，与本地存储在同一文件系统，保存时只需改名）"""
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=folder)
+    os.close(fd)
+    return path
+
+
+@contextmanager
+def local_copy(file_url):
+    """
+    文件URL对应的本地文件，用于PDF解析和渲染
+
+    本地存储直接返回路径；已归档的文件返回 archive.ArchiveMember；对象存储下载到临时文件，退出时删除
+
+    Yields:
+        str、ArchiveMember 或 None（文件不存在）
+    """
+    from archive import is_archive_url, open_member
+
+    key = url_to_key(file_url)
+    if key is None:
+        yield None
+        return
+    if is_archive_url(file_url):
+        yield open_member(current_app.config['UPLOAD_FOLDER'], key)
+        return
+
+    storage = get_storage()
+    if isinstance(storage, LocalStorage):
+        yield storage.local_path(key)
+        return
+
+    path = temp_path(os.path.splitext(key)[1])
+    try:
+        try:
+            with storage.open(key) as stream, open(path, 'wb') as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        except Exception as e:
+            print(f"下载文件失败 {key}: {e}")
+            yield None
+            return
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
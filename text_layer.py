@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+发票文本层
+上传或导入发票时，把发票所在页的规范化文本压缩保存到 invoice_texts（每条明细一行）。
+修正 readpdftxt 的解析规则后，只对保存的文本重新解析，不需要再用 pdfplumber 读取PDF：
+
+    flask reparse-invoices                  # 生成差异文件，不修改数据库
+    flask reparse-invoices --apply          # 写回有变化的字段
+    flask reparse-invoices --backfill       # 先为没有文本层的历史发票读取一次PDF
+
+写回时只修改仍等于上次解析结果的字段；手工修改过的字段保留，并在差异文件中单独列出；
+已付款申请的发票默认不修改（金额已经支付），变化同样列为保留，加 --include-paid 时才写回
+"""
+import json
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from sqlalchemy import select, update, func
+
+from models import db, InvoiceApplication, InvoiceDetail, InvoiceText
+from invoice_ops import refresh_application_totals
+from issuers import normalize_issuer, note_issuer
+from readpdftxt import parse_page_text, read_page_texts
+from rollups import track_rollups
+
+# 页之间的分隔符（规范化文本中不会出现）
+PAGE_SEPARATOR = '\f'
+# 明细列 -> 解析结果中的键
+FIELDS = {'issuer': '开票方', 'invoice_date': '开票日期', 'amount': '价税合计', 'buyer_entity': '购买方主体'}
+# 每个进程池任务解析的明细数
+CHUNK_SIZE = 200
+
+
+def compress_pages(pages):
+    return zlib.compress(PAGE_SEPARATOR.join(pages).encode('utf-8'), 6)
+
+
+def decompress_pages(content):
+    return zlib.decompress(content).decode('utf-8').split(PAGE_SEPARATOR)
+
+
+def field_values(info):
+    """解析结果转换为明细列的值（与上传时写入的值一致，日期为 YYYY-MM-DD 字符串）"""
+    invoice_date = info.get('开票日期')
+    try:
+        invoice_date = date.fromisoformat(invoice_date).isoformat() if invoice_date else None
+    except ValueError:
+        invoice_date = None
+    amount = info.get('价税合计', 0)
+    return {
+        'issuer': info.get('开票方', ''),
+        'invoice_date': invoice_date,
+        'amount': amount if isinstance(amount, int) else 0,
+        'buyer_entity': info.get('购买方主体'),
+    }
+
+
+def _current_values(row):
+    return {
+        'issuer': row.issuer or '',
+        'invoice_date': row.invoice_date.isoformat() if row.invoice_date else None,
+        'amount': row.amount or 0,
+        'buyer_entity': row.buyer_entity,
+    }
+
+
+def text_layer_row(detail_id, info):
+    """
+    invoice_texts 的一行
+
+    Args:
+        detail_id: 明细ID
+        info: extract_pdf_invoices 返回的信息字典（含 页面文本）
+
+    Returns:
+        dict；没有页面文本时为 None
+    """
+    pages = info.get('页面文本')
+    if not pages:
+        return None
+    return {
+        'detail_id': detail_id,
+        'content': compress_pages(pages),
+        'fields': json.dumps(field_values(info), ensure_ascii=False),
+    }
+
+
+def save_text_layer(info, detail_id=None):
+    """保存（或替换）一条明细的文本层，detail_id 为空时按发票号码查找明细（需在应用上下文中调用）"""
+    if detail_id is None:
+        detail_id = db.session.scalar(
+            select(InvoiceDetail.id).where(InvoiceDetail.invoice_number == info.get('发票号码'))
+        )
+    row = text_layer_row(detail_id, info) if detail_id else None
+    if row is not None:
+        db.session.merge(InvoiceText(**row))
+
+
+def _reparse_batch(args):
+    """
+    进程池任务：重新解析一批明细的文本
+
+    每条明细取发票号码与明细相同的页的解析结果，没有时取第一个没有发票号码的结果（同 extract_pdf_info）
+
+    Returns:
+        list: [(明细ID, 字段值), ...]，无法解析时字段值为 None
+    """
+    company_name, rows = args
+    results = []
+    for detail_id, invoice_number, content in rows:
+        matched = None
+        fallback = None
+        for text in decompress_pages(content):
+            if not text:
+                continue
+            ret, _ = parse_page_text(text, company_name)
+            if not ret:
+                continue
+            if ret.get('发票号码') == invoice_number:
+                matched = ret
+                break
+            if fallback is None and '发票号码' not in ret:
+                fallback = ret
+        info = matched or fallback
+        results.append((detail_id, field_values(info) if info else None))
+    return results
+
+
+def _compare(row, values):
+    """
+    比较重新解析的值与当前值
+
+    Returns:
+        tuple: (changes, kept)，均为 {列: [当前值, 解析值]}；kept 为手工修改过、不写回的字段
+    """
+    baseline = json.loads(row.fields) if row.fields else None
+    current = _current_values(row)
+    changes = {}
+    kept = {}
+    for field in FIELDS:
+        if values[field] == current[field]:
+            continue
+        # 没有上次解析结果（补充的历史发票、后来新增的字段）时视为未手工修改
+        if baseline is None or field not in baseline or current[field] == baseline[field]:
+            changes[field] = [current[field], values[field]]
+        else:
+            kept[field] = [current[field], values[field]]
+    return changes, kept
+
+
+def _apply(rows, parsed, changed, skipped=()):
+    """写回一批明细的变化，并把解析结果记为新的基准（skipped 中的明细未写回，保留原来的基准）"""
+    updates = []
+    for detail_id, changes in changed.items():
+        values = {'id': detail_id}
+        for field, (_, new) in changes.items():
+            values[field] = date.fromisoformat(new) if field == 'invoice_date' and new else new
+        if 'issuer' in changes:
+            values['issuer_normalized'] = normalize_issuer(values['issuer'])
+            note_issuer(db.session, changes['issuer'][0], -1)
+            note_issuer(db.session, values['issuer'])
+        updates.append(values)
+    if updates:
+        with track_rollups(detail_ids=list(changed)):
+            db.session.execute(update(InvoiceDetail), updates)
+        refresh_application_totals({row.application_id for row in rows
+                                    if 'amount' in changed.get(row.id, {})})
+
+    baselines = []
+    for row in rows:
+        values = parsed.get(row.id)
+        if row.id in skipped:
+            continue
+        if values is not None and (not row.fields or json.loads(row.fields) != values):
+            baselines.append({'b_id': row.id, 'b_fields': json.dumps(values, ensure_ascii=False)})
+    if baselines:
+        table = InvoiceText.__table__
+        db.session.execute(
+            table.update().where(table.c.detail_id == db.bindparam('b_id')).values(fields=db.bindparam('b_fields')),
+            baselines
+        )
+
+
+def reparse_invoices(company_name, apply=False, output=None, workers=None, batch_size=5000, progress=print,
+                     include_paid=False):
+    """
+    用保存的文本层重新解析全部发票（需在应用上下文中调用）
+
+    按ID分批读取，每批分成 CHUNK_SIZE 条一组在进程池中解析；有变化的明细写入差异文件（每行一个JSON：
+    id、invoice_number、application_id、is_paid、changes、kept），apply 为 True 时同时写回，每批提交一次
+
+    Args:
+        company_name: 公司名称关键词或 buyers.BuyerMatcher（同 parse_page_text）
+        apply: 是否写回
+        output: 差异文件路径，为空时不写
+        workers: 解析进程数
+        batch_size: 每批读取的明细数
+        progress: 进度输出函数
+        include_paid: 是否修改已付款申请的发票（默认不修改，变化列为 kept）
+
+    Returns:
+        dict: scanned（重新解析的明细数）、changed（有字段写回/待写回的明细数）、
+            kept（有手工修改字段被保留的明细数）、failed（无法解析的明细数）
+    """
+    counts = {'scanned': 0, 'changed': 0, 'kept': 0, 'failed': 0}
+    out = open(output, 'w', encoding='utf-8') if output else None
+    last_id = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                rows = db.session.execute(
+                    select(
+                        InvoiceDetail.id, InvoiceDetail.invoice_number, InvoiceDetail.application_id,
+                        InvoiceDetail.issuer, InvoiceDetail.invoice_date, InvoiceDetail.amount,
+                        InvoiceDetail.buyer_entity, InvoiceApplication.is_paid,
+                        InvoiceText.content, InvoiceText.fields,
+                    )
+                    .join(InvoiceText, InvoiceText.detail_id == InvoiceDetail.id)
+                    .join(InvoiceApplication, InvoiceApplication.id == InvoiceDetail.application_id)
+                    .where(InvoiceDetail.id > last_id)
+                    .order_by(InvoiceDetail.id)
+                    .limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                tasks = [(company_name, [(row.id, row.invoice_number, row.content) for row in rows[i:i + CHUNK_SIZE]])
+                         for i in range(0, len(rows), CHUNK_SIZE)]
+                parsed = dict(item for chunk in pool.map(_reparse_batch, tasks) for item in chunk)
+
+                changed = {}
+                skipped = set()
+                for row in rows:
+                    values = parsed[row.id]
+                    if values is None:
+                        counts['failed'] += 1
+                        continue
+                    changes, kept = _compare(row, values)
+                    if changes and row.is_paid and not include_paid:
+                        kept.update(changes)
+                        changes = {}
+                        skipped.add(row.id)
+                    if changes:
+                        counts['changed'] += 1
+                        changed[row.id] = changes
+                    if kept:
+                        counts['kept'] += 1
+                    if out and (changes or kept):
+                        out.write(json.dumps({
+                            'id': row.id, 'invoice_number': row.invoice_number,
+                            'application_id': row.application_id, 'is_paid': bool(row.is_paid),
+                            'changes': changes, 'kept': kept,
+                        }, ensure_ascii=False) + '\n')
+                counts['scanned'] += len(rows)
+
+                if apply:
+                    _apply(rows, parsed, changed, skipped)
+                    db.session.commit()
+                else:
+                    # 只读，释放读事务
+                    db.session.rollback()
+                progress(f"已解析 {counts['scanned']}，有变化 {counts['changed']}")
+    finally:
+        if out:
+            out.close()
+    return counts
+
+
+def _read_texts(args):
+    """进程池任务：读取一条明细所在页的文本"""
+    detail_id, source, first, last = args
+    try:
+        return detail_id, read_page_texts(source, first, last)
+    except Exception as e:
+        print(f"读取文件出错: 明细 {detail_id}, 错误: {e}")
+        return detail_id, None
+
+
+def backfill_text_layers(workers=None, batch_size=200, progress=print):
+    """
+    为没有文本层的PDF发票读取一次文件补充文本层（需在应用上下文中调用）
+
+    历史发票不知道当时的解析结果（fields 为空），重新解析时其字段视为未手工修改
+
+    Returns:
+        dict: filled（补充的明细数）、failed（文件不存在或无法读取的明细数）
+    """
+    from contextlib import ExitStack
+    from storage import local_copy
+
+    counts = {'filled': 0, 'failed': 0}
+    last_id = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = db.session.execute(
+                select(InvoiceDetail.id, InvoiceDetail.file_url, InvoiceDetail.page_start, InvoiceDetail.page_end)
+                .outerjoin(InvoiceText, InvoiceText.detail_id == InvoiceDetail.id)
+                .where(
+                    InvoiceText.detail_id.is_(None),
+                    InvoiceDetail.id > last_id,
+                    func.lower(InvoiceDetail.file_url).like('%.pdf'),
+                )
+                .order_by(InvoiceDetail.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            values = []
+            # 对象存储中的文件下载到临时文件，本批读取完成后删除
+            with ExitStack() as stack:
+                tasks = []
+                for row in rows:
+                    source = stack.enter_context(local_copy(row.file_url))
+                    if source is None:
+                        counts['failed'] += 1
+                        continue
+                    if not isinstance(source, str):
+                        # 已归档的文件传递内容
+                        source = source.getvalue()
+                    # 拆分前的明细没有页码，保存全部页
+                    tasks.append((row.id, source, row.page_start or 1, row.page_end))
+                for detail_id, pages in pool.map(_read_texts, tasks):
+                    if pages is None:
+                        counts['failed'] += 1
+                        continue
+                    values.append({'detail_id': detail_id, 'content': compress_pages(pages), 'fields': None})
+
+            if values:
+                db.session.execute(InvoiceText.__table__.insert(), values)
+            db.session.commit()
+            counts['filled'] += len(values)
+            progress(f"已补充文本层 {counts['filled']}，失败 {counts['failed']}")
+    return counts
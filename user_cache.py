@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""登录用户缓存
+Flask-Login 每个请求都会调用 user_loader，这里在进程内缓存用户身份和角色，
+避免每个请求（包括逐个文件的上传和 /uploads 文件访问）都查询一次数据库
+
+多进程部署时用户在某一个 worker 中被修改或删除：修改用户的事务同时写入 user_changes，
+各进程最多每 USER_CACHE_CHECK_SECONDS 秒读取一次新增的记录（一条按主键的查询），
+使对应用户的缓存失效，被降级或删除的用户在其他进程中最多再保留这么长时间
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask_login import UserMixin
+from sqlalchemy import select, delete, func
+
+from models import db, UserChange
+
+# 用户修改记录的保留时间（远大于缓存过期时间）
+CHANGE_RETENTION = timedelta(days=1)
+
+
+class CachedUser(UserMixin):
+    """缓存中的用户身份，只包含请求处理需要的字段"""
+
+    def __init__(self, id, login, name, role):
+        self.id = id
+        self.login = login
+        self.name = name
+        self.role = role
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.login, user.name, user.role)
+
+
+class UserCache:
+    """带过期时间的 LRU 缓存"""
+
+    def __init__(self, max_size=1024, ttl=300, check_interval=2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._last_change_id = None  # 已读取的最大用户修改记录ID
+        self._checked_at = 0
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            expires_at, user = item
+            if expires_at < time.monotonic():
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return user
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._items[user_id] = (time.monotonic() + self.ttl, user)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """使某个用户（或全部用户）的缓存失效"""
+        with self._lock:
+            if user_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(user_id, None)
+
+    def reset(self):
+        """清空缓存，下次读取时重新从最新的用户修改记录开始"""
+        with self._sync_lock:
+            self.invalidate()
+            self._last_change_id = None
+            self._checked_at = 0
+
+    def sync(self):
+        """读取其他进程记录的用户修改，使对应用户的缓存失效（每 check_interval 秒最多查询一次，需在应用上下文中调用）"""
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        with self._sync_lock:
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return
+            if self._last_change_id is None:
+                # 第一次读取：之前缓存的用户无法确认是否已被修改，全部丢弃
+                last_id = db.session.scalar(select(func.max(UserChange.id))) or 0
+                self.invalidate()
+            else:
+                rows = db.session.execute(
+                    select(UserChange.id, UserChange.user_id)
+                    .where(UserChange.id > self._last_change_id)
+                    .order_by(UserChange.id)
+                ).all()
+                for _, user_id in rows:
+                    self.invalidate(user_id)
+                last_id = rows[-1][0] if rows else self._last_change_id
+            self._last_change_id = last_id
+            self._checked_at = time.monotonic()
+
+
+user_cache = UserCache()
+
+
+def init_user_cache(app):
+    """根据配置设置缓存大小、过期时间和检查其他进程修改的间隔"""
+    user_cache.max_size = app.config.get('USER_CACHE_SIZE', 1024)
+    user_cache.ttl = app.config.get('USER_CACHE_TTL', 300)
+    user_cache.check_interval = app.config.get('USER_CACHE_CHECK_SECONDS', 2)
+    user_cache.reset()
+
+
+def record_user_change(user_id):
+    """
+    在当前事务中记录用户修改，其他进程读取后使该用户的缓存失效（提交后本进程仍需调用 user_cache.invalidate）
+
+    Args:
+        user_id: 用户ID
+    """
+    # 清理过期记录时保留最新的一条，SQLite 的自增ID不会回退
+    latest = select(func.max(UserChange.id)).scalar_subquery()
+    db.session.execute(
+        delete(UserChange).where(UserChange.created_at < datetime.now() - CHANGE_RETENTION, UserChange.id < latest)
+    )
+    db.session.add(UserChange(user_id=user_id))
+
+
+def load_cached_user(user_id, loader):
+    """
+    从缓存读取用户，未命中时调用 loader 查询数据库
+
+    Args:
+        user_id: 用户ID
+        loader: 根据ID查询 User 的函数
+
+    Returns:
+        CachedUser 或 None
+    """
+    user_cache.sync()
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    db_user = loader(user_id)
+    if db_user is None:
+        return None
+    user = CachedUser.from_user(db_user)
+    user_cache.set(user_id, user)
+    return user
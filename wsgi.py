@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+生产环境 WSGI 入口
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+gunicorn.conf.py 开启 preload_app，本模块在 master 进程中导入一次：
+创建应用并完成预热（字体注册、提取正则和 CMap、数据库表结构），然后再 fork 出 worker
+"""
+from app import create_app, warm_up
+
+application = create_app()
+warm_up(application)